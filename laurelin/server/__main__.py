@@ -1,19 +1,43 @@
-import asyncio
-import sys
+import argparse
 import os
-from .base import run_config_file
+import sys
+
+from .base import LaurelinServer, load_config_file
+from .config import Config
+from .runtime import EVENT_LOOPS, configure_event_loop, configure_gc, freeze_gc
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='laurelin.server', description='Run the laurelin LDAP server')
+    parser.add_argument('config', nargs='?', default=os.environ.get('LAURELIN_SERVER_CONFIG'),
+                        help='Config filename, defaults to $LAURELIN_SERVER_CONFIG')
+    parser.add_argument('--event-loop', choices=EVENT_LOOPS, default=None,
+                        help='Event loop implementation, overrides `event_loop:` in the config (default auto)')
+    parser.add_argument('--debug', action='store_true', default=None,
+                        help='Enable asyncio debug mode, overrides `debug:` in the config')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.config:
+        sys.stderr.write('Could not find a config filename - pass as $1 or $LAURELIN_SERVER_CONFIG\n')
+        sys.exit(1)
+
+    conf = load_config_file(args.config)
+
+    event_loop = args.event_loop or conf.get('event_loop', 'auto')
+    debug = args.debug if args.debug is not None else conf.get('debug', False)
+    gc_conf = Config(conf.get('gc', {}))
 
+    configure_gc(gc_conf)
+    loop_name = configure_event_loop(event_loop)
 
-async def main():
-    try:
-        conf_fn = sys.argv[1]
-    except IndexError:
-        try:
-            conf_fn = os.environ['LAURELIN_SERVER_CONFIG']
-        except KeyError:
-            sys.stderr.write('Could not find a config filename - pass as $1 or $LAURELIN_SERVER_CONFIG\n')
-            sys.exit(1)
-    await run_config_file(conf_fn)
+    server = LaurelinServer(conf)
+    server.logger.info(f'Using {loop_name} event loop, asyncio debug mode is {"on" if debug else "off"}')
+    freeze_gc(gc_conf)
+    server.serve(debug)
 
 
-asyncio.run(main(), debug=True)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Admission control - shed load with an LDAP result instead of letting every client slow down
+"""
+from collections import defaultdict
+
+from .stats import get_stats
+
+
+class ConnectionLimiter(object):
+    """Per-listener connection accounting"""
+
+    def __init__(self, max_connections: int = None, max_connections_per_ip: int = None):
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.connections = 0
+        self.connections_per_ip = defaultdict(int)
+
+    def admit(self, ip) -> (str, None):
+        """
+        Attempt to admit a new connection from ip (None if the transport has no peer address)
+
+        :returns: None if the connection was admitted, otherwise a string describing why it was refused
+        """
+        if self.max_connections is not None and self.connections >= self.max_connections:
+            get_stats().incr('connections_shed_max_connections')
+            return f'Server is at its limit of {self.max_connections} connections'
+        if ip is not None and self.max_connections_per_ip is not None:
+            if self.connections_per_ip[ip] >= self.max_connections_per_ip:
+                get_stats().incr('connections_shed_max_connections_per_ip')
+                return f'Too many connections from {ip}'
+            self.connections_per_ip[ip] += 1
+        self.connections += 1
+        get_stats().incr('connections_accepted')
+        return None
+
+    def release(self, ip):
+        self.connections -= 1
+        if ip is not None and self.max_connections_per_ip is not None:
+            self.connections_per_ip[ip] -= 1
+            if not self.connections_per_ip[ip]:
+                del self.connections_per_ip[ip]
+
+
+class OperationBudget(object):
+    """Server-wide limit on the number of operations in flight across all connections"""
+
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.in_flight = 0
+
+    def try_acquire(self) -> bool:
+        if self.limit is not None and self.in_flight >= self.limit:
+            get_stats().incr('operations_shed')
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
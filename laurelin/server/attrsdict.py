@@ -1,6 +1,41 @@
 from laurelin.ldap.utils import CaseIgnoreDict
 
 from .attrvaluelist import AttrValueList
+from .schema import get_schema
+
+
+class AttrSelection(object):
+    """
+    The attribute list of a search request, prepared once per search
+
+    An empty list or * selects all user attributes, + selects all operational attributes, and 1.1 alone selects no
+    attributes. Names are matched case-insensitively.
+    """
+
+    def __init__(self, attrs=None):
+        attrs = {attr.lower() for attr in attrs or ()}
+        self.all_user = not attrs or '*' in attrs
+        self.all_operational = '+' in attrs
+        self.names = attrs - {'*', '+', '1.1'}
+        self._operational = {}
+
+    def _is_operational(self, attr: str) -> bool:
+        try:
+            return self._operational[attr]
+        except KeyError:
+            operational = get_schema().get_attribute_type(attr)['usage'] != 'userApplications'
+            self._operational[attr] = operational
+            return operational
+
+    def __contains__(self, attr: str) -> bool:
+        attr = attr.lower()
+        if attr in self.names:
+            return True
+        if self.all_user or self.all_operational:
+            if self._is_operational(attr):
+                return self.all_operational
+            return self.all_user
+        return False
 
 
 class AttrsDict(CaseIgnoreDict):
@@ -9,12 +44,13 @@ class AttrsDict(CaseIgnoreDict):
         return self.get(attr, AttrValueList(attr))
 
     def deepcopy(self, attrs=None, types_only=False):
-        """Return a deep copy of self optionally limited to attrs"""
+        """Return a deep copy of self optionally limited to attrs (a list of names or an AttrSelection)"""
+        if not isinstance(attrs, AttrSelection):
+            attrs = AttrSelection(attrs)
         ret = AttrsDict()
         for attr, vals in self.items():
-            if attrs:
-                if attr not in attrs:
-                    continue
+            if attr not in attrs:
+                continue
             ret[attr] = AttrValueList(attr)
             if types_only:
                 continue
@@ -22,6 +58,13 @@ class AttrsDict(CaseIgnoreDict):
                 ret[attr].append(val)
         return ret
 
+    def copy(self) -> 'AttrsDict':
+        """Return a deep copy of all attributes"""
+        ret = AttrsDict()
+        for attr, vals in self.items():
+            ret[attr] = vals.copy()
+        return ret
+
     def setdefault(self, attr, default=None) -> AttrValueList:
         if default is None:
             default = AttrValueList(attr)
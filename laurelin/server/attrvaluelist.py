@@ -19,6 +19,13 @@ class AttrValueList(list):
         self._attr_type = attr
         self._attr = self._schema.get_attribute_type(attr)
 
+    def copy(self) -> 'AttrValueList':
+        # reuse the resolved attribute type rather than looking it up again
+        ret = AttrValueList.__new__(AttrValueList)
+        ret.__dict__.update(self.__dict__)
+        ret.extend(self)
+        return ret
+
     def _get_rule(self, key):
         try:
             rule = self._attr[key]
@@ -66,6 +73,13 @@ class AttrValueList(list):
                 return True
         return False
 
+    def greater_or_equal(self, assertion_value):
+        ordering = self._get_rule('ordering_rule')
+        for value in self:
+            if not ordering(value, assertion_value):
+                return True
+        return False
+
     def __lt__(self, other):
         return self.less_than(other)
 
@@ -76,7 +90,7 @@ class AttrValueList(list):
         return not self.less_than(other) and not self.equals(other)
 
     def __ge__(self, other):
-        return not self.less_than(other)
+        return self.greater_or_equal(other)
 
     def match_substrings(self, substrings):
         """
@@ -96,12 +110,12 @@ class AttrValueList(list):
             sub_obj = substrings.getComponentByPosition(i)
             sub_name = sub_obj.getName()
             sub_str = str(sub_obj.getComponent())
-            sub_strs.append(re.escape(substr_rule.prepare(sub_str)))
+            sub_strs.append(re.escape(substr_rule.prepare_substring(sub_str)))
         if sub_name != 'final' and sub_strs[-1] != '':
             sub_strs.append('')
         pattern = '^' + '.*?'.join(sub_strs) + '$'
         for val in self:
-            val = substr_rule.prepare(val)
+            val = substr_rule.prepare_substring(val)
             if re.match(pattern, val):
                 return True
         return False
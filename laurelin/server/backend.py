@@ -2,6 +2,7 @@ from laurelin.ldap import rfc4511, DerefAliases
 from laurelin.ldap.filter import parse as parse_filter
 from laurelin.ldap.protoutils import seq_to_list
 
+from .exceptions import *
 from .utils import optional_component, bool_component, list_component, require_component, str_component, int_component
 
 
@@ -66,10 +67,31 @@ class DataBackendMeta(type):
 
 
 class DataBackend(object, metaclass=DataBackendMeta):
+    # Values of the multi_worker config option this backend can operate under when the server runs multiple worker
+    # processes. read_only: every worker serves its own copy and rejects writes; independent: every worker has its
+    # own writable copy and writes are not seen by other workers; shared: all workers use one persistent store
+    MULTI_WORKER_MODES = ()
+
     def __init__(self, suffix, conf):
         self.suffix = suffix
         self.conf = conf
         self.default = self.conf.get('default', False)
+        self.read_only = self.conf.get('read_only', False)
+        self.multi_worker = self.conf.get('multi_worker')
+
+    def configure_workers(self):
+        """Called before forking when the server will run multiple worker processes"""
+        if self.multi_worker is None:
+            modes = ', '.join(self.MULTI_WORKER_MODES) or 'none supported'
+            raise ConfigError(f'DIT node {self.suffix} must set multi_worker to use multiple workers ({modes})')
+        if self.multi_worker not in self.MULTI_WORKER_MODES:
+            raise ConfigError(f'DIT node {self.suffix} backend does not support multi_worker: {self.multi_worker}')
+        if self.multi_worker == 'read_only':
+            self.read_only = True
+
+    def report(self) -> list:
+        """Lines describing backend-specific state, logged alongside the server stats"""
+        return []
 
     async def search(self, search_request):
         base_dn = require_component(search_request, 'baseObject', str)
@@ -81,8 +103,12 @@ class DataBackend(object, metaclass=DataBackendMeta):
         limit = int_component(search_request, 'sizeLimit')
         time_limit = int_component(search_request, 'timeLimit')
 
-        async for res in self.search_params(base_dn, scope, fil, attrs, deref_aliases, types_only, limit, time_limit):
-            yield res
+        results = self.search_params(base_dn, scope, fil, attrs, deref_aliases, types_only, limit, time_limit)
+        try:
+            async for res in results:
+                yield res
+        finally:
+            await results.aclose()
 
     async def search_params(self, base_dn: str, scope: rfc4511.Scope, fil: str = None,
                             attrs: list = None, deref_aliases: rfc4511.DerefAliases = None, types_only: bool = False,
@@ -104,8 +130,12 @@ class DataBackend(object, metaclass=DataBackendMeta):
         req.setComponentByName('sizeLimit', rfc4511.Integer0ToMax(limit))
         req.setComponentByName('timeLimit', rfc4511.Integer0ToMax(time_limit))
 
-        async for res in self.search(req):
-            yield res
+        results = self.search(req)
+        try:
+            async for res in results:
+                yield res
+        finally:
+            await results.aclose()
 
     async def compare(self, compare_request):
         dn = require_component(compare_request, 'entry', str)
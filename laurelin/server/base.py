@@ -1,11 +1,16 @@
 import asyncio
 import logging
 import logging.config
+from .admission import OperationBudget
 from .auth import AuthStack
 from .config import Config
 from .dit import DIT
 from .ldapserver import LDAPServer
+from .root_dse import RootDSE
+from .exceptions import *
 from .schema import get_schema
+from .stats import get_stats
+from .workers import WorkerSupervisor
 
 _logger_name = 'laurelin.server'
 
@@ -13,23 +18,58 @@ _logger_name = 'laurelin.server'
 class LaurelinServer(object):
     def __init__(self, conf: Config):
         self.logger = logging.getLogger(_logger_name)
+        self.conf = conf
 
-        dit = DIT(conf['dit'])
-        auth_stack = AuthStack(conf['auth_stack'], conf['auth_backends'], dit)
+        self.dit = DIT(conf['dit'])
+        auth_stack = AuthStack(conf['auth_stack'], conf['auth_backends'], self.dit)
+        budget = OperationBudget(conf.get('max_inflight_operations'))
+        self.root_dse = RootDSE(self.dit)
 
         self.servers = []
         for uri, server_conf in conf['servers'].items():
             self.logger.debug(f'Setting up LDAPServer {uri}')
-            self.servers.append(LDAPServer(uri, Config(server_conf), dit, auth_stack))
+            self.servers.append(LDAPServer(uri, Config(server_conf), self.dit, auth_stack, budget, self.root_dse))
+
+        self.stats_log_interval = conf.get('stats_log_interval')
+
+        self.workers = conf.get('workers', 1)
+        if self.workers < 1:
+            raise ConfigError('workers must be at least 1')
+        elif self.workers > 1:
+            for backend in self.dit.values():
+                backend.configure_workers()
+            for server in self.servers:
+                server.prepare_workers()
 
         self.logger.debug('LaurelinServer init complete')
 
     async def run(self):
-        self.logger.debug('Running LaurelinServer')
-        await asyncio.gather(*[server.run() for server in self.servers])
+        loop = asyncio.get_event_loop()
+        self.logger.info(f'Running LaurelinServer on {type(loop).__module__}.{type(loop).__name__}')
+        coros = [server.run() for server in self.servers]
+        if self.stats_log_interval:
+            coros.append(self._log_stats())
+        await asyncio.gather(*coros)
 
+    async def _log_stats(self):
+        stats = get_stats()
+        while True:
+            await asyncio.sleep(self.stats_log_interval)
+            self.logger.info(f'Stats: {stats.format()}')
+            for backend in self.dit.values():
+                for line in backend.report():
+                    self.logger.info(f'{backend.suffix}: {line}')
 
-async def run_config_file(conf_fn):
+    def serve(self, debug=False):
+        """Run the server until stopped, forking worker processes if configured"""
+        if self.workers > 1:
+            WorkerSupervisor(self, self.workers, debug).run()
+        else:
+            asyncio.run(self.run(), debug=debug)
+
+
+def load_config_file(conf_fn) -> Config:
+    """Load the config file and set up logging and the schema from it"""
     conf = Config()
     conf.load_file(conf_fn)
 
@@ -43,5 +83,17 @@ async def run_config_file(conf_fn):
     schema.load_conf_dir()
     schema.resolve()
 
+    return conf
+
+
+async def run_config_file(conf_fn):
+    conf = load_config_file(conf_fn)
     server = LaurelinServer(conf)
     await server.run()
+
+
+def serve_config_file(conf_fn, debug=False):
+    """Blocking entry point; unlike run_config_file this supports multiple worker processes"""
+    conf = load_config_file(conf_fn)
+    server = LaurelinServer(conf)
+    server.serve(debug)
@@ -0,0 +1,221 @@
+"""
+Minimal BER handling for the LDAP wire protocol
+
+pyasn1 remains responsible for actually decoding messages; this module finds PDU boundaries so that pyasn1 is handed
+exactly one complete message at a time, and provides fast-path encoders for the highest-volume responses.
+"""
+from laurelin.ldap import rfc4511
+from pyasn1.codec.ber.encoder import encode as ber_encode
+
+from .exceptions import *
+
+
+def read_header(buf) -> (tuple, None):
+    """
+    Parse the tag and length octets at the start of buf
+
+    :returns: (header_length, content_length), or None if buf does not yet contain the full header
+    """
+    buf_len = len(buf)
+    if buf_len < 2:
+        return None
+
+    i = 1
+    if buf[0] & 0x1f == 0x1f:
+        # high tag number form, tag continues while the high bit is set
+        while True:
+            if i >= buf_len:
+                return None
+            octet = buf[i]
+            i += 1
+            if not octet & 0x80:
+                break
+        if i >= buf_len:
+            return None
+
+    first_len_octet = buf[i]
+    i += 1
+    if first_len_octet < 0x80:
+        return i, first_len_octet
+    elif first_len_octet == 0x80:
+        # RFC4511 sec 5.1
+        raise DisconnectionProtocolError('Indefinite length BER encoding is not permitted')
+    num_len_octets = first_len_octet & 0x7f
+    if num_len_octets > 8:
+        raise DisconnectionProtocolError(f'BER length uses {num_len_octets} octets')
+    if buf_len < i + num_len_octets:
+        return None
+    content_len = int.from_bytes(buf[i:i + num_len_octets], 'big')
+    return i + num_len_octets, content_len
+
+
+class PDUReader(object):
+    """Frames complete BER-encoded PDUs out of an asyncio.StreamReader"""
+
+    MIN_READ_SIZE = 1024
+    MAX_READ_SIZE = 256 * 1024
+
+    def __init__(self, reader, max_pdu_size: int):
+        self.reader = reader
+        self.max_pdu_size = max_pdu_size
+        self._buffer = bytearray()
+        self._read_size = PDUReader.MIN_READ_SIZE
+
+    async def _fill(self, need: int) -> bool:
+        """Read at least some data into the buffer; returns False on EOF"""
+        data = await self.reader.read(max(need, self._read_size))
+        if not data:
+            return False
+        if len(data) >= self._read_size:
+            # the socket had at least as much as we asked for, so ask for more next time
+            self._read_size = min(self._read_size * 2, PDUReader.MAX_READ_SIZE)
+        self._buffer += data
+        return True
+
+    async def read_pdu(self) -> (bytes, None):
+        """Obtain the next complete PDU, or None if the stream was closed (discarding any partial PDU)"""
+        while True:
+            header = read_header(self._buffer)
+            if header is None:
+                if not await self._fill(0):
+                    return None
+                continue
+
+            header_len, content_len = header
+            pdu_len = header_len + content_len
+            if pdu_len > self.max_pdu_size:
+                raise DisconnectionProtocolError(f'PDU length {pdu_len} exceeds maximum of {self.max_pdu_size}')
+
+            have = len(self._buffer)
+            if have >= pdu_len:
+                with memoryview(self._buffer) as view:
+                    pdu = view[:pdu_len].tobytes()
+                # deleting from the front of a bytearray does not move the remaining data
+                del self._buffer[:pdu_len]
+                return pdu
+
+            if not await self._fill(min(pdu_len - have, PDUReader.MAX_READ_SIZE)):
+                return None
+
+
+# Fast-path encoders
+#
+# These produce output byte-identical to encoding the equivalent rfc4511 objects with pyasn1's BER encoder, but
+# without building the pyasn1 object tree. Only the response PDUs we send in bulk are covered here.
+
+def _tag_octet(asn1_cls):
+    tag = asn1_cls.tagSet[-1]
+    return tag.tagClass | tag.tagFormat | tag.tagId
+
+
+_TAG_INTEGER = 0x02
+_TAG_OCTET_STRING = 0x04
+_TAG_ENUMERATED = 0x0a
+_TAG_SEQUENCE = 0x30
+_TAG_SET = 0x31
+_TAG_SEARCH_RESULT_ENTRY = _tag_octet(rfc4511.SearchResultEntry)
+
+_result_codes = dict(rfc4511.ResultCode.namedValues.items())
+
+
+def _empty_optional_encoding(asn1_obj, component_cls) -> bytes:
+    """
+    Older pyasn1 releases encode unset optional SEQUENCE OF components (the LDAPMessage controls and LDAPResult
+    referral) as empty rather than omitting them. Determine what the installed release does so the fast path stays
+    byte-identical.
+    """
+    empty = bytes((_tag_octet(component_cls), 0))
+    if ber_encode(asn1_obj).endswith(empty):
+        return empty
+    return b''
+
+
+def _probe_message():
+    lm = rfc4511.LDAPMessage()
+    lm.setComponentByName('messageID', rfc4511.MessageID(0))
+    op = rfc4511.ProtocolOp()
+    op.setComponentByName('delRequest', rfc4511.DelRequest(''))
+    lm.setComponentByName('protocolOp', op)
+    return lm
+
+
+def _probe_result():
+    res = rfc4511.DelResponse()
+    res.setComponentByName('resultCode', rfc4511.ResultCode('success'))
+    res.setComponentByName('matchedDN', '')
+    res.setComponentByName('diagnosticMessage', '')
+    return res
+
+
+_EMPTY_CONTROLS = _empty_optional_encoding(_probe_message(), rfc4511.Controls)
+_EMPTY_REFERRAL = _empty_optional_encoding(_probe_result(), rfc4511.Referral)
+
+
+def encode_length(length: int) -> bytes:
+    if length < 0x80:
+        return bytes((length,))
+    len_octets = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes((0x80 | len(len_octets),)) + len_octets
+
+
+def encode_tlv(tag: int, content: bytes) -> bytes:
+    return bytes((tag,)) + encode_length(len(content)) + content
+
+
+def encode_integer(value: int, tag: int = _TAG_INTEGER) -> bytes:
+    return encode_tlv(tag, value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True))
+
+
+def encode_octet_string(value) -> bytes:
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return encode_tlv(_TAG_OCTET_STRING, value)
+
+
+def encode_message_op(message_id: int, op: bytes) -> bytes:
+    """Encode an LDAPMessage with no controls around an already-encoded protocolOp"""
+    return encode_tlv(_TAG_SEQUENCE, encode_integer(message_id) + op + _EMPTY_CONTROLS)
+
+
+def encode_ldap_result_op(res_cls, result_code, matched_dn='', message='') -> bytes:
+    """
+    Encode a response protocolOp consisting only of the LDAPResult components
+
+    :param res_cls: The rfc4511 response class, used only for its tag
+    :param result_code: A result code name, integer, or rfc4511.ResultCode
+    """
+    if isinstance(result_code, str):
+        result_code = _result_codes[result_code]
+    content = (encode_integer(int(result_code), _TAG_ENUMERATED) +
+               encode_octet_string(matched_dn) +
+               encode_octet_string(message) +
+               _EMPTY_REFERRAL)
+    return encode_tlv(_tag_octet(res_cls), content)
+
+
+def encode_ldap_result(message_id: int, res_cls, result_code, matched_dn='', message='') -> bytes:
+    """Encode an LDAPMessage containing a response consisting only of the LDAPResult components"""
+    return encode_message_op(message_id, encode_ldap_result_op(res_cls, result_code, matched_dn, message))
+
+
+def encode_search_result_entry_op(dn: str, attrs) -> bytes:
+    """
+    Encode a SearchResultEntry protocolOp; attributes with no values are omitted
+
+    :param attrs: A dict of attribute values or an iterable of (attribute, values) pairs
+    """
+    if isinstance(attrs, dict):
+        attrs = attrs.items()
+    partial_attrs = []
+    for attr, vals in attrs:
+        if not vals:
+            continue
+        enc_vals = b''.join([encode_octet_string(val) for val in vals])
+        partial_attrs.append(encode_tlv(_TAG_SEQUENCE, encode_octet_string(attr) + encode_tlv(_TAG_SET, enc_vals)))
+    content = encode_octet_string(dn) + encode_tlv(_TAG_SEQUENCE, b''.join(partial_attrs))
+    return encode_tlv(_TAG_SEARCH_RESULT_ENTRY, content)
+
+
+def encode_search_result_entry(message_id: int, dn: str, attrs) -> bytes:
+    """Encode an LDAPMessage containing a SearchResultEntry"""
+    return encode_message_op(message_id, encode_search_result_entry_op(dn, attrs))
@@ -1,19 +1,25 @@
 import asyncio
 import logging
 import traceback
+from functools import partial
 
 from async_timeout import timeout
 from laurelin.ldap import rfc4511
 from laurelin.ldap.constants import Scope
 from pyasn1.codec.ber.decoder import decode as ber_decode
 from pyasn1.codec.ber.encoder import encode as ber_encode
-from pyasn1.error import PyAsn1Error, SubstrateUnderrunError
+from pyasn1.error import PyAsn1Error
 
 from . import search_results, constants
 from .auth import AuthStack
+from .admission import OperationBudget
+from .ber import PDUReader, encode_ldap_result
+from .config import Config
 from .dit import DIT
 from .exceptions import *
 from .request import Request, is_request
+from .response_writer import ResponseWriter
+from .root_dse import RootDSE
 from .utils import require_component, int_component
 
 
@@ -47,6 +53,18 @@ def protocol_op(op_name: str, obj):
     return op
 
 
+def notice_of_disconnection(result_code='protocolError', message=''):
+    """Instantiate an unsolicited notice of disconnection rfc4511.LDAPMessage"""
+    xr = ldap_result(rfc4511.ExtendedResponse, result_code, message=message)
+    xr.setComponentByName('responseName', constants.OID_NOTICE_OF_DISCONNECTION)
+    op = protocol_op('extendedResp', xr)
+    return pack(0, op)
+
+
+# operations that can safely be stopped part way through; writes always run to completion once started
+_CANCELLABLE_OPERATIONS = frozenset(('searchRequest', 'compareRequest'))
+
+
 def _backend_method_name(root_op: str):
     """Convert a root operation string to the name of a method on an DataBackend"""
     return root_op.replace('DN', '_dn')
@@ -77,69 +95,97 @@ class ClientLogger(object):
 
 
 class ClientHandler(object):
-    RECV_BUFFER = 1024
+    DEFAULT_MAX_OUTSTANDING_OPERATIONS = 16
+    DEFAULT_MAX_PDU_SIZE = 16 * 1024 * 1024
+    DEFAULT_WRITE_HIGH_WATER_MARK = 64 * 1024
+    DEFAULT_WRITE_FLUSH_DELAY = 0
 
-    def __init__(self, reader, writer, dit: DIT, auth_stack: AuthStack):
+    def __init__(self, reader, writer, conf: Config, dit: DIT, auth_stack: AuthStack, budget: OperationBudget = None,
+                 root_dse: RootDSE = None):
         self.reader = reader
         self.writer = writer
+        self.conf = conf
         self.dit = dit
         self.auth_stack = auth_stack
+        if budget is None:
+            budget = OperationBudget()
+        self.budget = budget
+        if root_dse is None:
+            root_dse = RootDSE(dit)
+        self.root_dse = root_dse
         self.log = ClientLogger(writer.get_extra_info('peername'))
 
         self.authenticated_name = None
 
-        # Right now this is going to be the same for every client so maybe do once in LaurelinServer/LDAPServer
-        #  BUT depending on other things it may be different for some later, so TBD
-
-        nc = []
-        dnc = []
-        for dn, backend in self.dit.items():
-            nc.append(str(dn))
-            if backend.default:
-                if not dnc:
-                    dnc.append(str(dn))
-                else:
-                    raise ConfigError('Multiple DIT nodes marked as default')
-
-        if not dnc and len(nc) == 1:
-            dnc.append(nc[0])
-
-        if not nc:
-            raise ConfigError('No DIT nodes configured')
-
-        self.root_dse = search_results.Entry('', {
-            'namingContexts': nc,
-            'defaultNamingContext': dnc,
-            'supportedLDAPVersion': ['3'],
-            'vendorName': ['laurelin'],
-        })
+        # In-flight operations are tracked by message ID so that responses can be interleaved on the socket
+        max_outstanding = self.conf.get('max_outstanding_operations',
+                                        ClientHandler.DEFAULT_MAX_OUTSTANDING_OPERATIONS)
+        if max_outstanding < 1:
+            raise ConfigError('max_outstanding_operations must be at least 1')
+        self.operations = {}
+        # message IDs of the in-flight operations in _CANCELLABLE_OPERATIONS
+        self._cancellable = set()
+        self._operation_slots = asyncio.Semaphore(max_outstanding)
+
+        max_pdu_size = self.conf.get('max_pdu_size', ClientHandler.DEFAULT_MAX_PDU_SIZE)
+        self.pdus = PDUReader(self.reader, max_pdu_size)
+
+        high_water_mark = self.conf.get('write_high_water_mark', ClientHandler.DEFAULT_WRITE_HIGH_WATER_MARK)
+        flush_delay = self.conf.get('write_flush_delay', ClientHandler.DEFAULT_WRITE_FLUSH_DELAY)
+        self.responses = ResponseWriter(self.writer, high_water_mark, flush_delay)
+
+        # all in seconds, None to disable
+        self.idle_timeout = self.conf.get('idle_timeout')
+        self.operation_time_limit = self.conf.get('operation_time_limit')
+        max_lifetime = self.conf.get('max_connection_lifetime')
+        if max_lifetime:
+            self.expires_at = asyncio.get_event_loop().time() + max_lifetime
+        else:
+            self.expires_at = None
 
     async def send(self, lm: rfc4511.LDAPMessage):
         """Encode and send an LDAP message"""
-        self.writer.write(ber_encode(lm))
-        await self.writer.drain()
+        await self.send_pdu(ber_encode(lm))
+
+    async def send_pdu(self, pdu: bytes, flush=True):
+        """Send an already-encoded LDAP message; intermediate responses should pass flush=False"""
+        await self.responses.send(pdu, flush)
 
     async def send_ldap_result(self, req: Request, result_code, message='', controls=None):
         """Prepare and send an LDAP result message appropriate to the given Request"""
-        res = ldap_result(req.res_cls, result_code, req.matched_dn, message)
-        po = protocol_op(req.res_name, res)
-        lm = pack(req.id, po, controls)
-        await self.send(lm)
+        if controls:
+            res = ldap_result(req.res_cls, result_code, req.matched_dn, message)
+            po = protocol_op(req.res_name, res)
+            lm = pack(req.id, po, controls)
+            await self.send(lm)
+        else:
+            await self.send_pdu(encode_ldap_result(req.id, req.res_cls, result_code, req.matched_dn, message))
+
+    async def send_search_result(self, req: Request, result, controls=None):
+        """Send a search_results.Entry or search_results.Done in response to the given Request"""
+        if controls:
+            pdu = ber_encode(pack(req.id, result.to_proto(), controls))
+        else:
+            pdu = result.to_ber(req.id)
+        # entries are coalesced into larger writes; the SearchResultDone ends the operation
+        await self.send_pdu(pdu, flush=isinstance(result, search_results.Done))
+
+    async def send_notice_of_disconnection(self, message='', result_code='protocolError'):
+        """Send an unsolicited notice of disconnection"""
+        await self.send(notice_of_disconnection(result_code, message))
 
     async def run(self):
         """Handle the client's requests forever"""
 
         self.log.debug('Started new client')
-        buffer = b''
-        while True:
-            try:
-                data = await self.reader.read(self.RECV_BUFFER)
-                if not data:
-                    self.log.info('Client has exited')
-                    return
-                buffer += data
-                while len(buffer) > 0:
-                    _request, buffer = ber_decode(buffer, asn1Spec=rfc4511.LDAPMessage())
+        try:
+            while True:
+                try:
+                    pdu = await self._next_pdu()
+                    if pdu is None:
+                        self.log.info('Client has exited')
+                        return
+                    _request, _ = ber_decode(pdu, asn1Spec=rfc4511.LDAPMessage())
                     req = Request(_request)
 
                     self.log.info(f'Received message_id={req.id} operation={req.operation}')
@@ -149,23 +195,124 @@ class ClientHandler(object):
                         self.log.info('Client has unbound')
                         return
                     elif req.operation == 'abandonRequest':
-                        # As of right now I can't fathom a way to actually get abandon to work with asyncio
-                        #
-                        # Unfortunately RFC4511 specifies that interrupting result entries is the one thing we MUST
-                        # do, but it also says clients MUST NOT care if the abandon worked, so ... ?
-                        self.log.warning('Received abandon request - ignoring')
-                    else:
+                        self.abandon(int(req.asn1_obj))
+                    elif req.operation == 'bindRequest':
+                        # RFC4511 sec 4.2.1 - all outstanding operations must complete before processing a bind
+                        await self.wait_outstanding()
                         await self._respond_to_request(req)
-            except SubstrateUnderrunError:
-                continue
-            except (PyAsn1Error, DisconnectionProtocolError) as e:
-                self.log.exception('Caught fatal disconnect error', e)
-                xr = ldap_result(rfc4511.ExtendedResponse, 'protocolError', message=str(e))
-                xr.setComponentByName('responseName', constants.OID_NOTICE_OF_DISCONNECTION)
-                op = protocol_op('extendedResp', xr)
-                lm = pack(0, op)
-                await self.send(lm)
-                return
+                    else:
+                        await self.dispatch(req)
+                except ConnectionExpired as e:
+                    self.log.info(f'Disconnecting client: {e}')
+                    await self.wait_outstanding()
+                    await self.send_notice_of_disconnection(str(e), 'unavailable')
+                    return
+                except (PyAsn1Error, DisconnectionProtocolError) as e:
+                    self.log.exception('Caught fatal disconnect error', e)
+                    await self.send_notice_of_disconnection(str(e))
+                    return
+        finally:
+            await self.cancel_outstanding()
+
+    async def _next_pdu(self):
+        """Read the next request PDU, enforcing the idle timeout and maximum connection lifetime"""
+        loop = asyncio.get_event_loop()
+        while True:
+            wait = self.idle_timeout
+            if self.expires_at is not None:
+                remaining = self.expires_at - loop.time()
+                if remaining <= 0:
+                    raise ConnectionExpired('Maximum connection lifetime exceeded')
+                if wait is None or remaining < wait:
+                    wait = remaining
+            try:
+                async with timeout(wait):
+                    return await self.pdus.read_pdu()
+            except asyncio.TimeoutError:
+                # PDUReader only consumes data into its buffer once a read completes, so nothing is lost here
+                if self.expires_at is not None and loop.time() >= self.expires_at:
+                    raise ConnectionExpired('Maximum connection lifetime exceeded')
+                if not self.operations:
+                    raise ConnectionExpired(f'Connection was idle for more than {self.idle_timeout} seconds')
+                # not idle while operations are still in flight
+
+    async def dispatch(self, req: Request):
+        """Start responding to a request as its own task, waiting for a free slot if too many are outstanding"""
+        if req.id in self.operations:
+            raise DisconnectionProtocolError(f'Message ID {req.id} is already in use by an outstanding operation')
+        await self._operation_slots.acquire()
+        task = asyncio.ensure_future(self._run_operation(req))
+        self.operations[req.id] = task
+        if req.operation in _CANCELLABLE_OPERATIONS:
+            self._cancellable.add(req.id)
+        task.add_done_callback(partial(self._operation_done, req.id))
+
+    def _operation_done(self, message_id, task):
+        del self.operations[message_id]
+        self._cancellable.discard(message_id)
+        self._operation_slots.release()
+
+    async def _run_operation(self, req: Request):
+        try:
+            if self.budget.try_acquire():
+                try:
+                    await self._respond_with_deadline(req)
+                finally:
+                    self.budget.release()
+            else:
+                await self._respond_busy(req)
+        except (PyAsn1Error, DisconnectionProtocolError) as e:
+            self.log.exception(f'{req.operation} {req.id} caused fatal disconnect error', e)
+            await self.send_notice_of_disconnection(str(e))
+            self.writer.close()
+
+    async def wait_outstanding(self):
+        """Wait for all in-flight operations to complete"""
+        if self.operations:
+            await asyncio.gather(*self.operations.values(), return_exceptions=True)
+
+    def abandon(self, message_id: int):
+        """Cancel an in-flight search or compare; no response is sent for an abandoned operation"""
+        try:
+            task = self.operations[message_id]
+        except KeyError:
+            # RFC4511 sec 4.11 - abandoning a completed or unknown operation is not an error
+            self.log.debug(f'Abandon request for message_id={message_id} which is not outstanding - ignoring')
+            return
+        if message_id not in self._cancellable:
+            # RFC4511 sec 4.11 - servers may decline to abandon an operation, which then completes normally
+            self.log.info(f'Not abandoning message_id={message_id}, writes always run to completion')
+            return
+        self.log.info(f'Abandoning message_id={message_id}')
+        task.cancel()
+
+    async def cancel_outstanding(self):
+        """Cancel all in-flight searches and compares, and wait for them and any writes to finish"""
+        for message_id in self._cancellable:
+            self.operations[message_id].cancel()
+        await self.wait_outstanding()
+
+    async def _respond_with_deadline(self, req):
+        # searches apply the server limit themselves alongside the client-requested timeLimit, and writes are never
+        # interrupted since they may already be committed
+        if req.operation == 'compareRequest':
+            time_limit = self.operation_time_limit
+        else:
+            time_limit = None
+        try:
+            async with timeout(time_limit):
+                await self._respond_to_request(req)
+        except asyncio.TimeoutError:
+            self.log.warning(f'{req.operation} {req.id} exceeded the server time limit of {time_limit} seconds')
+            await self.send_ldap_result(req, 'timeLimitExceeded',
+                                        f'Server time limit of {time_limit} seconds was exceeded')
+
+    async def _respond_busy(self, req):
+        if not is_request(req.operation):
+            raise DisconnectionProtocolError(f'{req.id} does not appear to contain a standard LDAP request')
+        self.log.warning(f'{req.operation} {req.id} refused, server is at its in-flight operation limit')
+        req.populate_response_attrs()
+        await self.send_ldap_result(req, 'busy', 'Server is busy, try again later')
 
     async def _respond_to_request(self, req):
         if not is_request(req.operation):
@@ -175,6 +322,9 @@ class ClientHandler(object):
             req.populate_response_attrs()
             handler_method = getattr(self, _handler_method_name(req.root_op), self._handle_generic)
             await handler_method(req)
+        except asyncio.CancelledError:
+            self.log.info(f'{req.operation} {req.id} was cancelled')
+            raise
         except ResultCodeError as e:
             self.log.info(f'{req.operation} {req.id} failed gracefully with result {e.RESULT_CODE}: '
                           f'{e}\n{traceback.format_exc()}')
@@ -189,8 +339,8 @@ class ClientHandler(object):
             await self.send_ldap_result(req, 'other', 'Internal server error')
 
     async def _handle_generic(self, req):
-        # This handles all the normal methods
-        backend_method = getattr(self.dit.backend(req.matched_dn), _backend_method_name(req.root_op))
+        # This handles all the normal methods, which are all writes
+        backend_method = getattr(self.dit.writable_backend(req.matched_dn), _backend_method_name(req.root_op))
         self.log.info(f'Received {req.operation}')
         await backend_method(req.asn1_obj)
         self.log.debug(f'{req.operation} {req.id} successful')
@@ -208,25 +358,28 @@ class ClientHandler(object):
         scope = require_component(req.asn1_obj, 'scope')
         if req.matched_dn == '' and scope == Scope.BASE:
             self.log.debug('Got root DSE request')
-            lm = pack(req.id, self.root_dse.to_proto())
-            await self.send(lm)
-            lm = pack(req.id, search_results.Done('').to_proto())
-            await self.send(lm)
+            await self.send_pdu(self.root_dse.encode(req.id))
             return
 
         limit = int_component(req.asn1_obj, 'sizeLimit', default_value=0)
         time_limit = int_component(req.asn1_obj, 'timeLimit', default_value=0)
+        if self.operation_time_limit and (not time_limit or self.operation_time_limit < time_limit):
+            time_limit = self.operation_time_limit
 
+        results = self.dit.backend(req.matched_dn).search(req.asn1_obj)
         try:
             n = 0
             async with timeout(time_limit):
-                async for result in self.dit.backend(req.matched_dn).search(req.asn1_obj):
-                    lm = pack(req.id, result.to_proto())  # TODO controls?
-                    await self.send(lm)
-                    n += 1
-                    if limit and n >= limit:
+                async for result in results:
+                    if limit and n >= limit and not isinstance(result, search_results.Done):
+                        # the backend did not enforce the size limit itself
                         self.log.debug(f'Search {req.id} hit requested size limit')
+                        await self.send_search_result(req, search_results.Done(
+                            req.matched_dn, rfc4511.ResultCode('sizeLimitExceeded'),
+                            f'Size limit of {limit} entries exceeded'))
                         break
+                    await self.send_search_result(req, result)  # TODO controls?
+                    n += 1
             self.log.debug('Search successfully completed')
         except ObjectNotFound as e:
             base_dn = req.matched_dn
@@ -235,8 +388,10 @@ class ClientHandler(object):
             raise NoSuchObjectError(f'Search base object was not found, found up to: {matched_dn} '
                                     f'Could not find: {unmatched}')
         except asyncio.TimeoutError:
-            raise TimeLimitExceededError(f'Requested time limit of {time_limit} seconds was '
-                                         'exceeded during search request')
+            raise TimeLimitExceededError(f'Time limit of {time_limit} seconds was exceeded during search request')
+        finally:
+            # stops the backend scan immediately on abandon, time limit, or size limit
+            await results.aclose()
 
     async def _handle_compare(self, req):
         cmp = await self.dit.backend(req.matched_dn).compare(req.asn1_obj)
@@ -248,11 +403,7 @@ class ClientHandler(object):
         else:
             raise InternalError('Backend returned non-boolean for compare')
 
-        cr = ldap_result(rfc4511.CompareResponse, result, 'Compare successful')
-        op = protocol_op('compareResponse', cr)
-        lm = pack(req.id, op)  # TODO controls?
-
-        await self.send(lm)
+        await self.send_ldap_result(req, result, 'Compare successful')  # TODO controls?
 
     async def _handle_extended(self, req):
         # TODO extended requests
@@ -29,3 +29,10 @@ class DIT(dict):
             if dn[-len(suffix):] == suffix:
                 return self[suffix]
         raise NoSuchObjectError(f'Could not find a backend to handle the DN {dn}')
+
+    def writable_backend(self, dn) -> DataBackend:
+        """Obtain the backend for a given DN, ensuring it accepts writes"""
+        backend = self.backend(dn)
+        if backend is None or backend.read_only:
+            raise UnwillingToPerformError(f'The DIT node containing {dn} is read-only')
+        return backend
@@ -58,18 +58,31 @@ class DN(tuple):
             return tuple.__getitem__(self, item)
 
 
+def split_rdn(rdn: str) -> list:
+    """Split an RDN string into (attribute type, value) pairs exactly as given"""
+    avas = []
+    for ava in split_unescaped(rdn, '+'):
+        try:
+            attr, val = split_unescaped(ava, '=')
+        except ValueError:
+            raise InvalidDNError(f'Invalid RDN AVA {ava} - no equals sign or equals sign needs escaping')
+        avas.append((attr, val))
+    return avas
+
+
+def leaf_rdn(dn) -> str:
+    """The first RDN of a DN exactly as given"""
+    return split_unescaped(str(dn), ',')[0]
+
+
 def parse_rdn(rdn):
     if isinstance(rdn, RDN):
         return rdn
     if rdn == '':
         return RDN()
-    str_avas = split_unescaped(rdn, '+')
     tpl_avas = []
-    for ava in str_avas:
-        try:
-            attr, val = split_unescaped(ava, '=')
-        except ValueError:
-            raise InvalidDNError(f'Invalid RDN AVA {ava} - no equals sign or equals sign needs escaping')
+    for attr, val in split_rdn(rdn):
+        ava = f'{attr}={val}'
         try:
             val = get_schema().get_attribute_type(attr).prepare_value(val)
         except UndefinedSchemaElementError:
@@ -22,6 +22,10 @@ class ConfigError(LaurelinError):
     pass
 
 
+class ConnectionExpired(LaurelinError):
+    pass
+
+
 class SchemaError(LDAPError):
     pass
 
@@ -90,6 +94,10 @@ class TimeLimitExceededError(ResultCodeError):
     RESULT_CODE = 'timeLimitExceeded'
 
 
+class UnwillingToPerformError(ResultCodeError):
+    RESULT_CODE = 'unwillingToPerform'
+
+
 class AliasError(ResultCodeError):
     RESULT_CODE = 'aliasProblem'
 
@@ -1,14 +1,19 @@
 import asyncio
 import logging
+import os
+import socket
 import ssl
 
 from laurelin.ldap.net import parse_host_uri, host_port
+from pyasn1.codec.ber.encoder import encode as ber_encode
 
+from .admission import ConnectionLimiter, OperationBudget
 from .auth import AuthStack
 from .config import Config
-from .client_handler import ClientHandler
+from .client_handler import ClientHandler, notice_of_disconnection
 from .dit import DIT
 from .exceptions import *
+from .root_dse import RootDSE
 
 logger = logging.getLogger('laurelin.server')
 
@@ -20,31 +25,74 @@ class LDAPServer(object):
     DEFAULT_SSL_CLIENT_VERIFY_CA_PATH = None
     DEFAULT_SSL_CLIENT_VERIFY_CHECK_CRL = True
 
-    def __init__(self, uri: str, conf: Config, dit: DIT, auth_stack: AuthStack):
+    def __init__(self, uri: str, conf: Config, dit: DIT, auth_stack: AuthStack, budget: OperationBudget = None,
+                 root_dse: RootDSE = None):
         self.uri = uri
         self.conf = conf
         self.dit = dit
         self.auth_stack = auth_stack
+        self.budget = budget
+        if root_dse is None:
+            root_dse = RootDSE(dit)
+        self.root_dse = root_dse
         self.server = None
+        self.limiter = ConnectionLimiter(self.conf.get('max_connections'), self.conf.get('max_connections_per_ip'))
+
+        # set by prepare_workers()
+        self.reuse_port = None
+        self.unix_sock = None
+
+    def prepare_workers(self):
+        """Called before forking when the server will run multiple worker processes"""
+        scheme, netloc = parse_host_uri(self.uri)
+        if scheme == 'ldapi':
+            # unix sockets cannot be shared with SO_REUSEPORT, so bind once here and let each worker inherit it
+            try:
+                os.unlink(netloc)
+            except FileNotFoundError:
+                pass
+            self.unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.unix_sock.bind(netloc)
+        else:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise ConfigError('Multiple workers require SO_REUSEPORT which is not supported on this platform')
+            self.reuse_port = True
 
     async def run(self):
         scheme, netloc = parse_host_uri(self.uri)
         if scheme == 'ldap':
             host, port = host_port(netloc, default_port=389)
-            self.server = await asyncio.start_server(self.client, host=host, port=port)
+            self.server = await asyncio.start_server(self.client, host=host, port=port, reuse_port=self.reuse_port)
         elif scheme == 'ldaps':
             host, port = host_port(netloc, default_port=636)
             ctx = self._create_ssl_context()
-            self.server = await asyncio.start_server(self.client, host=host, port=port, ssl=ctx)
+            self.server = await asyncio.start_server(self.client, host=host, port=port, ssl=ctx,
+                                                     reuse_port=self.reuse_port)
         elif scheme == 'ldapi':
-            self.server = await asyncio.start_unix_server(self.client, path=netloc)
+            if self.unix_sock:
+                self.server = await asyncio.start_unix_server(self.client, sock=self.unix_sock)
+            else:
+                self.server = await asyncio.start_unix_server(self.client, path=netloc)
         else:
             raise ConfigError(f'Unsupported URI scheme {scheme}')
         async with self.server:
             await self.server.serve_forever()
 
     async def client(self, reader, writer):
-        await ClientHandler(reader, writer, self.dit, self.auth_stack).run()
+        peername = writer.get_extra_info('peername')
+        ip = peername[0] if isinstance(peername, tuple) else None
+        refusal = self.limiter.admit(ip)
+        if refusal:
+            logger.warning(f'{self.uri}: Refusing connection from {peername}: {refusal}')
+            writer.write(ber_encode(notice_of_disconnection('unavailable', refusal)))
+            writer.close()
+            return
+        try:
+            await ClientHandler(reader, writer, self.conf, self.dit, self.auth_stack, self.budget,
+                                self.root_dse).run()
+        finally:
+            self.limiter.release(ip)
+            writer.close()
 
     def _create_ssl_context(self):
         cert_filename = self.conf['certificate']
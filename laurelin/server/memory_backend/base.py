@@ -1,64 +1,264 @@
 """
-In-memory ephemeral LDAP backend store
+In-memory LDAP backend store, optionally persisted with a write-ahead log and snapshots
 """
+import asyncio
 import logging
+from functools import partial
+from time import perf_counter
+
+from laurelin.ldap import rfc4511
 from laurelin.ldap.constants import Scope, DerefAliases
-from laurelin.ldap.filter import parse as parse_filter
-from laurelin.ldap.protoutils import split_unescaped, seq_to_list
+from laurelin.ldap.filter import parse as parse_filter, rfc4511_filter_to_rfc4515_string
+from laurelin.ldap.modify import Mod
 
+from .compiled_filter import compile_filter
+from .index import IndexManager
 from .ldapobject import LDAPObject
+from .locks import LockTable
+from .mvcc import VersionManager
+from .persistence import Persistence
+from .planner import QueryPlan, plan_search
+from .scan_budget import ScanBudget
 from .. import search_results
+from ..attrsdict import AttrSelection
 from ..backend import DataBackend
-from ..dn import parse_rdn
+from ..dn import DN, leaf_rdn, parse_dn, parse_rdn
 from ..exceptions import *
-from ..utils import require_component, str_component
+from ..stats import get_stats
+from ..utils import str_component
 
 logger = logging.getLogger('laurelin.server.memory_backend')
 
 
 class MemoryBackend(DataBackend):
+    # every worker process holds its own copy of the data
+    MULTI_WORKER_MODES = ('read_only', 'independent')
+
+    DEFAULT_SCAN_SLICE_ENTRIES = 1000
+    DEFAULT_SCAN_SLICE_US = 2000
+
     def __init__(self, suffix, conf):
         DataBackend.__init__(self, suffix, conf)
         self._dit = LDAPObject(suffix)
+        # normalized DN -> object for every object in the backend, kept alongside the children dicts
+        self._objects = {self._dit.dn: self._dit}
+        self._versions = VersionManager()
+        self._locks = LockTable()
+        self.scan_slice_entries = self.conf.get('scan_slice_entries', MemoryBackend.DEFAULT_SCAN_SLICE_ENTRIES)
+        self.scan_slice_us = self.conf.get('scan_slice_us', MemoryBackend.DEFAULT_SCAN_SLICE_US)
+        self.lookthrough_limit = self.conf.get('lookthrough_limit')
+        self.indexes = IndexManager(self.conf.get('indexes'))
+        self.indexes.add(self._dit)
+
+        persistence_conf = self.conf.get('persistence')
+        if persistence_conf:
+            self._persistence = Persistence(suffix, persistence_conf)
+            self._persistence.load(self._snapshot_loader(), self._apply_record, self._dump_tree)
+        else:
+            self._persistence = None
+
+    def configure_workers(self):
+        DataBackend.configure_workers(self)
+        if self._persistence and not self.read_only:
+            raise ConfigError(f'DIT node {self.suffix} cannot use persistence with multi_worker: {self.multi_worker}')
+        if self.multi_worker == 'independent':
+            # workers are forked from the server process, which never sees their writes
+            logger.warning(f'DIT node {self.suffix} uses multi_worker: independent - writes are not shared between '
+                           f'workers, and a restarted worker goes back to the data loaded at startup')
+
+    def report(self):
+        return self.indexes.report() + [
+            f'memory backend {self.suffix}: version {self._versions.version}, '
+            f'{self._versions.retained} replaced states retained for running searches'
+        ]
+
+    def _dump_tree(self):
+        """
+        Start a snapshot of the tree as it is now
+
+        :returns: A coroutine producing a plain copy of the tree in pre-order: (parent_index, rdn, attrs) for each object
+        """
+        return self._dump_entries(self._versions.begin_read())
+
+    async def _dump_entries(self, read_version: int) -> list:
+        entries = []
+        positions = {}
+        budget = ScanBudget(self.scan_slice_entries, self.scan_slice_us)
+        try:
+            for obj in self._dit.subtree(read_version=read_version, budget=budget):
+                if obj is None:
+                    # slice used up, let connections have a turn
+                    budget.pause()
+                    await asyncio.sleep(0)
+                    budget.resume()
+                    continue
+                ver = obj.visible(read_version)
+                if obj is self._dit:
+                    parent_idx = None
+                    rdn = ver.dn_str
+                else:
+                    parent_idx = positions[id(ver.parent)]
+                    rdn = ver.dn_str[:-len(ver.parent.visible(read_version).dn_str) - 1]
+                positions[id(obj)] = len(entries)
+                entries.append((parent_idx, rdn, {attr: list(vals) for attr, vals in ver.attrs.items()}))
+        finally:
+            self._versions.end_read(read_version)
+            budget.finish()
+        return entries
+
+    def _snapshot_loader(self):
+        loaded = []
+
+        def load_entries(entries):
+            # snapshot data was validated when it was written
+            for parent_idx, rdn, attrs in entries:
+                if parent_idx is None:
+                    self.indexes.remove(self._dit)
+                    del self._objects[self._dit.dn]
+                    self._dit = obj = LDAPObject(rdn, attrs=attrs)
+                else:
+                    parent_obj = loaded[parent_idx]
+                    obj = LDAPObject(rdn, parent_obj.dn_str, attrs)
+                    parent_obj.add_child_ref(obj)
+                loaded.append(obj)
+                self._objects[obj.dn] = obj
+                self.indexes.add(obj)
+        return load_entries
+
+    def _apply_record(self, record: tuple):
+        op = record[0]
+        if op == 'add':
+            self._apply_add(*record[1:])
+        elif op == 'modify':
+            self._apply_modify(*record[1:])
+        elif op == 'mod_dn':
+            self._apply_mod_dn(*record[1:])
+        elif op == 'delete':
+            self._apply_delete(record[1])
+        else:
+            raise InternalError(f'Unknown write-ahead log record {op}')
 
     async def search_params(self, base_dn, scope, fil=None, attrs=None, deref_aliases=None, types_only=False,
                             limit=None, time_limit=None):
-        if limit is not None or time_limit is not None:
-            raise InternalError('MemoryBackend does not implement search limits')
+        deadline = None
+        if time_limit:
+            deadline = perf_counter() + time_limit
 
         if base_dn == '' and scope == Scope.BASE:
             raise InternalError('Root DSE search request was dispatched to backend')
 
-        if fil is not None:
+        if isinstance(fil, str):
+            # search() passes the already-parsed filter from the request
             fil = parse_filter(fil)
 
-        base_obj = self._dit.get(base_dn)
+        match = compile_filter(fil)
+        attrs = AttrSelection(attrs)
+        base_obj = self._get(base_dn)
         if deref_aliases == DerefAliases.BASE or deref_aliases == DerefAliases.ALWAYS:
             base_obj = self.deref_object(base_obj)
         if scope == Scope.BASE:
-            if base_obj.matches_filter(fil):
-                yield base_obj.to_result(attrs, types_only)
+            async with self._locks.read(base_obj.dn):
+                # a write to the entry may have completed while we waited
+                base_obj = self._get(base_obj.dn)
+                result = base_obj.to_result(attrs, types_only) if match(base_obj.attrs) else None
+            if result is not None:
+                yield result
             yield search_results.Done(base_obj.dn_str)
             return
-        elif scope == Scope.ONE:
-            result_gen = base_obj.onelevel(fil)
-        elif scope == Scope.SUB:
-            result_gen = base_obj.subtree(fil)
-        else:
+        elif scope not in (Scope.ONE, Scope.SUB):
             raise ValueError('scope')
 
-        deref_search = (deref_aliases == DerefAliases.SEARCH or deref_aliases == DerefAliases.ALWAYS)
-        for item in result_gen:
-            if deref_search:
-                item = self.deref_object(item)
-            yield item.to_result(attrs, types_only)
-        yield search_results.Done(base_obj.dn_str)
+        plan = self._plan(base_obj, scope, fil)
+        if fil is not None and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Search plan for {rfc4511_filter_to_rfc4515_string(fil)} under {base_obj.dn_str}: {plan}')
+        get_stats().incr('memory_backend_indexed_searches' if plan.uses_index else 'memory_backend_scan_searches')
+
+        # everything below reads the backend as of this version, regardless of writes while we are suspended
+        read_version = self._versions.begin_read()
+        # the lookthrough limit only applies to scans; index lookups only examine candidates
+        budget = ScanBudget(self.scan_slice_entries, self.scan_slice_us,
+                            None if plan.uses_index else self.lookthrough_limit)
+        done = search_results.Done(base_obj.dn_str)
+        sent = 0
+        try:
+            candidates = plan.candidates()
+            if candidates is not None:
+                result_gen = self._candidates_in_scope(base_obj, scope, match, list(candidates), read_version, budget)
+            elif scope == Scope.ONE:
+                result_gen = base_obj.onelevel(match, read_version, budget)
+            else:
+                result_gen = base_obj.subtree(match, read_version, budget)
+
+            deref_search = (deref_aliases == DerefAliases.SEARCH or deref_aliases == DerefAliases.ALWAYS)
+            lookthrough_reached = False
+            try:
+                for item in result_gen:
+                    if lookthrough_reached:
+                        # the scan went on to another entry, so the limit really was exceeded
+                        done = search_results.Done(base_obj.dn_str, rfc4511.ResultCode('adminLimitExceeded'),
+                                                   f'Lookthrough limit of {self.lookthrough_limit} entries '
+                                                   'exceeded, use a more specific filter or an indexed attribute')
+                        break
+                    if item is None:
+                        if budget.lookthrough_reached:
+                            # only an error if there is anything left to examine
+                            lookthrough_reached = True
+                            continue
+                        if deadline is not None and perf_counter() >= deadline:
+                            done = search_results.Done(base_obj.dn_str, rfc4511.ResultCode('timeLimitExceeded'),
+                                                       f'Time limit of {time_limit} seconds exceeded')
+                            break
+                        # slice used up, let other connections have a turn
+                        budget.pause()
+                        await asyncio.sleep(0)
+                        budget.resume()
+                        continue
+                    if limit and sent >= limit:
+                        # there is at least one more matching entry
+                        done = search_results.Done(base_obj.dn_str, rfc4511.ResultCode('sizeLimitExceeded'),
+                                                   f'Size limit of {limit} entries exceeded')
+                        break
+                    item = item.visible(read_version)
+                    if deref_search:
+                        item = self.deref_object(item)
+                    yield item.to_result(attrs, types_only)
+                    sent += 1
+            finally:
+                # abandoned/cancelled searches close this generator at its current yield
+                result_gen.close()
+        finally:
+            self._versions.end_read(read_version)
+            budget.finish()
+            stats = get_stats()
+            stats.incr('memory_backend_entries_examined', budget.examined)
+            stats.incr('memory_backend_scan_pauses', budget.pauses)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Search under {base_obj.dn_str} {budget}')
+        yield done
+
+    def _plan(self, base_obj, scope, fil) -> QueryPlan:
+        scope_size = None
+        if scope == Scope.ONE:
+            scope_size = len(base_obj.children) + 1
+        return plan_search(self.indexes, fil, scope_size)
+
+    def explain(self, base_dn: str, scope, fil: str) -> str:
+        """Describe how a one-level or subtree search would be performed"""
+        return str(self._plan(self._get(base_dn), scope, parse_filter(fil)))
 
-    def deref_object(self, obj: LDAPObject):
+    @staticmethod
+    def _candidates_in_scope(base_obj, scope, match, candidates: list, read_version: int, budget: ScanBudget):
+        for obj in candidates:
+            if obj.in_scope(base_obj, scope, read_version) and match(obj.visible(read_version).attrs):
+                yield obj
+            if budget.spent():
+                yield None
+
+    def deref_object(self, obj):
         try:
             while obj.attrs.get_attr('objectClass') == 'alias':
                 aliased_dn = obj.attrs['aliasedObjectName'][0]
-                obj = self._dit.get(aliased_dn)
+                obj = self._get(aliased_dn)
             return obj
         except (KeyError, IndexError):
             raise AliasError(f'Alias object {obj.dn_str} is missing an aliasedObjectName attribute')
@@ -66,46 +266,162 @@ class MemoryBackend(DataBackend):
             raise AliasError(f'Aliased object {aliased_dn} does not exist')
 
     async def compare_params(self, dn, attr_type, attr_value):
-        obj = self._dit.get(dn)
-        return attr_type in obj.attrs and attr_value in obj.attrs[attr_type]
-
-    async def modify(self, modify_request):
-        dn = require_component(modify_request, 'object', str)
-        changes = require_component(modify_request, 'changes')
-        obj = self._dit.get(dn)
-        for i in range(len(changes)):
-            change = changes.getComponentByPosition(i)
-            op = change.getComponentByName('operation')
-            mod = change.getComponentByName('modification')
-            attr_type = str(mod.getComponentByName('type'))
-            attr_vals = seq_to_list(mod.getComponentByName('vals'))
-            obj.modify_op(op, attr_type, attr_vals)
+        async with self._locks.read(parse_dn(dn)):
+            obj = self._get(dn)
+            return attr_type in obj.attrs and attr_value in obj.attrs[attr_type]
+
+    def _ancestors(self, dn) -> list:
+        """The DNs above dn and below the suffix, which writers to dn share the locks on"""
+        return [dn[i:] for i in range(1, len(dn) - len(self._dit.dn))]
+
+    async def _commit(self, record: tuple, apply):
+        """Make a staged write visible, once it is durable if persistence is enabled"""
+        if self._persistence:
+            await self._persistence.log(record, apply)
+        else:
+            apply()
 
     async def modify_params(self, dn, mod_list):
-        obj = self._dit.get(dn)
-        for op, attr_type, attr_vals in mod_list:
-            obj.modify_op(op, attr_type, attr_vals)
+        dn = parse_dn(dn)
+        async with self._locks.write(dn, shared=self._ancestors(dn)):
+            obj = self._get(dn)
+            new_attrs, object_class = obj.stage_modify(mod_list)
+            # log the resulting values rather than the request, so replaying does not need to validate again
+            attr_values = {attr_type: list(new_attrs.get(attr_type, ())) for op, attr_type, attr_vals in mod_list}
+            await self._commit(('modify', str(dn), attr_values),
+                               partial(self._replace_attrs, obj, new_attrs, object_class, list(attr_values)))
+
+    def _apply_modify(self, dn, attr_values: dict):
+        obj = self._get(dn)
+        new_attrs, object_class = obj.stage_modify([(Mod.REPLACE, attr_type, attr_vals)
+                                                    for attr_type, attr_vals in attr_values.items()], validate=False)
+        self._replace_attrs(obj, new_attrs, object_class, list(attr_values))
 
-    def _get_rdn_and_parent(self, dn):
-        rdn, parent_dn = split_unescaped(dn, ',', 1)
-        parent_obj = self._dit.get(parent_dn)
-        return parse_rdn(rdn), parent_obj
+    def _replace_attrs(self, obj, new_attrs, object_class, attr_types: list):
+        self.indexes.remove(obj, attr_types)
+        try:
+            old = obj.replace_attrs_state(new_attrs, object_class, self._versions.begin_write(),
+                                          self._versions.reading)
+        finally:
+            self.indexes.add(obj, attr_types)
+        self._retire_versions([(obj, old)])
+
+    def _retire_versions(self, replaced: list):
+        for obj, old in replaced:
+            if old is not None:
+                self._versions.retire(obj.begin, partial(obj.forget, old))
+
+    def _retire_child(self, parent_obj, obj):
+        """Keep obj reachable from its old parent for searches that started before it was deleted or moved"""
+        if self._versions.reading:
+            parent_obj.retain_former_child(obj)
+            self._versions.retire(obj.begin, partial(parent_obj.release_former_child, obj))
+
+    def _get(self, dn) -> LDAPObject:
+        dn = parse_dn(dn)
+        try:
+            return self._objects[dn]
+        except KeyError:
+            pass
+        # find the closest existing ancestor to report as the matched DN
+        for i in range(1, len(dn)):
+            matched = self._objects.get(dn[i:])
+            if matched is not None:
+                raise ObjectNotFound('No such object', matched.dn_str)
+        raise ObjectNotFound('No such object', '')
 
     async def add_params(self, dn, attrs):
-        rdn, parent_obj = self._get_rdn_and_parent(dn)
-        parent_obj.add_child(rdn, attrs)
+        parsed_dn = parse_dn(dn)
+        async with self._locks.write(parsed_dn, shared=self._ancestors(parsed_dn)):
+            parent_obj, obj = self._stage_add(dn, attrs)
+            await self._commit(('add', dn, {attr: list(vals) for attr, vals in attrs.items()}),
+                               partial(self._add_object, parent_obj, obj))
+
+    def _stage_add(self, dn, attrs, validate=True) -> tuple:
+        rdn = leaf_rdn(dn)
+        dn = parse_dn(dn)
+        parent_obj = self._get(dn[1:])
+        if dn[0] in parent_obj.children:
+            raise EntryAlreadyExistsError('Object already exists')
+        obj = LDAPObject(rdn, parent_obj.dn_str, attrs)
+        if validate:
+            obj.validate()
+        return parent_obj, obj
+
+    def _apply_add(self, dn, attrs):
+        self._add_object(*self._stage_add(dn, attrs, validate=False))
+
+    def _add_object(self, parent_obj, obj):
+        obj.begin = self._versions.begin_write()
+        parent_obj.add_child_ref(obj)
+        self._objects[obj.dn] = obj
+        self.indexes.add(obj)
 
     async def delete(self, delete_request):
         dn = str(delete_request)
-        rdn, parent_obj = self._get_rdn_and_parent(dn)
-        parent_obj.delete_child(rdn)
+        parsed_dn = parse_dn(dn)
+        async with self._locks.write(parsed_dn, shared=self._ancestors(parsed_dn)):
+            obj = self._stage_delete(dn)
+            await self._commit(('delete', dn), partial(self._delete_object, obj))
+
+    def _stage_delete(self, dn) -> LDAPObject:
+        obj = self._get(dn)
+        if obj is self._dit:
+            raise UnwillingToPerformError('Cannot delete the suffix object of a DIT node')
+        if obj.children:
+            raise LDAPError('Object is non-leaf, cannot delete')
+        return obj
+
+    def _apply_delete(self, dn):
+        self._delete_object(self._stage_delete(dn))
+
+    def _delete_object(self, obj):
+        parent_obj = obj.parent
+        parent_obj.delete_child(obj.rdn)
+        del self._objects[obj.dn]
+        self.indexes.remove(obj)
+        obj.update(self._versions.begin_write(), self._versions.reading, parent=None)
+        self._retire_child(parent_obj, obj)
 
     async def mod_dn_params(self, dn, new_rdn, del_old_rdn_attr, new_parent=None):
-        rdn, parent_obj = self._get_rdn_and_parent(dn)
+        old_dn = parse_dn(dn)
+        new_dn = DN(rdns=(parse_rdn(new_rdn),) + tuple(parse_dn(new_parent) if new_parent else old_dn[1:]))
+        async with self._locks.write(old_dn, new_dn, shared=self._ancestors(old_dn) + self._ancestors(new_dn)):
+            obj, new_parent_obj = self._stage_mod_dn(dn, new_rdn, new_parent)
+            await self._commit(('mod_dn', dn, new_rdn, del_old_rdn_attr, new_parent),
+                               partial(self._rename, obj, new_rdn, del_old_rdn_attr, new_parent_obj))
+
+    def _stage_mod_dn(self, dn, new_rdn, new_parent=None) -> tuple:
+        obj = self._get(dn)
+        if obj is self._dit:
+            raise UnwillingToPerformError('Cannot rename the suffix object of a DIT node')
         if new_parent:
-            new_parent_obj = self._dit.get(str(_new_parent))
-            obj = parent_obj.get_child(rdn)
-            parent_obj.del_child_ref(rdn)
-            new_parent_obj.add_child_ref(obj)
-            parent_obj = new_parent_obj
-        parent_obj.mod_rdn(rdn, new_rdn, del_old_rdn_attr)
+            new_parent_obj = self._get(new_parent)
+            if new_parent_obj is obj or new_parent_obj.in_scope(obj, Scope.SUB):
+                raise UnwillingToPerformError('Cannot move an object beneath itself')
+        else:
+            new_parent_obj = obj.parent
+        if new_parent_obj.children.get(parse_rdn(new_rdn), obj) is not obj:
+            raise EntryAlreadyExistsError('Object already exists')
+        return obj, new_parent_obj
+
+    def _apply_mod_dn(self, dn, new_rdn, del_old_rdn_attr, new_parent=None):
+        obj, new_parent_obj = self._stage_mod_dn(dn, new_rdn, new_parent)
+        self._rename(obj, new_rdn, del_old_rdn_attr, new_parent_obj)
+
+    def _rename(self, obj, new_rdn, del_old_rdn_attr, new_parent_obj):
+        old_parent_obj = obj.parent
+        subtree = [obj] + obj.descendants()
+        for moved in subtree:
+            del self._objects[moved.dn]
+        self.indexes.remove(obj)
+        try:
+            replaced = obj.rename(new_rdn, new_parent_obj, del_old_rdn_attr, self._versions.begin_write(),
+                                  self._versions.reading)
+        finally:
+            self.indexes.add(obj)
+            for moved in subtree:
+                self._objects[moved.dn] = moved
+        self._retire_versions(replaced)
+        if new_parent_obj is not old_parent_obj:
+            self._retire_child(old_parent_obj, obj)
@@ -0,0 +1,220 @@
+"""
+Compiles search filters into plain Python predicates
+
+The pyasn1 filter is walked once per search: attribute types and matching rules are resolved, assertion values are
+prepared and substring patterns are built up front. The resulting predicate takes an AttrsDict and only has to
+prepare the entry's own values.
+"""
+import re
+
+from ..attrvaluelist import APPROX_MATCH_FUZZ_MIN_RATIO, fuzz
+from ..exceptions import *
+from ..schema import get_schema
+
+
+def _match_all(attrs):
+    return True
+
+
+def _get_rule(attr: str, key: str):
+    """Resolve a matching rule, or return an LDAPError to raise if the attribute is actually encountered"""
+    schema = get_schema()
+    try:
+        rule = schema.get_attribute_type(attr)[key]
+    except KeyError:
+        return LDAPError(f'Attribute {attr} does not have a defined {key}')
+    try:
+        return schema.get_matching_rule(rule)
+    except UndefinedSchemaElementError:
+        return LDAPError(f'Attribute {attr} {key} is not defined')
+
+
+def _rule_error(attr: str, err: LDAPError):
+    # matches_filter only failed on entries that actually had the attribute, keep it that way
+    def predicate(attrs):
+        if attr in attrs:
+            raise err
+        return False
+    return predicate
+
+
+def _validate_assertion(rule, value: str):
+    if 'syntax' in rule:
+        get_schema().get_syntax_rule(rule['syntax']).validate(value)
+
+
+def _compile_equality(attr: str, value: str):
+    rule = _get_rule(attr, 'equality_rule')
+    if isinstance(rule, LDAPError):
+        return _rule_error(attr, rule)
+    _validate_assertion(rule, value)
+    prepare = rule.prepare
+    value = prepare(value)
+
+    def predicate(attrs):
+        vals = attrs.get(attr)
+        if vals is None:
+            return False
+        for val in vals:
+            if prepare(val) == value:
+                return True
+        return False
+    return predicate
+
+
+def _compile_ordering(attr: str, value: str, greater: bool):
+    rule = _get_rule(attr, 'ordering_rule')
+    if isinstance(rule, LDAPError):
+        return _rule_error(attr, rule)
+    _validate_assertion(rule, value)
+    prepare = rule.prepare
+    prepared = prepare(value)
+
+    if greater:
+        def predicate(attrs):
+            vals = attrs.get(attr)
+            if vals is None:
+                return False
+            for val in vals:
+                if not prepare(val) < prepared:
+                    return True
+            return False
+        return predicate
+
+    # lessOrEqual also matches values that are equal according to the equality rule
+    equal = _compile_equality(attr, value)
+
+    def predicate(attrs):
+        vals = attrs.get(attr)
+        if vals is None:
+            return False
+        for val in vals:
+            if prepare(val) < prepared:
+                return True
+        return equal(attrs)
+    return predicate
+
+
+def _compile_substrings(attr: str, substrings):
+    rule = _get_rule(attr, 'substrings_rule')
+    if isinstance(rule, LDAPError):
+        return _rule_error(attr, rule)
+    prepare = rule.prepare_substring
+
+    # same pattern construction as AttrValueList.match_substrings
+    sub_name = ''
+    sub_strs = []
+    if substrings.getComponentByPosition(0).getName() != 'initial':
+        sub_strs.append('')
+    for i in range(len(substrings)):
+        sub_obj = substrings.getComponentByPosition(i)
+        sub_name = sub_obj.getName()
+        sub_strs.append(re.escape(prepare(str(sub_obj.getComponent()))))
+    if sub_name != 'final' and sub_strs[-1] != '':
+        sub_strs.append('')
+    match = re.compile('^' + '.*?'.join(sub_strs) + '$').match
+
+    def predicate(attrs):
+        vals = attrs.get(attr)
+        if vals is None:
+            return False
+        for val in vals:
+            if match(prepare(val)):
+                return True
+        return False
+    return predicate
+
+
+def _compile_approx(attr: str, value: str):
+    rule = _get_rule(attr, 'equality_rule')
+    if isinstance(rule, LDAPError):
+        return _rule_error(attr, rule)
+    prepare = rule.prepare
+    value = prepare(value)
+
+    def predicate(attrs):
+        vals = attrs.get(attr)
+        if vals is None:
+            return False
+        for val in vals:
+            if fuzz.ratio(prepare(val), value) >= APPROX_MATCH_FUZZ_MIN_RATIO:
+                return True
+        return False
+    return predicate
+
+
+def _compile_present(attr: str):
+    if attr.lower() == 'objectclass':
+        return _match_all
+
+    def predicate(attrs):
+        return attr in attrs
+    return predicate
+
+
+def _compile_and(children: tuple):
+    def predicate(attrs):
+        for child in children:
+            if not child(attrs):
+                return False
+        return True
+    return predicate
+
+
+def _compile_or(children: tuple):
+    def predicate(attrs):
+        for child in children:
+            if child(attrs):
+                return True
+        return False
+    return predicate
+
+
+def _compile_not(child):
+    def predicate(attrs):
+        return not child(attrs)
+    return predicate
+
+
+def _ava(fil):
+    ava = fil.getComponent()
+    return str(ava.getComponentByName('attributeDesc')), str(ava.getComponentByName('assertionValue'))
+
+
+def compile_filter(fil):
+    """
+    Compile a parsed filter into a predicate
+
+    :param laurelin.ldap.rfc4511.Filter fil: The filter, or None to match everything
+    :returns: A function accepting an AttrsDict and returning whether it matches the filter
+    """
+    if fil is None:
+        return _match_all
+    filter_type = fil.getName()
+    if filter_type == 'and':
+        and_obj = fil.getComponent()
+        return _compile_and(tuple(compile_filter(and_obj.getComponentByPosition(i)) for i in range(len(and_obj))))
+    elif filter_type == 'or':
+        or_obj = fil.getComponent()
+        return _compile_or(tuple(compile_filter(or_obj.getComponentByPosition(i)) for i in range(len(or_obj))))
+    elif filter_type == 'not':
+        return _compile_not(compile_filter(fil.getComponent().getComponentByName('innerNotFilter')))
+    elif filter_type == 'equalityMatch':
+        return _compile_equality(*_ava(fil))
+    elif filter_type == 'substrings':
+        subs_obj = fil.getComponent()
+        return _compile_substrings(str(subs_obj.getComponentByName('type')),
+                                   subs_obj.getComponentByName('substrings'))
+    elif filter_type == 'greaterOrEqual':
+        return _compile_ordering(*_ava(fil), greater=True)
+    elif filter_type == 'lessOrEqual':
+        return _compile_ordering(*_ava(fil), greater=False)
+    elif filter_type == 'present':
+        return _compile_present(str(fil.getComponent()))
+    elif filter_type == 'approxMatch':
+        return _compile_approx(*_ava(fil))
+    elif filter_type == 'extensibleMatch':
+        # TODO extensibleMatch filter
+        raise LDAPError('Extensible match filters not yet implemented')
+    else:
+        raise LDAPError(f'Non-standard filter type "{filter_type}" is unhandled')
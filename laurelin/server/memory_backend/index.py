@@ -0,0 +1,304 @@
+"""
+Attribute indexes for the memory backend
+
+Indexes map attribute values to the set of LDAPObjects holding them. They are only used to narrow down the entries
+a search needs to look at; every candidate is still checked against the full filter.
+"""
+import logging
+import sys
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from time import perf_counter
+
+from ..exceptions import *
+from ..schema import get_schema
+
+logger = logging.getLogger('laurelin.server.memory_backend.index')
+
+
+def _get_rule(attr: str, key: str):
+    schema = get_schema()
+    try:
+        return schema.get_matching_rule(schema.get_attribute_type(attr)[key])
+    except (KeyError, UndefinedSchemaElementError):
+        raise ConfigError(f'Cannot index {attr}, it does not have a defined {key}')
+
+
+class EqualityIndex(object):
+    """Maps values prepared by the attribute's equality rule to the set of objects holding them"""
+
+    kind = 'equality'
+
+    def __init__(self, attr: str):
+        self.attr = attr
+        self.rule = _get_rule(attr, 'equality_rule')
+        self._values = defaultdict(set)
+
+    def _keys(self, obj):
+        return {self.rule.prepare(val) for val in obj.attrs.get_attr(self.attr)}
+
+    def add(self, obj):
+        for key in self._keys(obj):
+            self._values[key].add(obj)
+
+    def remove(self, obj):
+        for key in self._keys(obj):
+            objs = self._values.get(key)
+            if objs is None:
+                continue
+            objs.discard(obj)
+            if not objs:
+                del self._values[key]
+
+    def lookup(self, value) -> set:
+        return self._values.get(self.rule.prepare(value), set())
+
+    def estimate(self, value) -> int:
+        return len(self.lookup(value))
+
+    def report(self) -> str:
+        postings = sum(len(objs) for objs in self._values.values())
+        return f'{self.kind} index on {self.attr}: {len(self._values)} distinct values, {postings} entries'
+
+
+class ObjectClassIndex(EqualityIndex):
+    """Maps object class OIDs, as resolved by objectIdentifierMatch, to the set of objects of that class"""
+
+    kind = 'objectClass'
+
+    def __init__(self, attr: str = 'objectClass'):
+        EqualityIndex.__init__(self, attr)
+
+
+class PresenceIndex(object):
+    """The set of objects holding any value of the attribute"""
+
+    kind = 'presence'
+
+    def __init__(self, attr: str):
+        self.attr = attr
+        self.objects = set()
+
+    def add(self, obj):
+        if obj.attrs.get_attr(self.attr):
+            self.objects.add(obj)
+
+    def remove(self, obj):
+        self.objects.discard(obj)
+
+    def lookup(self) -> set:
+        return self.objects
+
+    def estimate(self) -> int:
+        return len(self.objects)
+
+    def report(self) -> str:
+        return f'{self.kind} index on {self.attr}: {len(self.objects)} entries'
+
+
+class SubstringIndex(object):
+    """
+    Maps trigrams of values prepared by the attribute's substrings rule to the set of objects holding them
+
+    Values are prepared without the padding spaces added by insignificant space handling, then wrapped in start and
+    end markers so that initial and final substrings can be narrowed down too.
+    """
+
+    kind = 'substrings'
+
+    GRAM_SIZE = 3
+    START = '\x02'
+    END = '\x03'
+
+    def __init__(self, attr: str):
+        self.attr = attr
+        self.rule = _get_rule(attr, 'substrings_rule')
+        self._grams = defaultdict(set)
+        self.build_seconds = 0.0
+
+    def _value_grams(self, value: str) -> set:
+        n = SubstringIndex.GRAM_SIZE
+        return {value[i:i + n] for i in range(len(value) - n + 1)}
+
+    def _keys(self, obj) -> set:
+        keys = set()
+        for val in obj.attrs.get_attr(self.attr):
+            keys |= self._value_grams(SubstringIndex.START + self.rule.prepare_substring(val) + SubstringIndex.END)
+        return keys
+
+    def add(self, obj):
+        start = perf_counter()
+        for gram in self._keys(obj):
+            self._grams[gram].add(obj)
+        self.build_seconds += perf_counter() - start
+
+    def remove(self, obj):
+        for gram in self._keys(obj):
+            objs = self._grams.get(gram)
+            if objs is None:
+                continue
+            objs.discard(obj)
+            if not objs:
+                del self._grams[gram]
+
+    def _assertion_grams(self, substrings) -> set:
+        grams = set()
+        for i in range(len(substrings)):
+            sub_obj = substrings.getComponentByPosition(i)
+            sub_str = self.rule.prepare_substring(str(sub_obj.getComponent()))
+            sub_name = sub_obj.getName()
+            if sub_name == 'initial':
+                sub_str = SubstringIndex.START + sub_str
+            elif sub_name == 'final':
+                sub_str = sub_str + SubstringIndex.END
+            grams |= self._value_grams(sub_str)
+        return grams
+
+    def usable(self, substrings) -> bool:
+        """Whether any component of the assertion is long enough to narrow the search"""
+        return bool(self._assertion_grams(substrings))
+
+    def lookup(self, substrings) -> set:
+        """Find a superset of the objects matching a Substrings protocol object"""
+        sets = sorted([self._grams.get(gram, set()) for gram in self._assertion_grams(substrings)], key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def estimate(self, substrings) -> int:
+        """Upper bound on the number of candidates: the size of the smallest trigram posting set"""
+        return min(len(self._grams.get(gram, ())) for gram in self._assertion_grams(substrings))
+
+    def memory_usage(self) -> int:
+        """Approximate size of the index structures in bytes, not counting the indexed objects"""
+        size = sys.getsizeof(self._grams)
+        for gram, objs in self._grams.items():
+            size += sys.getsizeof(gram) + sys.getsizeof(objs)
+        return size
+
+    def report(self) -> str:
+        return (f'{self.kind} index on {self.attr}: {len(self._grams)} trigrams, '
+                f'~{self.memory_usage() // 1024} KiB, {self.build_seconds:.3f}s spent indexing')
+
+
+class OrderingIndex(object):
+    """Keeps the distinct values prepared by the attribute's ordering rule sorted for range lookups"""
+
+    kind = 'ordering'
+
+    def __init__(self, attr: str):
+        self.attr = attr
+        self.rule = _get_rule(attr, 'ordering_rule')
+        self._sorted = []
+        self._values = {}
+        self._postings = 0
+
+    def _keys(self, obj):
+        return {self.rule.prepare(val) for val in obj.attrs.get_attr(self.attr)}
+
+    def add(self, obj):
+        for key in self._keys(obj):
+            objs = self._values.get(key)
+            if objs is None:
+                objs = self._values[key] = set()
+                insort(self._sorted, key)
+            if obj not in objs:
+                objs.add(obj)
+                self._postings += 1
+
+    def remove(self, obj):
+        for key in self._keys(obj):
+            objs = self._values.get(key)
+            if objs is None or obj not in objs:
+                continue
+            objs.remove(obj)
+            self._postings -= 1
+            if not objs:
+                del self._values[key]
+                del self._sorted[bisect_left(self._sorted, key)]
+
+    def _range(self, value, greater: bool) -> (int, int):
+        value = self.rule.prepare(value)
+        if greater:
+            return bisect_left(self._sorted, value), len(self._sorted)
+        else:
+            return 0, bisect_right(self._sorted, value)
+
+    def lookup(self, value, greater: bool) -> set:
+        """Objects with any value >= (greater) or <= the assertion value"""
+        start, end = self._range(value, greater)
+        ret = set()
+        for key in self._sorted[start:end]:
+            ret |= self._values[key]
+        return ret
+
+    def estimate(self, value, greater: bool) -> int:
+        """Number of distinct values in range times the average number of entries per value"""
+        if not self._sorted:
+            return 0
+        start, end = self._range(value, greater)
+        return (end - start) * self._postings // len(self._sorted)
+
+    def report(self) -> str:
+        return f'{self.kind} index on {self.attr}: {len(self._sorted)} distinct values, {self._postings} entries'
+
+
+_index_types = {
+    'equality': EqualityIndex,
+    'presence': PresenceIndex,
+    'substrings': SubstringIndex,
+    'ordering': OrderingIndex,
+}
+
+
+class IndexManager(object):
+    """Holds the configured indexes for one backend"""
+
+    def __init__(self, index_conf: dict = None):
+        # objectClass is always indexed; it is present on every entry so a presence index would be pointless
+        self._indexes = {'objectclass': {'equality': ObjectClassIndex()}}
+        for attr, types in (index_conf or {}).items():
+            if isinstance(types, str):
+                types = [types]
+            for index_type in types:
+                if attr.lower() == 'objectclass':
+                    continue
+                try:
+                    index_cls = _index_types[index_type]
+                except KeyError:
+                    raise ConfigError(f'Unknown index type {index_type} for attribute {attr}')
+                self._indexes.setdefault(attr.lower(), {})[index_type] = index_cls(attr)
+                logger.debug(f'Configured {index_type} index on {attr}')
+        self.entry_count = 0
+
+    def _all(self):
+        for attr_indexes in self._indexes.values():
+            yield from attr_indexes.values()
+
+    def get(self, attr: str, index_type: str):
+        """Obtain the index of the given type on attr, or None"""
+        try:
+            return self._indexes[attr.lower()][index_type]
+        except KeyError:
+            return None
+
+    def _affected(self, attrs):
+        if attrs is None:
+            return self._all()
+        return (index for attr in attrs for index in self._indexes.get(attr.lower(), {}).values())
+
+    def add(self, obj, attrs=None):
+        """Index obj, optionally only for the given attribute types"""
+        if attrs is None:
+            self.entry_count += 1
+        for index in self._affected(attrs):
+            index.add(obj)
+
+    def remove(self, obj, attrs=None):
+        """Remove obj from the indexes, optionally only for the given attribute types"""
+        if attrs is None:
+            self.entry_count -= 1
+        for index in self._affected(attrs):
+            index.remove(obj)
+
+    def report(self) -> list:
+        """Describe the cardinality, size and build cost of each index"""
+        return [index.report() for index in self._all()]
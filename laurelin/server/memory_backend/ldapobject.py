@@ -1,16 +1,25 @@
+from laurelin.ldap.constants import Scope
 from laurelin.ldap.modify import Mod
-from laurelin.ldap.protoutils import split_unescaped
 
-from ..attrsdict import AttrsDict
+from ..attrsdict import AttrsDict, AttrSelection
 
+from .compiled_filter import compile_filter
+from .mvcc import EntryVersion
 from .. import search_results
-from ..dn import parse_rdn, parse_dn
+from ..dn import DN, parse_rdn, split_rdn
 from ..exceptions import *
-from ..schema.object_class import ObjectClass
+from ..schema import get_schema
 
 
 class LDAPObject(object):
-    def __init__(self, rdn: str, parent_suffix=None, attrs=None):
+    """
+    An entry in the memory backend
+
+    The object itself holds the current state of the entry. State replaced by a write while searches were running is
+    kept as a chain of EntryVersions behind it; use visible() to read the entry as of a search's version.
+    """
+
+    def __init__(self, rdn: str, parent_suffix=None, attrs=None, begin=0):
         if isinstance(attrs, AttrsDict):
             pass
         elif attrs is None or isinstance(attrs, dict):
@@ -18,120 +27,144 @@ class LDAPObject(object):
         else:
             raise TypeError('attrs')
 
+        # the RDN as the client gave it, for the DN string and RDN attribute values
+        self.rdn_str = str(rdn)
+        # normalized RDN, the key in the parent's children
         self.rdn = parse_rdn(rdn)
         if parent_suffix:
             self.dn_str = f'{rdn},{parent_suffix}'
         else:
             self.dn_str = str(rdn)
+        # normalized DN, completed when the object is attached to its parent
+        self.dn = DN(rdns=(self.rdn,))
+
+        self.attrs = attrs
+        self._add_rdn_values()
+        self.parent = None
+        # the version this state was written at, and the state it replaced
+        self.begin = begin
+        self.prev = None
 
-        for rdn_attr, rdn_val in self.rdn:
-            if rdn_attr not in attrs:
-                attrs[rdn_attr] = [rdn_val]
-            elif rdn_val not in attrs[rdn_attr]:
-                attrs[rdn_attr].append(rdn_val)
+        self.object_class = self._merged_object_class(attrs)
 
+        self.children = {}
+        # children that left while searches that can still see them were running
+        self.former_children = None
+
+    @staticmethod
+    def _merged_object_class(attrs):
         try:
             oc_attr = attrs['objectClass']
-            self.object_class = ObjectClass({'name': 'virtualMergedObjectClass', 'desc': 'Combined object classes'})
-            for oc_name in oc_attr:
-                self.object_class.merge(oc_name)
         except KeyError:
-            self.object_class = None
+            return None
+        return get_schema().get_merged_object_class(oc_attr)
 
-        self.attrs = attrs
-        self.children = {}
+    def _add_rdn_values(self):
+        for rdn_attr, rdn_val in split_rdn(self.rdn_str):
+            if rdn_attr not in self.attrs:
+                self.attrs[rdn_attr] = [rdn_val]
+            elif rdn_val not in self.attrs[rdn_attr]:
+                self.attrs[rdn_attr].append(rdn_val)
 
     def to_result(self, attrs=None, types_only=False):
-        new_attrs = self.attrs.deepcopy(attrs, types_only)
-        return search_results.Entry(self.dn_str, new_attrs)
+        """
+        :param attrs: The requested attributes, ideally an AttrSelection prepared once per search
+        """
+        if not isinstance(attrs, AttrSelection):
+            attrs = AttrSelection(attrs)
+        return search_results.EntryView(self.dn_str, self.attrs, attrs, types_only)
+
+    def visible(self, read_version=None):
+        """
+        The state of this object as seen by a search
+
+        :param read_version: The version the search started at, or None for the current state
+        :returns: This object, an EntryVersion, or None if the object did not exist yet
+        """
+        ver = self
+        if read_version is not None:
+            while ver is not None and ver.begin > read_version:
+                ver = ver.prev
+        return ver
+
+    def update(self, begin: int, keep_history: bool, **changes) -> (EntryVersion, None):
+        """
+        Replace some of dn_str, attrs and parent as of version begin
+
+        :param keep_history: Keep the replaced state for searches that are still running
+        :returns: The EntryVersion holding the replaced state, to be forgotten once no search can see it
+        """
+        old = None
+        if keep_history:
+            old = self.prev = EntryVersion(self.dn_str, self.attrs, self.parent, self.begin, self.prev)
+        self.begin = begin
+        for field, value in changes.items():
+            setattr(self, field, value)
+        return old
+
+    def forget(self, old: EntryVersion):
+        """Drop a replaced state, along with anything older"""
+        ver = self
+        while ver.prev is not None:
+            if ver.prev is old:
+                ver.prev = None
+                return
+            ver = ver.prev
+
+    def retain_former_child(self, obj):
+        if self.former_children is None:
+            self.former_children = []
+        self.former_children.append(obj)
+
+    def release_former_child(self, obj):
+        self.former_children.remove(obj)
+        if not self.former_children:
+            self.former_children = None
+
+    def children_at(self, read_version=None) -> list:
+        """A copy of the children as seen by a search"""
+        if read_version is None:
+            return list(self.children.values())
+        children = []
+        for obj in self.children.values():
+            if obj.begin <= read_version:
+                # unchanged since the search started
+                children.append(obj)
+                continue
+            ver = obj.visible(read_version)
+            if ver is not None and ver.parent is self:
+                children.append(obj)
+        if self.former_children:
+            for obj in self.former_children:
+                if obj.parent is self:
+                    # it came back and is already in self.children
+                    continue
+                ver = obj.visible(read_version)
+                if ver is not None and ver.parent is self:
+                    children.append(obj)
+        return children
 
     def validate(self):
         if self.object_class:
             self.object_class.validate(self.attrs)
 
     def matches_filter(self, fil):
-        if fil is None:
-            return True
-        filter_type = fil.getName()
-        if filter_type == 'and':
-            and_obj = fil.getComponent()
-            for i in range(len(and_obj)):
-                if not self.matches_filter(and_obj.getComponentByPosition(i)):
-                    return False
-            return True
-        elif filter_type == 'or':
-            or_obj = fil.getComponent()
-            for i in range(len(or_obj)):
-                if self.matches_filter(or_obj.getComponentByPosition(i)):
-                    return True
-            return False
-        elif filter_type == 'not':
-            not_obj = fil.getComponent()
-            not_filter = not_obj.getComponentByName('innerNotFilter')
-            return not self.matches_filter(not_filter)
-        elif filter_type == 'equalityMatch':
-            ava = fil.getComponent()
-            attr = str(ava.getComponentByName('attributeDesc'))
-            value = str(ava.getComponentByName('assertionValue'))
-            return attr in self.attrs and self.attrs[attr] == value
-        elif filter_type == 'substrings':
-            subs_obj = fil.getComponent()
-            attr = str(subs_obj.getComponentByName('type'))
-            subs = subs_obj.getComponentByName('substrings')
-            return attr in self.attrs and self.attrs[attr].match_substrings(subs)
-        elif filter_type == 'greaterOrEqual':
-            ava = fil.getComponent()
-            attr = str(ava.getComponentByName('attributeDesc'))
-            value = str(ava.getComponentByName('assertionValue'))
-            return attr in self.attrs and self.attrs[attr] >= value
-        elif filter_type == 'lessOrEqual':
-            ava = fil.getComponent()
-            attr = str(ava.getComponentByName('attributeDesc'))
-            value = str(ava.getComponentByName('assertionValue'))
-            return attr in self.attrs and self.attrs[attr] <= value
-        elif filter_type == 'present':
-            present_obj = fil.getComponent()
-            attr = str(present_obj)
-            if attr.lower() == 'objectclass':
-                return True
-            return attr in self.attrs
-        elif filter_type == 'approxMatch':
-            ava = fil.getComponent()
-            attr = str(ava.getComponentByName('attributeDesc'))
-            value = str(ava.getComponentByName('assertionValue'))
-            return attr in self.attrs and self.attrs[attr].match_approx(value)
-        elif filter_type == 'extensibleMatch':
-            # TODO extensibleMatch filter
-            raise LDAPError('Extensible match filters not yet implemented')
-            #xm_obj = fil.getComponent()
-
-            #rule = ''
-            #rule_obj = xm_obj.getComponentByName('matchingRule')
-            #if rule_obj.isValue:
-            #    rule = ':' + str(rule_obj)
-
-            #attr = ''
-            #attr_obj = xm_obj.getComponentByName('type')
-            #if attr_obj.isValue:
-            #    attr = str(attr_obj)
-
-            #dn_attrs = ':dn' if bool(xm_obj.getComponentByName('dnAttributes')) else ''
-
-            #value = str(xm_obj.getComponentByName('matchValue'))
-
-            #ret = '({0}{1}{2}:={3})'.format(attr, dn_attrs, rule, value)
-        else:
-            raise LDAPError(f'Non-standard filter type "{filter_type}" is unhandled')
+        """Check a single object against a parsed filter; use compile_filter() when checking many"""
+        return compile_filter(fil)(self.attrs)
 
-    def add_child(self, rdn, attrs=None):
-        obj = LDAPObject(rdn, self.dn_str, attrs)
-        obj.validate()
+    def add_child(self, rdn, attrs=None, validate=True, begin=0):
+        obj = LDAPObject(rdn, self.dn_str, attrs, begin)
+        if validate:
+            obj.validate()
         self.add_child_ref(obj)
+        return obj
 
     def add_child_ref(self, obj):
         if obj.rdn in self.children:
             raise EntryAlreadyExistsError('Object already exists')
         self.children[obj.rdn] = obj
+        obj.parent = self
+        obj.dn = DN(rdns=(obj.rdn,) + tuple(self.dn))
 
     def delete_child(self, rdn):
         if not self.children[rdn].children:
@@ -140,37 +173,52 @@ class LDAPObject(object):
             raise LDAPError('Object is non-leaf, cannot delete')
 
     def del_child_ref(self, rdn):
-        del self.children[rdn]
+        return self.children.pop(rdn)
 
     def get_child(self, rdn):
         rdn = parse_rdn(rdn)
         try:
             return self.children[rdn]
         except KeyError:
-            raise LDAPError('No such object')
-
-    def get(self, dn):
-        dn = parse_dn(dn)
-        if len(dn) == 1 and dn[0] == self.rdn:
-            return self
-        elif dn[-1] == self.rdn:
-            dn = dn[0:-1]
-            next_obj = self.get_child(dn[-1])
-            return next_obj.get(dn)
-        else:
             raise ObjectNotFound('No such object', self.dn_str)
 
-    def mod_rdn(self, rdn, new_rdn, del_old_rdn_attr):
-        if rdn == new_rdn:
-            return
+    def descendants(self) -> list:
+        """All objects in the subtree below this one"""
+        descendants = self.subtree()
+        next(descendants)
+        return list(descendants)
+
+    def rename(self, new_rdn, new_parent, del_old_rdn_attr, begin=0, keep_history=False) -> list:
+        """
+        Give this object a new RDN and/or parent, updating the DNs of the whole subtree
+
+        :returns: (object, replaced EntryVersion) pairs for every object whose history was kept
+        """
+        new_rdn_str = str(new_rdn)
+        new_rdn = parse_rdn(new_rdn)
+        if new_parent.children.get(new_rdn, self) is not self:
+            raise EntryAlreadyExistsError('Object already exists')
 
-        obj = self.get_child(rdn)
-        self.del_child_ref(rdn)
-        self.children[new_rdn] = obj
+        old_rdn = self.rdn
+        old_rdn_str = self.rdn_str
+        self.parent.del_child_ref(old_rdn)
+        self.rdn = new_rdn
+        self.rdn_str = new_rdn_str
+        replaced = [(self, self.update(begin, keep_history, attrs=self.attrs.copy(), parent=new_parent,
+                                       dn_str=f'{new_rdn_str},{new_parent.dn_str}'))]
+        new_parent.add_child_ref(self)
 
         if del_old_rdn_attr:
-            rdn_attr, rdn_val = split_unescaped(rdn, '=')
-            self.delete_attr_value(rdn_attr, rdn_val)
+            for rdn_attr, rdn_val in split_rdn(old_rdn_str):
+                prepared = get_schema().get_attribute_type(rdn_attr).prepare_value(rdn_val)
+                if (rdn_attr.lower(), prepared) not in new_rdn:
+                    self.delete_attr_value(rdn_attr, rdn_val)
+        self._add_rdn_values()
+
+        for obj in self.descendants():
+            replaced.append((obj, obj.update(begin, keep_history, dn_str=f'{obj.rdn_str},{obj.parent.dn_str}')))
+            obj.dn = DN(rdns=(obj.rdn,) + tuple(obj.parent.dn))
+        return [(obj, old) for obj, old in replaced if old is not None]
 
     def delete_attr_value(self, attr, value):
         try:
@@ -182,6 +230,39 @@ class LDAPObject(object):
         except ValueError:
             pass
 
+    def modify(self, mod_list, begin=0, keep_history=False) -> (EntryVersion, None):
+        """
+        Apply all changes of a modify request atomically
+
+        If any change or the validation fails, the object is left untouched.
+        """
+        return self.replace_attrs_state(*self.stage_modify(mod_list), begin, keep_history)
+
+    def stage_modify(self, mod_list, validate=True) -> tuple:
+        """
+        Apply the changes of a modify request to a copy of the attributes and validate the result
+
+        :returns: The new attributes and merged object class, to be installed with replace_attrs_state()
+        """
+        old_attrs = self.attrs
+        self.attrs = old_attrs.copy()
+        try:
+            for op, attr_type, attr_vals in mod_list:
+                self.modify_op(op, attr_type, attr_vals)
+        finally:
+            new_attrs, self.attrs = self.attrs, old_attrs
+
+        object_class = self.object_class
+        if any(attr_type.lower() == 'objectclass' for op, attr_type, attr_vals in mod_list):
+            object_class = self._merged_object_class(new_attrs)
+        if validate and object_class:
+            object_class.validate(new_attrs)
+        return new_attrs, object_class
+
+    def replace_attrs_state(self, attrs, object_class, begin=0, keep_history=False) -> (EntryVersion, None):
+        self.object_class = object_class
+        return self.update(begin, keep_history, attrs=attrs)
+
     def modify_op(self, op, attr_type, attr_vals):
         if op == Mod.ADD:
             self.add_attrs(attr_type, attr_vals)
@@ -223,17 +304,51 @@ class LDAPObject(object):
         except KeyError:
             pass
 
-    def onelevel(self, filter=None):
-        if self.matches_filter(filter):
-            yield self
-        for obj in self.children.values():
-            if obj.matches_filter(filter):
+    def in_scope(self, base, scope, read_version=None):
+        """Check whether this object falls within a one-level or subtree search of base"""
+        if self is base:
+            return True
+        parent = self.visible(read_version).parent
+        if scope == Scope.ONE:
+            return parent is base
+        while parent is not None:
+            if parent is base:
+                return True
+            parent = parent.visible(read_version).parent
+        return False
+
+    def onelevel(self, match=None, read_version=None, budget=None):
+        """Yield this object and its children that satisfy a compiled filter predicate"""
+        if match is None:
+            match = compile_filter(None)
+        for obj in [self] + self.children_at(read_version):
+            if match(obj.visible(read_version).attrs):
                 yield obj
-
-    def subtree(self, filter=None):
-        if self.matches_filter(filter):
-            yield self
-        for child in self.children.values():
-            for obj in child.subtree():
-                if obj.matches_filter(filter):
-                    yield obj
+            if budget is not None and budget.spent():
+                yield None
+
+    def subtree(self, match=None, read_version=None, budget=None):
+        """
+        Yield this object and all descendants that satisfy a compiled filter predicate
+
+        Each object is visited and tested exactly once, in pre-order, and the traversal stops as soon as the generator
+        is closed. With a read_version, objects are matched and traversed as of that version. With a ScanBudget, None
+        is yielded whenever the budget for the current slice is spent.
+        """
+        if match is None:
+            match = compile_filter(None)
+        stack = [self]
+        while stack:
+            obj = stack.pop()
+            if read_version is None or obj.begin <= read_version:
+                attrs = obj.attrs
+            else:
+                attrs = obj.visible(read_version).attrs
+            if match(attrs):
+                yield obj
+            if budget is not None and budget.spent():
+                yield None
+            if obj.children or obj.former_children:
+                children = obj.children_at(read_version)
+                children.reverse()
+                stack.extend(children)
@@ -0,0 +1,168 @@
+"""
+Per-entry reader/writer locks for the memory backend
+
+Writes hold the entries they change exclusively until the write is complete, including waiting for it to be logged
+when persistence is enabled. They also share the locks on the ancestors of those entries, so an entry cannot be deleted
+or moved while a write below it is in progress. Reads of a single entry take a shared lock, so they never observe a
+write that has not completed yet and otherwise never wait for each other. Once a writer is waiting, new readers queue
+behind it so a steady stream of reads cannot hold off writes indefinitely; when that write completes, the readers that
+queued during it go before the next writer. One-level and subtree searches read a versioned snapshot instead and do not
+lock at all.
+
+Locks only exist while they are held or waited on.
+"""
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from time import perf_counter
+
+from ..stats import get_stats
+
+
+class RWLock(object):
+    """An asyncio lock shared by any number of readers, or held by one writer"""
+
+    def __init__(self):
+        self.readers = 0
+        self.writing = False
+        self._read_waiters = []
+        self._write_waiters = deque()
+
+    @property
+    def idle(self) -> bool:
+        return not (self.readers or self.writing or self._read_waiters or self._write_waiters)
+
+    async def acquire_read(self) -> bool:
+        """Acquire a shared lock, returning whether we had to wait for a writer"""
+        if not self.writing and not self._write_waiters:
+            self.readers += 1
+            return False
+        await self._wait(self._read_waiters, self.release_read)
+        return True
+
+    async def acquire_write(self) -> bool:
+        """Acquire the exclusive lock, returning whether we had to wait"""
+        if not self.writing and not self.readers:
+            self.writing = True
+            return False
+        await self._wait(self._write_waiters, self.release_write)
+        return True
+
+    async def _wait(self, waiters, release):
+        waiter = asyncio.get_event_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the lock was handed to us as we were cancelled
+                release()
+            else:
+                waiters.remove(waiter)
+                # readers may have been queued behind a writer that is no longer waiting
+                self._wake(readers_first=False)
+            raise
+
+    def release_read(self):
+        self.readers -= 1
+        if not self.readers:
+            self._wake(readers_first=False)
+
+    def release_write(self):
+        self.writing = False
+        self._wake(readers_first=True)
+
+    def _wake(self, readers_first: bool):
+        # readers waiting for a write to complete go next, otherwise they stay queued behind any waiting writer
+        if self.writing:
+            return
+        # waiters cancelled but not yet resumed are skipped; they remove themselves from the queues
+        if self._read_waiters and (readers_first or not self._write_waiters):
+            waiters, self._read_waiters = self._read_waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    self.readers += 1
+                    waiter.set_result(None)
+        elif self._write_waiters and not self.readers:
+            for waiter in self._write_waiters:
+                if not waiter.done():
+                    self.writing = True
+                    self._write_waiters.remove(waiter)
+                    waiter.set_result(None)
+                    break
+
+
+def _lock_order(dn) -> tuple:
+    # by normalized value, parents first; str(dn) may be the client's spelling
+    return tuple(tuple(sorted(rdn)) for rdn in reversed(dn))
+
+
+class LockTable(object):
+    """RWLocks keyed by normalized DN"""
+
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def _get(self, dn) -> RWLock:
+        try:
+            return self._locks[dn]
+        except KeyError:
+            lock = self._locks[dn] = RWLock()
+            return lock
+
+    @asynccontextmanager
+    async def read(self, dn):
+        lock = self._get(dn)
+        start = perf_counter()
+        waited = await lock.acquire_read()
+        if waited:
+            self._record_wait('read', start)
+        try:
+            yield
+        finally:
+            lock.release_read()
+            self._discard(dn, lock)
+
+    @asynccontextmanager
+    async def write(self, *dns, shared=()):
+        """
+        Exclusively lock one or more DNs, and share the locks on others such as their ancestors
+
+        Locks are always taken in the same order so that writers cannot deadlock.
+        """
+        exclusive = set(dns)
+        locked = []
+        try:
+            for dn in sorted(exclusive.union(shared), key=_lock_order):
+                lock = self._get(dn)
+                write = dn in exclusive
+                start = perf_counter()
+                try:
+                    waited = await (lock.acquire_write() if write else lock.acquire_read())
+                except BaseException:
+                    self._discard(dn, lock)
+                    raise
+                locked.append((dn, lock, write))
+                if waited:
+                    self._record_wait('write' if write else 'read', start)
+            yield
+        finally:
+            for dn, lock, write in locked:
+                if write:
+                    lock.release_write()
+                else:
+                    lock.release_read()
+                self._discard(dn, lock)
+
+    def _discard(self, dn, lock: RWLock):
+        if lock.idle and self._locks.get(dn) is lock:
+            del self._locks[dn]
+
+    @staticmethod
+    def _record_wait(kind: str, start: float):
+        stats = get_stats()
+        stats.incr(f'memory_backend_{kind}_lock_waits')
+        stats.incr(f'memory_backend_{kind}_lock_wait_us', int((perf_counter() - start) * 1000000))
@@ -0,0 +1,73 @@
+"""
+Multi-version concurrency control for the memory backend
+
+Every write gets a new version number. A write never changes data that a running search can see: while any search is
+active, the replaced state of an entry is kept as an EntryVersion chained behind the object, and deleted or moved
+objects stay reachable from their former parent. A search reads everything as of the version current when it started,
+and the old state is released once the last search that could see it finishes.
+"""
+from collections import Counter, deque
+
+from .. import search_results
+from ..attrsdict import AttrSelection
+
+
+class EntryVersion(object):
+    """The state of an LDAPObject before a write; never changed once created"""
+    __slots__ = ('dn_str', 'attrs', 'parent', 'begin', 'prev')
+
+    def __init__(self, dn_str: str, attrs, parent, begin: int, prev):
+        self.dn_str = dn_str
+        self.attrs = attrs
+        self.parent = parent
+        self.begin = begin
+        self.prev = prev
+
+    def to_result(self, attrs=None, types_only=False):
+        if not isinstance(attrs, AttrSelection):
+            attrs = AttrSelection(attrs)
+        return search_results.EntryView(self.dn_str, self.attrs, attrs, types_only)
+
+
+class VersionManager(object):
+    def __init__(self):
+        self.version = 0
+        self._readers = Counter()
+        # (version, callback) in version order
+        self._retired = deque()
+
+    @property
+    def reading(self) -> bool:
+        """Whether any search could still need the state replaced by a new write"""
+        return bool(self._readers)
+
+    @property
+    def retained(self) -> int:
+        return len(self._retired)
+
+    def begin_write(self) -> int:
+        self.version += 1
+        return self.version
+
+    def begin_read(self) -> int:
+        self._readers[self.version] += 1
+        return self.version
+
+    def end_read(self, read_version: int):
+        self._readers[read_version] -= 1
+        if not self._readers[read_version]:
+            del self._readers[read_version]
+            self._reclaim()
+
+    def retire(self, version: int, release):
+        """Call release once no search that started before version is running"""
+        if self._readers and min(self._readers) < version:
+            self._retired.append((version, release))
+        else:
+            release()
+
+    def _reclaim(self):
+        oldest = min(self._readers) if self._readers else None
+        while self._retired and (oldest is None or self._retired[0][0] <= oldest):
+            version, release = self._retired.popleft()
+            release()
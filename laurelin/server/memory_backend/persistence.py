@@ -0,0 +1,242 @@
+"""
+Snapshot and write-ahead log durability for the memory backend
+
+Every write is validated, then appended to a write-ahead log (WAL) as a numbered record, and only applied in memory
+once the record is durable. Writes that arrive close together share a single fsync (group commit). Once enough records
+have accumulated, a compact snapshot of the whole tree is written and the WAL files it covers are removed.
+
+On startup the newest snapshot is loaded and any later WAL records are replayed. Both contain only data that was
+already validated when it was first written, so it is not validated again.
+"""
+import asyncio
+import logging
+import os
+import pickle
+import struct
+import zlib
+from glob import glob
+from time import perf_counter
+
+from ..exceptions import *
+
+logger = logging.getLogger('laurelin.server.memory_backend.persistence')
+
+_SNAPSHOT_FORMAT = 1
+_RECORD_HEADER = struct.Struct('>II')  # length, crc32
+
+
+class Persistence(object):
+    DEFAULT_FSYNC = True
+    DEFAULT_GROUP_COMMIT_DELAY = 0.002
+    DEFAULT_SNAPSHOT_AFTER_RECORDS = 100000
+    SNAPSHOT_CHUNK_SIZE = 10000
+
+    def __init__(self, suffix: str, conf: dict):
+        self.suffix = suffix
+        try:
+            self.directory = conf['directory']
+        except KeyError:
+            raise ConfigError(f'persistence for DIT node {suffix} requires a directory')
+        self.fsync = conf.get('fsync', Persistence.DEFAULT_FSYNC)
+        self.group_commit_delay = conf.get('group_commit_delay', Persistence.DEFAULT_GROUP_COMMIT_DELAY)
+        self.snapshot_after_records = conf.get('snapshot_after_records', Persistence.DEFAULT_SNAPSHOT_AFTER_RECORDS)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._snapshot_fn = os.path.join(self.directory, 'snapshot')
+        self._next_seq = 1
+        self._wal = None
+        self._applied_seq = 0
+        self._pending = []
+        self._flush_task = None
+        self._failed = False
+        self._snapshot_task = None
+        self._records_since_snapshot = 0
+        self._dump_tree = None
+
+    # Loading
+
+    def load(self, load_entries, apply_record, dump_tree):
+        """
+        Restore state from disk
+
+        :param load_entries: Called with each chunk of snapshot entries, as produced by dump_tree
+        :param apply_record: Called with each WAL record newer than the snapshot
+        :param dump_tree: Called when writing a snapshot to start copying the current state; returns a coroutine
+                          producing a list of (parent_index, rdn, attrs) entries
+        """
+        self._dump_tree = dump_tree
+        start = perf_counter()
+        snapshot_seq = 0
+        num_entries = 0
+        try:
+            with open(self._snapshot_fn, 'rb') as f:
+                header = pickle.load(f)
+                if header.get('format') != _SNAPSHOT_FORMAT or header.get('suffix') != self.suffix:
+                    raise ConfigError(f'{self._snapshot_fn} is not a snapshot of {self.suffix}')
+                snapshot_seq = header['seq']
+                while num_entries < header['count']:
+                    chunk = pickle.load(f)
+                    load_entries(chunk)
+                    num_entries += len(chunk)
+            logger.info(f'Loaded {num_entries} entries for {self.suffix} from snapshot in '
+                        f'{perf_counter() - start:.2f}s')
+        except FileNotFoundError:
+            logger.info(f'No snapshot for {self.suffix} in {self.directory}')
+
+        start = perf_counter()
+        last_seq = snapshot_seq
+        replayed = 0
+        for wal_fn in self._wal_files():
+            for seq, record in self._read_wal(wal_fn):
+                if seq <= snapshot_seq:
+                    continue
+                apply_record(record)
+                last_seq = seq
+                replayed += 1
+        if replayed:
+            logger.info(f'Replayed {replayed} write-ahead log records for {self.suffix} in '
+                        f'{perf_counter() - start:.2f}s')
+
+        self._applied_seq = last_seq
+        self._next_seq = last_seq + 1
+        self._records_since_snapshot = replayed
+        self._open_wal()
+
+    def _wal_files(self) -> list:
+        return sorted(glob(os.path.join(self.directory, 'wal.*')))
+
+    def _read_wal(self, wal_fn):
+        with open(wal_fn, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos < len(data):
+            header_end = pos + _RECORD_HEADER.size
+            if header_end <= len(data):
+                length, crc = _RECORD_HEADER.unpack_from(data, pos)
+                payload = data[header_end:header_end + length]
+                if len(payload) == length and zlib.crc32(payload) == crc:
+                    yield pickle.loads(payload)
+                    pos = header_end + length
+                    continue
+            # a write was cut short by a crash; it was never acknowledged, so drop it
+            logger.warning(f'Truncating incomplete record at offset {pos} of {wal_fn}')
+            with open(wal_fn, 'r+b') as f:
+                f.truncate(pos)
+            return
+
+    def _open_wal(self):
+        if self._wal is not None:
+            self._wal.close()
+        self._wal = open(os.path.join(self.directory, f'wal.{self._applied_seq + 1:020d}'), 'ab')
+
+    # Writing
+
+    async def log(self, record: tuple, apply):
+        """
+        Append a record for a write that has been validated but not applied yet, returning once it is durable
+
+        :param apply: Called to apply the write in memory once its record is durable. Writes are applied in the order
+                      they were logged, and never if logging fails.
+        """
+        if self._failed:
+            raise InternalError(f'Write-ahead log for {self.suffix} is unavailable after an earlier failure')
+        seq = self._next_seq
+        self._next_seq += 1
+        payload = pickle.dumps((seq, record), pickle.HIGHEST_PROTOCOL)
+        waiter = asyncio.get_event_loop().create_future()
+        self._pending.append((seq, _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload, apply, waiter))
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush())
+        await asyncio.shield(waiter)
+
+    async def _flush(self):
+        # the only task writing to the WAL; it also switches to a new WAL file between batches, so the file can never
+        # be swapped out while a batch is being written and fsync()ed
+        try:
+            while self._pending:
+                # give concurrent writes a moment to join this commit
+                await asyncio.sleep(self.group_commit_delay)
+                pending, self._pending = self._pending, []
+                try:
+                    self._wal.write(b''.join(data for seq, data, apply, waiter in pending))
+                    self._wal.flush()
+                    if self.fsync:
+                        await asyncio.get_event_loop().run_in_executor(None, os.fsync, self._wal.fileno())
+                except OSError as e:
+                    # part of the batch may have reached the disk; anything appended after it could be lost behind
+                    # a torn record on the next startup, so stop accepting writes
+                    logger.exception(f'Failed to write the write-ahead log for {self.suffix}')
+                    self._failed = True
+                    pending += self._pending
+                    self._pending = []
+                    for seq, data, apply, waiter in pending:
+                        waiter.set_exception(InternalError(f'Write-ahead log failure: {e}'))
+                    return
+
+                for seq, data, apply, waiter in pending:
+                    try:
+                        apply()
+                    except Exception as e:
+                        # writers hold the locks the write was validated under, so this should never happen
+                        logger.exception(f'Failed to apply logged write {seq} for {self.suffix}')
+                        waiter.set_exception(e)
+                    else:
+                        waiter.set_result(None)
+                    self._applied_seq = seq
+
+                self._records_since_snapshot += len(pending)
+                if self._records_since_snapshot >= self.snapshot_after_records and self._snapshot_task is None:
+                    self._snapshot_task = asyncio.ensure_future(self._write_snapshot_files(*self._rotate()))
+        finally:
+            self._flush_task = None
+
+    def _rotate(self) -> tuple:
+        """Start a new WAL file for new records, returning what the snapshot of everything before it needs"""
+        # every record up to here has been applied in memory; records still pending will go to the new file
+        self._open_wal()
+        # with nothing applied since the last switch, the new file is the same as the current one
+        old_wal_files = [wal_fn for wal_fn in self._wal_files() if wal_fn != self._wal.name]
+        self._records_since_snapshot = 0
+        return self._applied_seq, self._dump_tree(), old_wal_files
+
+    async def snapshot(self):
+        """Write a snapshot of the current state and remove the WAL files it makes redundant"""
+        while self._snapshot_task is not None or self._flush_task is not None:
+            await asyncio.shield(self._snapshot_task or self._flush_task)
+        self._snapshot_task = asyncio.ensure_future(self._write_snapshot_files(*self._rotate()))
+        await asyncio.shield(self._snapshot_task)
+
+    async def _write_snapshot_files(self, seq: int, dump, old_wal_files: list):
+        try:
+            start = perf_counter()
+            entries = await dump
+            await asyncio.get_event_loop().run_in_executor(None, self._write_snapshot, seq, entries)
+            for wal_fn in old_wal_files:
+                os.unlink(wal_fn)
+            logger.info(f'Wrote snapshot of {len(entries)} entries for {self.suffix} in '
+                        f'{perf_counter() - start:.2f}s')
+        except OSError:
+            logger.exception(f'Failed to write snapshot for {self.suffix}')
+        finally:
+            self._snapshot_task = None
+
+    def _write_snapshot(self, seq: int, entries: list):
+        tmp_fn = self._snapshot_fn + '.tmp'
+        with open(tmp_fn, 'wb') as f:
+            header = {'format': _SNAPSHOT_FORMAT, 'suffix': self.suffix, 'seq': seq, 'count': len(entries)}
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            for i in range(0, len(entries), Persistence.SNAPSHOT_CHUNK_SIZE):
+                pickle.dump(entries[i:i + Persistence.SNAPSHOT_CHUNK_SIZE], f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fn, self._snapshot_fn)
+        if self.fsync:
+            # make the rename durable before the WAL files it replaces are removed
+            self._fsync_directory()
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,170 @@
+"""
+Cost-based search planning for the memory backend
+
+A plan decides which indexes to consult for a filter. Every candidate a plan produces is still checked against the
+full filter, so filter components that no index covers (NOT, unindexed attributes, etc.) are simply left to that
+residual check.
+"""
+from laurelin.ldap.filter import rfc4511_filter_to_rfc4515_string
+
+from .index import IndexManager
+
+
+class PlanNode(object):
+    """An index-backed step producing a superset of the matching objects"""
+
+    def __init__(self, estimate: int):
+        self.estimate = estimate
+
+    def candidates(self) -> set:
+        raise NotImplementedError()
+
+
+class IndexLookup(PlanNode):
+    def __init__(self, fil, index, *args):
+        PlanNode.__init__(self, index.estimate(*args))
+        self.fil = fil
+        self.index = index
+        self.args = args
+
+    def candidates(self) -> set:
+        return self.index.lookup(*self.args)
+
+    def __str__(self):
+        return f'{self.index.kind}{rfc4511_filter_to_rfc4515_string(self.fil)} ~{self.estimate}'
+
+
+class Intersection(PlanNode):
+    """Intersects the cheapest children; the rest are left to the residual filter check"""
+
+    # Children more than this many times larger than the smallest are not worth intersecting
+    MAX_SIZE_RATIO = 8
+
+    def __init__(self, children: list, skipped: int = 0):
+        children.sort(key=lambda node: node.estimate)
+        limit = max(children[0].estimate, 1) * Intersection.MAX_SIZE_RATIO
+        self.children = [node for node in children if node.estimate <= limit]
+        self.skipped = skipped + len(children) - len(self.children)
+        PlanNode.__init__(self, self.children[0].estimate)
+
+    def candidates(self) -> set:
+        ret = None
+        for node in self.children:
+            cands = node.candidates()
+            # never modify a set owned by an index
+            ret = set(cands) if ret is None else ret & cands
+            if not ret:
+                break
+        return ret
+
+    def __str__(self):
+        children = ' & '.join(str(node) for node in self.children)
+        residual = f' +{self.skipped} residual' if self.skipped else ''
+        return f'({children}){residual}'
+
+
+class Union(PlanNode):
+    def __init__(self, children: list):
+        self.children = children
+        PlanNode.__init__(self, sum(node.estimate for node in children))
+
+    def candidates(self) -> set:
+        ret = set()
+        for node in self.children:
+            ret |= node.candidates()
+        return ret
+
+    def __str__(self):
+        return '(' + ' | '.join(str(node) for node in self.children) + ')'
+
+
+class QueryPlan(object):
+    """The chosen strategy for one search filter"""
+
+    def __init__(self, root: (PlanNode, None), entry_count: int):
+        self.root = root
+        self.entry_count = entry_count
+
+    @property
+    def uses_index(self) -> bool:
+        # an index that will not narrow things down is more expensive than just walking the tree
+        return self.root is not None and self.root.estimate < self.entry_count
+
+    def candidates(self) -> (set, None):
+        """A set of objects to check against the filter, or None to scan the search scope"""
+        if not self.uses_index:
+            return None
+        return self.root.candidates()
+
+    def __str__(self):
+        if self.root is None:
+            return f'scan (no usable index, {self.entry_count} entries)'
+        elif not self.uses_index:
+            return f'scan (index {self.root} would not narrow {self.entry_count} entries)'
+        else:
+            return f'index {self.root} of {self.entry_count} entries'
+
+
+def _plan_node(indexes: IndexManager, fil) -> (PlanNode, None):
+    filter_type = fil.getName()
+    if filter_type == 'and':
+        and_obj = fil.getComponent()
+        children = []
+        for i in range(len(and_obj)):
+            node = _plan_node(indexes, and_obj.getComponentByPosition(i))
+            if node is not None:
+                children.append(node)
+        if not children:
+            return None
+        return Intersection(children, len(and_obj) - len(children))
+    elif filter_type == 'or':
+        or_obj = fil.getComponent()
+        children = []
+        for i in range(len(or_obj)):
+            node = _plan_node(indexes, or_obj.getComponentByPosition(i))
+            if node is None:
+                # one unindexed branch means any entry might match
+                return None
+            children.append(node)
+        return Union(children)
+    elif filter_type == 'equalityMatch':
+        ava = fil.getComponent()
+        index = indexes.get(str(ava.getComponentByName('attributeDesc')), 'equality')
+        if index is None:
+            return None
+        return IndexLookup(fil, index, str(ava.getComponentByName('assertionValue')))
+    elif filter_type == 'greaterOrEqual' or filter_type == 'lessOrEqual':
+        ava = fil.getComponent()
+        index = indexes.get(str(ava.getComponentByName('attributeDesc')), 'ordering')
+        if index is None:
+            return None
+        return IndexLookup(fil, index, str(ava.getComponentByName('assertionValue')), filter_type == 'greaterOrEqual')
+    elif filter_type == 'present':
+        index = indexes.get(str(fil.getComponent()), 'presence')
+        if index is None:
+            return None
+        return IndexLookup(fil, index)
+    elif filter_type == 'substrings':
+        subs_obj = fil.getComponent()
+        index = indexes.get(str(subs_obj.getComponentByName('type')), 'substrings')
+        subs = subs_obj.getComponentByName('substrings')
+        if index is None or not index.usable(subs):
+            return None
+        return IndexLookup(fil, index, subs)
+    else:
+        # not, approxMatch, extensibleMatch are only handled by the residual check
+        return None
+
+
+def plan_search(indexes: IndexManager, fil, scope_size: int = None) -> QueryPlan:
+    """
+    Build a plan for a parsed filter
+
+    :param scope_size: The number of entries a scan would visit, if known to be less than the whole backend
+    """
+    root = None
+    if fil is not None:
+        root = _plan_node(indexes, fil)
+    if scope_size is None:
+        scope_size = indexes.entry_count
+    return QueryPlan(root, scope_size)
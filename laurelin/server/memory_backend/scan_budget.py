@@ -0,0 +1,65 @@
+"""
+Cooperative time slicing for long memory backend scans
+
+Examining entries never awaits anything, so a scan that rarely matches would otherwise keep the event loop to itself
+until it finishes. Traversals check a ScanBudget for every entry they examine, and hand control back to the search
+so it can let other tasks run once the budget for the current slice is spent. An optional lookthrough limit also caps
+the total number of entries examined.
+"""
+from time import perf_counter
+
+
+class ScanBudget(object):
+    CLOCK_INTERVAL = 16
+
+    def __init__(self, max_entries: int, max_us: int, lookthrough_limit: int = None):
+        self.max_entries = max_entries
+        self.max_seconds = max_us / 1000000
+        self.lookthrough_limit = lookthrough_limit
+        self.examined = 0
+        self.pauses = 0
+        self.longest_slice = 0.0
+        self._slice_entries = 0
+        self._slice_limit = self._next_slice_limit()
+        self._slice_start = perf_counter()
+
+    def _next_slice_limit(self) -> int:
+        if self.lookthrough_limit is None:
+            return self.max_entries
+        # end the slice right at the lookthrough limit so it never has to be checked per entry
+        return max(min(self.max_entries, self.lookthrough_limit - self.examined), 1)
+
+    @property
+    def lookthrough_reached(self) -> bool:
+        return self.lookthrough_limit is not None and self.examined + self._slice_entries >= self.lookthrough_limit
+
+    def spent(self) -> bool:
+        """Count one examined entry and return whether the current slice is used up"""
+        self._slice_entries += 1
+        if self._slice_entries >= self._slice_limit:
+            return True
+        # reading the clock costs about as much as a cheap filter check, so only do it occasionally
+        if self._slice_entries % ScanBudget.CLOCK_INTERVAL:
+            return False
+        return perf_counter() - self._slice_start >= self.max_seconds
+
+    def pause(self):
+        """Note that control was given back to the event loop"""
+        self.pauses += 1
+        self._end_slice()
+
+    def resume(self):
+        self._slice_limit = self._next_slice_limit()
+        self._slice_start = perf_counter()
+
+    def finish(self):
+        self._end_slice()
+
+    def _end_slice(self):
+        self.longest_slice = max(self.longest_slice, perf_counter() - self._slice_start)
+        self.examined += self._slice_entries
+        self._slice_entries = 0
+
+    def __str__(self):
+        return (f'examined {self.examined} entries, paused {self.pauses} times, '
+                f'longest slice {self.longest_slice * 1000:.1f}ms')
@@ -0,0 +1,55 @@
+import asyncio
+
+
+class ResponseWriter(object):
+    """Coalesces encoded response PDUs into larger socket writes"""
+
+    def __init__(self, writer, high_water_mark: int, flush_delay: float = 0):
+        self.writer = writer
+        self.high_water_mark = high_water_mark
+        self.flush_delay = flush_delay
+        self._pending = []
+        self._pending_size = 0
+        self._drain_lock = asyncio.Lock()
+        self._flush_timer = None
+
+    async def send(self, pdu: bytes, flush=True):
+        """
+        Queue an encoded PDU for sending
+
+        :param flush: If False, only write out and drain once the high water mark has been passed, or once flush_delay
+                      seconds have gone by without that happening
+        """
+        # PDUs are only ever appended whole, so responses to concurrent operations cannot interleave mid-message
+        self._pending.append(pdu)
+        self._pending_size += len(pdu)
+        if flush or self._pending_size >= self.high_water_mark:
+            await self.flush()
+        elif self._flush_timer is None:
+            # with no delay this runs as soon as the operation gives up control, e.g. when a search scan pauses
+            self._flush_timer = asyncio.get_event_loop().call_later(self.flush_delay, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_timer = None
+        if self._pending:
+            asyncio.ensure_future(self._flush_quietly())
+
+    async def _flush_quietly(self):
+        try:
+            await self.flush()
+        except ConnectionError:
+            # the operation that queued the PDUs sees the same error on its next send
+            pass
+
+    async def flush(self):
+        """Write out all queued PDUs and wait for the transport to accept them"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._pending:
+            self.writer.write(b''.join(self._pending))
+            self._pending.clear()
+            self._pending_size = 0
+        # drain() must not be awaited concurrently
+        async with self._drain_lock:
+            await self.writer.drain()
@@ -0,0 +1,74 @@
+from laurelin.ldap import rfc4511
+
+from . import search_results
+from .ber import encode_message_op, encode_search_result_entry_op, encode_ldap_result_op
+from .dit import DIT
+from .exceptions import *
+
+
+class RootDSE(object):
+    """The Root DSE entry, built and encoded once and shared by every connection"""
+
+    def __init__(self, dit: DIT):
+        self.dit = dit
+        self.static_attrs = {
+            'supportedLDAPVersion': ['3'],
+            'vendorName': ['laurelin'],
+        }
+        self._entry = None
+        self._response_ops = None
+
+        # build immediately so that DIT config errors are raised at startup
+        self._build()
+
+    def invalidate(self):
+        """Must be called whenever the DIT or anything advertised in the Root DSE changes"""
+        self._entry = None
+        self._response_ops = None
+
+    def set_attr(self, attr: str, values: list):
+        """Advertise a static attribute, e.g. supportedControl or supportedExtension"""
+        self.static_attrs[attr] = list(values)
+        self.invalidate()
+
+    @property
+    def entry(self) -> search_results.Entry:
+        if self._entry is None:
+            self._build()
+        return self._entry
+
+    def encode(self, message_id: int) -> bytes:
+        """Obtain the complete encoded search response - the entry followed by the SearchResultDone"""
+        if self._response_ops is None:
+            self._build()
+        entry_op, done_op = self._response_ops
+        return encode_message_op(message_id, entry_op) + encode_message_op(message_id, done_op)
+
+    def _build(self):
+        nc = []
+        dnc = []
+        for dn, backend in self.dit.items():
+            nc.append(str(dn))
+            if backend.default:
+                if not dnc:
+                    dnc.append(str(dn))
+                else:
+                    raise ConfigError('Multiple DIT nodes marked as default')
+
+        if not dnc and len(nc) == 1:
+            dnc.append(nc[0])
+
+        if not nc:
+            raise ConfigError('No DIT nodes configured')
+
+        attrs = {
+            'namingContexts': nc,
+            'defaultNamingContext': dnc,
+        }
+        attrs.update(self.static_attrs)
+        self._entry = search_results.Entry('', attrs)
+        done = search_results.Done('')
+        self._response_ops = (
+            encode_search_result_entry_op(self._entry.dn, self._entry.attrs),
+            encode_ldap_result_op(rfc4511.SearchResultDone, done.result_code, done.matched_dn, done.message),
+        )
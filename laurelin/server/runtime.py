@@ -0,0 +1,55 @@
+"""
+Process-level runtime tuning: event loop implementation and garbage collector settings
+"""
+import asyncio
+import gc
+import logging
+
+from .config import Config
+from .exceptions import *
+
+logger = logging.getLogger('laurelin.server.runtime')
+
+EVENT_LOOPS = ('auto', 'asyncio', 'uvloop')
+
+
+def configure_event_loop(name: str = 'auto') -> str:
+    """
+    Install the event loop policy for the named loop implementation
+
+    :param name: One of EVENT_LOOPS. auto uses uvloop if it is installed, otherwise the standard library loop.
+    :returns: The name of the loop implementation that will be used
+    """
+    if name not in EVENT_LOOPS:
+        raise ConfigError(f'Unknown event_loop {name}, must be one of {", ".join(EVENT_LOOPS)}')
+    if name == 'asyncio':
+        asyncio.set_event_loop_policy(None)
+        return 'asyncio'
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            raise ConfigError('event_loop uvloop was requested but uvloop is not installed')
+        logger.debug('uvloop is not installed, using the standard library event loop')
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+
+def configure_gc(gc_conf: Config):
+    """Apply the `gc:` section of the config before the server starts"""
+    thresholds = gc_conf.get('thresholds')
+    if thresholds:
+        gc.set_threshold(*thresholds)
+        logger.info(f'Set garbage collection thresholds to {gc.get_threshold()}')
+    if gc_conf.get('disable', False):
+        gc.disable()
+        logger.info('Automatic garbage collection is disabled')
+
+
+def freeze_gc(gc_conf: Config):
+    """Optionally move everything allocated during startup out of future collections"""
+    if gc_conf.get('freeze_after_startup', False):
+        gc.collect()
+        gc.freeze()
+        logger.info(f'Froze {gc.get_freeze_count()} objects allocated during startup')
@@ -50,11 +50,14 @@ class Schema(object):
     def __init__(self):
         self._schema = defaultdict(CaseIgnoreDict)
         self._oids = {}
+        # frozenset of object class names -> MergedObjectClass
+        self._merged_object_classes = {}
         self.conf = Config()
 
     def clear(self):
         self._schema.clear()
         self._oids.clear()
+        self._merged_object_classes.clear()
 
     def load_builtin(self):
         # These shall be the only 4 hard coded schema elements to enable special-casing extensibleObject
@@ -125,6 +128,8 @@ class Schema(object):
         name = params.setdefault('name', name)
         params.setdefault('desc', name)
         element = schema_element(kind, params)
+        if kind == 'object_classes':
+            self._merged_object_classes.clear()
         self._schema[kind][name] = element
         try:
             self._oids[params['oid']] = element
@@ -134,6 +139,8 @@ class Schema(object):
 
     def resolve(self):
         """Resolve all inheritance"""
+        # merged classes may have been built before inheritance was resolved
+        self._merged_object_classes.clear()
         try:
             for kind in 'object_classes', 'attribute_types':
                 for obj in self._schema[kind].values():
@@ -165,10 +172,39 @@ class Schema(object):
             else:
                 raise
 
+    def resolve_oid(self, ident: str) -> str:
+        """
+        Get the numeric OID of a schema element from its descriptor, for objectIdentifierMatch
+
+        Numeric OIDs are returned unchanged, and descriptors of unknown or OID-less elements are lowercased.
+        """
+        if ident[:1].isdigit():
+            return ident
+        for kind in 'object_classes', 'attribute_types', 'matching_rules', 'syntax_rules':
+            element = self._schema[kind].get(ident)
+            if element is not None and 'oid' in element:
+                return element['oid']
+        return ident.lower()
+
     get_object_class = _element_getter('object_classes')
     get_matching_rule = _element_getter('matching_rules')
     get_syntax_rule = _element_getter('syntax_rules')
 
+    def get_merged_object_class(self, object_classes):
+        """
+        Get the shared combination of an entry's object classes
+
+        :param object_classes: Names or OIDs of the object classes
+        :rtype: laurelin.server.schema.object_class.MergedObjectClass
+        """
+        names = frozenset(self.get_object_class(oc)['name'] for oc in object_classes)
+        try:
+            return self._merged_object_classes[names]
+        except KeyError:
+            from .object_class import MergedObjectClass
+            merged = self._merged_object_classes[names] = MergedObjectClass(names)
+            return merged
+
 
 _schema = None
 
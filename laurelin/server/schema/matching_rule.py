@@ -5,6 +5,11 @@ from ..exceptions import *
 
 from laurelin.ldap import rfc4518
 
+
+def _resolve_oid(value):
+    return get_schema().resolve_oid(value)
+
+
 prep_routines = {
     'case_exact': (
         rfc4518.Transcode,
@@ -21,6 +26,7 @@ prep_routines = {
         rfc4518.Insignificant.space,
     ),
     'parse_dn': (parse_dn,),
+    'object_identifier': (_resolve_oid,),
     'none': (),
 }
 
@@ -49,6 +55,15 @@ class MatchingRule(BaseSchemaElement):
             value = prep_method(value)
         return PreparedString(value)
 
+    def prepare_substring(self, value):
+        """
+        Prepare an attribute value or a substring assertion component for substring matching
+
+        Insignificant space handling pads prepared values with a space at each end, which would stop components from
+        matching at the start or end of a value. Spaces at the ends of a component are insignificant too.
+        """
+        return PreparedString(self.prepare(value).strip(' '))
+
     def __call__(self, attribute_value, assertion_value):
         if 'syntax' in self:
             assertion_syntax = self.schema.get_syntax_rule(self['syntax'])
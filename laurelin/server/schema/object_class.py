@@ -55,6 +55,55 @@ class ObjectClass(BaseSchemaElement):
             attr_type.validate(values)
 
 
+class MergedObjectClass(ObjectClass):
+    """
+    The combination of all object classes of an entry
+
+    Instances are cached by the schema and shared between all entries with the same object classes, so everything
+    needed for validation is worked out once here.
+    """
+
+    def __init__(self, names: frozenset):
+        ObjectClass.__init__(self, {'name': 'virtualMergedObjectClass', 'desc': 'Combined object classes'})
+        self.names = names
+        self.extensible = False
+        for name in names:
+            if name == ExtensibleObjectClass.NAME:
+                self.extensible = True
+            else:
+                self.merge(name)
+        self.required_attrs = frozenset(self.required_attrs)
+        self.allowed_attrs = frozenset(self.allowed_attrs)
+        self.permitted_attrs = self.required_attrs | self.allowed_attrs
+        self._attr_types = {}
+
+    def validate(self, attrs: dict):
+        attr_types_set = {attr.lower() for attr in attrs.keys()}
+
+        missing_required = self.required_attrs - attr_types_set
+        if missing_required:
+            missing_required = ', '.join(missing_required)
+            raise SchemaValidationError(f'Missing required attributes: {missing_required}')
+
+        if not self.extensible:
+            not_allowed = attr_types_set - self.permitted_attrs
+            if not_allowed:
+                not_allowed = ', '.join(not_allowed)
+                raise SchemaValidationError(f'Attribute types are not allowed: {not_allowed}')
+
+        self.attr_type_validate(attrs)
+
+    def attr_type_validate(self, attrs: dict):
+        for attr, values in attrs.items():
+            try:
+                attr_type = self._attr_types[attr]
+            except KeyError:
+                attr_type = self._attr_types[attr] = self.schema.get_attribute_type(attr)
+            if self.extensible and attr_type['usage'] != 'userApplications':
+                raise SchemaValidationError('Non-user attribute on extensibleObject')
+            attr_type.validate(values)
+
+
 class ExtensibleObjectClass(ObjectClass):
     OID = '1.3.6.1.4.1.1466.101.120.111'
     NAME = 'extensibleObject'
@@ -1,6 +1,7 @@
 from laurelin.ldap import rfc4511
 
-from .attrsdict import AttrsDict
+from .attrsdict import AttrsDict, AttrSelection
+from .ber import encode_search_result_entry, encode_ldap_result
 
 
 class Entry(object):
@@ -12,13 +13,17 @@ class Entry(object):
             self.attrs = AttrsDict(attrs_dict)
         # TODO controls?
 
+    def items(self):
+        """The (attribute, values) pairs to send"""
+        return self.attrs.items()
+
     def to_proto(self):
         op = rfc4511.ProtocolOp()
         res = rfc4511.SearchResultEntry()
         res.setComponentByName('objectName', rfc4511.LDAPDN(self.dn))
         attrs = rfc4511.PartialAttributeList()
         j = 0
-        for attr, vals in self.attrs.items():
+        for attr, vals in self.items():
             if not vals:
                 continue
             _attr = rfc4511.PartialAttribute()
@@ -33,6 +38,34 @@ class Entry(object):
         op.setComponentByName('searchResEntry', res)
         return op
 
+    def to_ber(self, message_id: int) -> bytes:
+        """Encode a complete LDAPMessage with no controls, bypassing pyasn1"""
+        return encode_search_result_entry(message_id, self.dn, self.items())
+
+
+class EntryView(Entry):
+    """
+    A read-only search result over a stored entry's attributes
+
+    Only references to the selected values are taken, so building a result does not copy any attribute value lists
+    or touch the schema, and later modifications of the stored entry do not change the result.
+    """
+
+    def __init__(self, dn: str, attrs: AttrsDict, selection: AttrSelection, types_only: bool = False):
+        self.dn = dn
+        self._items = tuple((attr, () if types_only else tuple(vals))
+                            for attr, vals in attrs.items() if attr in selection)
+        self._attrs = None
+
+    def items(self):
+        return self._items
+
+    @property
+    def attrs(self) -> AttrsDict:
+        if self._attrs is None:
+            self._attrs = AttrsDict({attr: list(vals) for attr, vals in self._items})
+        return self._attrs
+
 
 class Done(object):
     def __init__(self, matched_dn, result_code=None, message=None):
@@ -54,3 +87,8 @@ class Done(object):
         srd.setComponentByName('diagnosticMessage', self.message)
         op.setComponentByName('searchResDone', srd)
         return op
+
+    def to_ber(self, message_id: int) -> bytes:
+        """Encode a complete LDAPMessage with no controls, bypassing pyasn1"""
+        return encode_ldap_result(message_id, rfc4511.SearchResultDone, self.result_code, self.matched_dn,
+                                  self.message)
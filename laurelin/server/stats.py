@@ -0,0 +1,34 @@
+"""
+Process-wide counters for operational visibility
+"""
+from collections import defaultdict
+
+
+class Stats(object):
+    def __init__(self):
+        self.counters = defaultdict(int)
+
+    def incr(self, name: str, amount=1):
+        self.counters[name] += amount
+
+    def get(self, name: str):
+        return self.counters.get(name, 0)
+
+    def snapshot(self) -> dict:
+        return dict(self.counters)
+
+    def format(self) -> str:
+        return ', '.join([f'{name}={value}' for name, value in sorted(self.counters.items())])
+
+    def clear(self):
+        self.counters.clear()
+
+
+_stats = None
+
+
+def get_stats() -> Stats:
+    global _stats
+    if not _stats:
+        _stats = Stats()
+    return _stats
@@ -0,0 +1,95 @@
+"""
+Pre-forked worker processes
+
+Each worker runs its own event loop with all configured listeners. TCP listeners are bound separately in every worker
+with SO_REUSEPORT so the kernel balances incoming connections; ldapi sockets are bound once before forking and
+inherited.
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger('laurelin.server.workers')
+
+
+class WorkerSupervisor(object):
+    DEFAULT_RESTART_DELAY = 1.0
+
+    def __init__(self, server, num_workers: int, debug=False):
+        """
+        :param laurelin.server.base.LaurelinServer server: The fully configured server to run in each worker
+        """
+        self.server = server
+        self.num_workers = num_workers
+        self.debug = debug
+        self.restart_delay = server.conf.get('worker_restart_delay', WorkerSupervisor.DEFAULT_RESTART_DELAY)
+        self.workers = {}  # pid -> worker number
+        self._stopping = False
+
+    def run(self):
+        """Fork all workers and supervise them until told to stop"""
+        for signum in signal.SIGTERM, signal.SIGINT:
+            signal.signal(signum, self._stop)
+
+        for i in range(self.num_workers):
+            self._spawn(i)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            try:
+                worker_num = self.workers.pop(pid)
+            except KeyError:
+                continue
+            if self._stopping:
+                logger.info(f'Worker {worker_num} (pid {pid}) has exited')
+            else:
+                logger.error(f'Worker {worker_num} (pid {pid}) died unexpectedly with status {status}, restarting')
+                time.sleep(self.restart_delay)
+                if not self._stopping:
+                    self._spawn(worker_num)
+        logger.info('All workers have exited')
+
+    def _stop(self, signum, frame):
+        if not self._stopping:
+            logger.info(f'Received signal {signum}, stopping workers')
+        self._stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self, worker_num: int):
+        pid = os.fork()
+        if pid:
+            logger.info(f'Started worker {worker_num} with pid {pid}')
+            self.workers[pid] = worker_num
+            return
+
+        # in the child
+        exit_code = 0
+        try:
+            for signum in signal.SIGTERM, signal.SIGINT:
+                signal.signal(signum, signal.SIG_DFL)
+            asyncio.run(self._run_worker(), debug=self.debug)
+        except KeyboardInterrupt:
+            pass
+        except BaseException as e:
+            logger.exception(f'Worker {worker_num} crashed: {e.__class__.__name__}: {e}')
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+
+    async def _run_worker(self):
+        task = asyncio.ensure_future(self.server.run())
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info(f'Worker pid {os.getpid()} shutting down')
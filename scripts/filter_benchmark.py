@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Compare per-entry filter interpretation against filters compiled once per search"""
+import argparse
+import time
+
+from laurelin.ldap.filter import parse
+
+from laurelin.server.memory_backend.compiled_filter import compile_filter
+from laurelin.server.memory_backend.ldapobject import LDAPObject
+from laurelin.server.schema import get_schema
+
+FILTERS = [
+    '(cn=user500)',
+    '(&(objectClass=person)(cn=user5*)(!(description=*)))',
+    '(|(sn=nope)(cn=*99*)(sn=last7))',
+]
+
+
+def build_objects(count):
+    objs = []
+    for i in range(count):
+        attrs = {'objectClass': ['top', 'person'], 'cn': [f'user{i}'], 'sn': [f'Last{i % 50}']}
+        if i % 3 == 0:
+            attrs['description'] = [f'description {i}']
+        objs.append(LDAPObject(f'cn=user{i}', 'o=bench', attrs))
+    return objs
+
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    schema = get_schema()
+    schema.load_builtin()
+    schema.resolve()
+
+    objs = build_objects(args.entries)
+    for filter_str in FILTERS:
+        fil = parse(filter_str)
+
+        def interpreted():
+            return [obj for obj in objs if obj.matches_filter(fil)]
+
+        def compiled():
+            match = compile_filter(fil)
+            return [obj for obj in objs if match(obj.attrs)]
+
+        if interpreted() != compiled():
+            raise RuntimeError(f'Results differ for {filter_str}')
+        t_interp = best_of(args.repeat, interpreted)
+        t_comp = best_of(args.repeat, compiled)
+        print(f'{filter_str}\n  per-entry: {t_interp * 1000:.1f}ms  compiled: {t_comp * 1000:.1f}ms  '
+              f'speedup: {t_interp / t_comp:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
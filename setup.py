@@ -35,5 +35,8 @@ setup(
     namespace_packages=['laurelin'],
     packages=find_packages(exclude=['tests', 'scripts', 'venv', 'modules']),
     install_requires=['laurelin-ldap', 'pyasn1', 'PyYAML', 'parsimonious', 'async_timeout', 'fuzzywuzzy'],
+    extras_require={
+        'uvloop': ['uvloop'],
+    },
     include_package_data=True,
 )
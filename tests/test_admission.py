@@ -0,0 +1,35 @@
+import unittest
+
+from laurelin.server.admission import ConnectionLimiter, OperationBudget
+from laurelin.server.stats import get_stats
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        get_stats().clear()
+
+    def test_connection_limiter(self):
+        limiter = ConnectionLimiter(max_connections=3, max_connections_per_ip=2)
+        self.assertIsNone(limiter.admit('10.0.0.1'))
+        self.assertIsNone(limiter.admit('10.0.0.1'))
+        self.assertIsNotNone(limiter.admit('10.0.0.1'))
+        self.assertIsNone(limiter.admit('10.0.0.2'))
+        self.assertIsNotNone(limiter.admit('10.0.0.3'))
+        limiter.release('10.0.0.1')
+        self.assertIsNone(limiter.admit(None))
+        self.assertEqual(get_stats().get('connections_shed_max_connections_per_ip'), 1)
+        self.assertEqual(get_stats().get('connections_shed_max_connections'), 1)
+        self.assertEqual(get_stats().get('connections_accepted'), 4)
+
+    def test_operation_budget(self):
+        budget = OperationBudget(2)
+        self.assertTrue(budget.try_acquire())
+        self.assertTrue(budget.try_acquire())
+        self.assertFalse(budget.try_acquire())
+        budget.release()
+        self.assertTrue(budget.try_acquire())
+        self.assertEqual(get_stats().get('operations_shed'), 1)
+
+        unlimited = OperationBudget()
+        for _ in range(100):
+            self.assertTrue(unlimited.try_acquire())
@@ -0,0 +1,102 @@
+import asyncio
+import unittest
+
+from laurelin.ldap import rfc4511
+from pyasn1.codec.ber.encoder import encode as ber_encode
+
+from laurelin.server import search_results
+from laurelin.server.ber import read_header, PDUReader, encode_ldap_result
+from laurelin.server.exceptions import DisconnectionProtocolError
+from laurelin.server.schema import get_schema
+
+
+def pack(message_id, op):
+    lm = rfc4511.LDAPMessage()
+    lm.setComponentByName('messageID', rfc4511.MessageID(message_id))
+    lm.setComponentByName('protocolOp', op)
+    return lm
+
+
+class TestBERFraming(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def test_read_header(self):
+        self.assertIsNone(read_header(b''))
+        self.assertIsNone(read_header(b'\x30'))
+        self.assertEqual(read_header(b'\x30\x05'), (2, 5))
+        self.assertIsNone(read_header(b'\x30\x82\x01'))
+        self.assertEqual(read_header(b'\x30\x82\x01\x00'), (4, 256))
+        self.assertEqual(read_header(b'\x1f\x81\x01\x03'), (4, 3))
+        with self.assertRaises(DisconnectionProtocolError):
+            read_header(b'\x30\x80')
+
+    def test_read_pdu(self):
+        small = b'\x30\x03\x02\x01\x01'
+        large = b'\x30\x82\x10\x00' + b'x' * 0x1000
+
+        async def run_test():
+            reader = asyncio.StreamReader()
+            pdus = PDUReader(reader, 1024 * 1024)
+            data = small + large + small
+            # feed in awkward chunks to split headers and bodies
+            for i in range(0, len(data), 7):
+                reader.feed_data(data[i:i + 7])
+            reader.feed_data(small[:2])
+            reader.feed_eof()
+
+            self.assertEqual(await pdus.read_pdu(), small)
+            self.assertEqual(await pdus.read_pdu(), large)
+            self.assertEqual(await pdus.read_pdu(), small)
+            self.assertIsNone(await pdus.read_pdu())
+
+        self.loop.run_until_complete(run_test())
+
+    def test_max_pdu_size(self):
+        async def run_test():
+            reader = asyncio.StreamReader()
+            pdus = PDUReader(reader, 100)
+            reader.feed_data(b'\x30\x82\x10\x00')
+            with self.assertRaises(DisconnectionProtocolError):
+                await pdus.read_pdu()
+
+        self.loop.run_until_complete(run_test())
+
+
+class TestBEREncoders(unittest.TestCase):
+    message_ids = (0, 1, 127, 128, 255, 256, 2 ** 31 - 1)
+
+    def __init__(self, *args, **kwds):
+        unittest.TestCase.__init__(self, *args, **kwds)
+        schema = get_schema()
+        schema.load_builtin()
+        schema.resolve()
+
+    def test_search_result_entry(self):
+        attrs_list = [
+            {},
+            {'cn': ['foo']},
+            {'cn': ['x' * 200, '\u00fc'], 'empty': [], 'description': ['y' * 70000]},
+        ]
+        for message_id in self.message_ids:
+            for attrs in attrs_list:
+                with self.subTest(message_id=message_id, attrs=list(attrs.keys())):
+                    entry = search_results.Entry('cn=t\u00e9st,o=foo', attrs)
+                    self.assertEqual(entry.to_ber(message_id), ber_encode(pack(message_id, entry.to_proto())))
+
+    def test_ldap_result(self):
+        for message_id in self.message_ids:
+            for result_code in ('success', 'noSuchObject', 'compareTrue', 'other'):
+                with self.subTest(message_id=message_id, result_code=result_code):
+                    done = search_results.Done('o=foo', rfc4511.ResultCode(result_code), 'm' * 300)
+                    self.assertEqual(done.to_ber(message_id), ber_encode(pack(message_id, done.to_proto())))
+
+                    res = rfc4511.ModifyResponse()
+                    res.setComponentByName('resultCode', rfc4511.ResultCode(result_code))
+                    res.setComponentByName('matchedDN', 'o=foo')
+                    res.setComponentByName('diagnosticMessage', '')
+                    op = rfc4511.ProtocolOp()
+                    op.setComponentByName('modifyResponse', res)
+                    self.assertEqual(encode_ldap_result(message_id, rfc4511.ModifyResponse, result_code, 'o=foo'),
+                                     ber_encode(pack(message_id, op)))
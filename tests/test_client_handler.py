@@ -0,0 +1,444 @@
+import asyncio
+import socket
+import unittest
+
+from laurelin.ldap import rfc4511
+from laurelin.ldap.constants import Scope
+from pyasn1.codec.ber.decoder import decode as ber_decode
+from pyasn1.codec.ber.encoder import encode as ber_encode
+
+from laurelin.server.ber import PDUReader
+from laurelin.server.client_handler import ClientHandler, pack, protocol_op
+from laurelin.server.config import Config
+from laurelin.server.dit import DIT
+from laurelin.server.schema import get_schema
+
+SUFFIX = 'o=test'
+
+
+def make_search_request(base_dn, scope, time_limit=0):
+    req = rfc4511.SearchRequest()
+    req.setComponentByName('baseObject', rfc4511.LDAPDN(base_dn))
+    req.setComponentByName('scope', scope)
+    req.setComponentByName('derefAliases', rfc4511.DerefAliases('neverDerefAliases'))
+    req.setComponentByName('sizeLimit', rfc4511.Integer0ToMax(0))
+    req.setComponentByName('timeLimit', rfc4511.Integer0ToMax(time_limit))
+    req.setComponentByName('typesOnly', rfc4511.TypesOnly(False))
+    fil = rfc4511.Filter()
+    fil.setComponentByName('present', rfc4511.Present('objectClass'))
+    req.setComponentByName('filter', fil)
+    req.setComponentByName('attributes', rfc4511.AttributeSelection())
+    return req
+
+
+def make_compare_request(dn, attr_type, attr_value):
+    ava = rfc4511.AttributeValueAssertion()
+    ava.setComponentByName('attributeDesc', rfc4511.AttributeDescription(attr_type))
+    ava.setComponentByName('assertionValue', rfc4511.AssertionValue(attr_value))
+    req = rfc4511.CompareRequest()
+    req.setComponentByName('entry', rfc4511.LDAPDN(dn))
+    req.setComponentByName('ava', ava)
+    return req
+
+
+def make_modify_request(dn, attr_type, attr_value):
+    vals = rfc4511.Vals()
+    vals.setComponentByPosition(0, rfc4511.AttributeValue(attr_value))
+    mod = rfc4511.PartialAttribute()
+    mod.setComponentByName('type', rfc4511.AttributeDescription(attr_type))
+    mod.setComponentByName('vals', vals)
+    change = rfc4511.Change()
+    change.setComponentByName('operation', rfc4511.Operation('replace'))
+    change.setComponentByName('modification', mod)
+    changes = rfc4511.Changes()
+    changes.setComponentByPosition(0, change)
+    req = rfc4511.ModifyRequest()
+    req.setComponentByName('object', rfc4511.LDAPDN(dn))
+    req.setComponentByName('changes', changes)
+    return req
+
+
+class Gate(object):
+    """Holds calls to a backend method until opened, recording whether they were cancelled while waiting"""
+
+    def __init__(self, backend, method: str):
+        self.opened = asyncio.Event()
+        self.waiting = 0
+        self.cancelled = 0
+        wrapped = getattr(backend, method)
+
+        async def gated(*args, **kwds):
+            self.waiting += 1
+            try:
+                await self.opened.wait()
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            return await wrapped(*args, **kwds)
+
+        setattr(backend, method, gated)
+
+    def open(self):
+        self.opened.set()
+
+
+class Client(object):
+    """The client end of a connection to a ClientHandler"""
+
+    def __init__(self, reader, writer):
+        self.writer = writer
+        self.pdus = PDUReader(reader, ClientHandler.DEFAULT_MAX_PDU_SIZE)
+
+    def send(self, message_id, op_name, obj):
+        self.writer.write(ber_encode(pack(message_id, protocol_op(op_name, obj))))
+
+    async def receive(self, wait=5):
+        """The next response as (message_id, operation name, operation), or None once the server hangs up"""
+        pdu = await asyncio.wait_for(self.pdus.read_pdu(), wait)
+        if pdu is None:
+            return None
+        lm, _ = ber_decode(pdu, asn1Spec=rfc4511.LDAPMessage())
+        op = lm.getComponentByName('protocolOp')
+        return int(lm.getComponentByName('messageID')), op.getName(), op.getComponent()
+
+    async def receive_all(self) -> list:
+        """All responses until the server hangs up"""
+        responses = []
+        while True:
+            res = await self.receive()
+            if res is None:
+                return responses
+            responses.append(res)
+
+
+def result_code(op) -> str:
+    code = op.getComponentByName('resultCode')
+    return code.namedValues.getName(int(code))
+
+
+async def until(condition, wait=5):
+    """Let other tasks run until condition() is true"""
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.001)
+    await asyncio.wait_for(poll(), wait)
+
+
+class TestClientHandler(unittest.TestCase):
+    def __init__(self, *args, **kwds):
+        unittest.TestCase.__init__(self, *args, **kwds)
+        schema = get_schema()
+        schema.load_builtin()
+        schema.resolve()
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            # hang up and let the handler finish
+            self.client.writer.close()
+            self.loop.run_until_complete(self.served)
+        self.loop.close()
+
+    async def connect(self, conf=None, backend_conf=None):
+        """Serve a new connection with a ClientHandler over a socket pair"""
+        node_conf = {'data_backend': 'memory'}
+        node_conf.update(backend_conf or {})
+        dit = DIT({SUFFIX: node_conf})
+        self.backend = dit.backend(SUFFIX)
+        for i in range(10):
+            await self.backend.add_params(f'cn=user{i},{SUFFIX}', {'cn': [f'user{i}']})
+
+        server_sock, client_sock = socket.socketpair()
+        reader, writer = await asyncio.open_connection(sock=server_sock)
+        self.handler = ClientHandler(reader, writer, Config(conf or {}), dit, auth_stack=None)
+
+        async def serve():
+            try:
+                await self.handler.run()
+            finally:
+                writer.close()
+
+        self.served = asyncio.ensure_future(serve())
+        self.client = Client(*await asyncio.open_connection(sock=client_sock))
+        return self.client
+
+    def test_dispatch_by_message_id(self):
+        async def run_test():
+            client = await self.connect()
+            gate = Gate(self.backend, 'compare_params')
+            client.send(3, 'compareRequest', make_compare_request(f'cn=user1,{SUFFIX}', 'cn', 'user1'))
+            client.send(4, 'compareRequest', make_compare_request(f'cn=user2,{SUFFIX}', 'cn', 'nope'))
+            client.send(5, 'searchRequest', make_search_request(f'cn=user3,{SUFFIX}', Scope.BASE))
+
+            # the search is answered while both compares are still in flight
+            self.assertEqual((await client.receive())[:2], (5, 'searchResEntry'))
+            self.assertEqual((await client.receive())[:2], (5, 'searchResDone'))
+            self.assertEqual(sorted(self.handler.operations), [3, 4])
+
+            gate.open()
+            results = {}
+            for _ in range(2):
+                message_id, op_name, op = await client.receive()
+                self.assertEqual(op_name, 'compareResponse')
+                results[message_id] = result_code(op)
+            self.assertEqual(results, {3: 'compareTrue', 4: 'compareFalse'})
+            self.assertEqual(self.handler.operations, {})
+
+        self.loop.run_until_complete(run_test())
+
+    def test_interleaved_responses(self):
+        async def run_test():
+            # search entries are written as they are found and the scan yields after every entry
+            client = await self.connect({'write_high_water_mark': 1}, {'scan_slice_entries': 1})
+            client.send(1, 'searchRequest', make_search_request(SUFFIX, Scope.SUB))
+            client.send(2, 'compareRequest', make_compare_request(f'cn=user1,{SUFFIX}', 'cn', 'user1'))
+
+            responses = [(await client.receive())[:2] for _ in range(13)]
+            search = [i for i, (message_id, op_name) in enumerate(responses) if message_id == 1]
+            compare = responses.index((2, 'compareResponse'))
+            self.assertEqual(len(search), 12)
+            self.assertEqual(responses[search[-1]], (1, 'searchResDone'))
+            self.assertLess(search[0], compare)
+            self.assertLess(compare, search[-1])
+
+        self.loop.run_until_complete(run_test())
+
+    def test_flush_at_scan_pause(self):
+        async def run_test():
+            # entries stay well under the high water mark, but are written out when the scan gives up control
+            client = await self.connect({}, {'scan_slice_entries': 1})
+            held = asyncio.Event()
+            sent = []
+            send_search_result = self.handler.send_search_result
+
+            async def hold_second_entry(req, result, controls=None):
+                sent.append(result)
+                if len(sent) == 2:
+                    await held.wait()
+                await send_search_result(req, result, controls)
+
+            self.handler.send_search_result = hold_second_entry
+            client.send(1, 'searchRequest', make_search_request(SUFFIX, Scope.SUB))
+            self.assertEqual((await client.receive())[:2], (1, 'searchResEntry'))
+            self.assertEqual(len(sent), 2)
+
+            held.set()
+            responses = [(await client.receive())[:2] for _ in range(11)]
+            self.assertEqual(responses[-1], (1, 'searchResDone'))
+
+        self.loop.run_until_complete(run_test())
+
+    def test_duplicate_message_id(self):
+        async def run_test():
+            client = await self.connect()
+            gate = Gate(self.backend, 'compare_params')
+            client.send(7, 'compareRequest', make_compare_request(f'cn=user1,{SUFFIX}', 'cn', 'user1'))
+            client.send(7, 'compareRequest', make_compare_request(f'cn=user2,{SUFFIX}', 'cn', 'user2'))
+
+            # the client is disconnected, and the first compare is cancelled rather than answered
+            responses = await client.receive_all()
+            self.assertEqual(len(responses), 1)
+            message_id, op_name, op = responses[0]
+            self.assertEqual((message_id, op_name), (0, 'extendedResp'))
+            self.assertEqual(result_code(op), 'protocolError')
+            await self.served
+            self.assertEqual(self.handler.operations, {})
+            gate.open()
+
+        self.loop.run_until_complete(run_test())
+
+    def test_outstanding_operation_limit(self):
+        async def run_test():
+            client = await self.connect({'max_outstanding_operations': 1})
+            gate = Gate(self.backend, 'compare_params')
+            client.send(1, 'compareRequest', make_compare_request(f'cn=user1,{SUFFIX}', 'cn', 'user1'))
+            client.send(2, 'searchRequest', make_search_request(f'cn=user3,{SUFFIX}', Scope.BASE))
+
+            # the search waits for the compare to free up the only slot
+            with self.assertRaises(asyncio.TimeoutError):
+                await client.receive(0.1)
+            self.assertEqual(list(self.handler.operations), [1])
+
+            gate.open()
+            self.assertEqual((await client.receive())[:2], (1, 'compareResponse'))
+            self.assertEqual((await client.receive())[:2], (2, 'searchResEntry'))
+            self.assertEqual((await client.receive())[:2], (2, 'searchResDone'))
+
+        self.loop.run_until_complete(run_test())
+
+    def test_abandon_search_and_compare(self):
+        async def run_test():
+            client = await self.connect()
+            search_gate = Gate(self.handler, 'send_search_result')
+            compare_gate = Gate(self.backend, 'compare_params')
+            client.send(1, 'searchRequest', make_search_request(SUFFIX, Scope.SUB))
+            client.send(2, 'compareRequest', make_compare_request(f'cn=user1,{SUFFIX}', 'cn', 'user1'))
+            await until(lambda: search_gate.waiting and compare_gate.waiting)
+
+            client.send(3, 'abandonRequest', rfc4511.AbandonRequest(1))
+            client.send(4, 'abandonRequest', rfc4511.AbandonRequest(2))
+            await until(lambda: not self.handler.operations)
+            self.assertEqual((search_gate.cancelled, compare_gate.cancelled), (1, 1))
+
+            # neither abandoned operation is answered, and the connection stays usable
+            search_gate.open()
+            compare_gate.open()
+            client.send(5, 'compareRequest', make_compare_request(f'cn=user2,{SUFFIX}', 'cn', 'user2'))
+            message_id, op_name, op = await client.receive()
+            self.assertEqual((message_id, op_name), (5, 'compareResponse'))
+            self.assertEqual(result_code(op), 'compareTrue')
+
+        self.loop.run_until_complete(run_test())
+
+    def test_abandon_declines_writes(self):
+        async def run_test():
+            client = await self.connect()
+            gate = Gate(self.backend, '_commit')
+            client.send(1, 'modifyRequest', make_modify_request(f'cn=user1,{SUFFIX}', 'description', 'changed'))
+            await until(lambda: gate.waiting)
+
+            client.send(2, 'abandonRequest', rfc4511.AbandonRequest(1))
+            with self.assertRaises(asyncio.TimeoutError):
+                await client.receive(0.1)
+            self.assertEqual(list(self.handler.operations), [1])
+
+            # the modify runs to completion and is answered as usual
+            gate.open()
+            message_id, op_name, op = await client.receive()
+            self.assertEqual((message_id, op_name), (1, 'modifyResponse'))
+            self.assertEqual(result_code(op), 'success')
+            self.assertEqual(gate.cancelled, 0)
+            self.assertIn('changed', self.backend._get(f'cn=user1,{SUFFIX}').attrs['description'])
+
+        self.loop.run_until_complete(run_test())
+
+    def _test_hang_up(self, hang_up):
+        async def run_test():
+            client = await self.connect()
+            compare_gate = Gate(self.backend, 'compare_params')
+            write_gate = Gate(self.backend, '_commit')
+            client.send(1, 'compareRequest', make_compare_request(f'cn=user1,{SUFFIX}', 'cn', 'user1'))
+            client.send(2, 'modifyRequest', make_modify_request(f'cn=user2,{SUFFIX}', 'description', 'changed'))
+            await until(lambda: compare_gate.waiting and write_gate.waiting)
+
+            hang_up(client)
+            # the compare is cancelled straight away, but the handler waits for the modify
+            await until(lambda: compare_gate.cancelled)
+            await asyncio.sleep(0.1)
+            self.assertFalse(self.served.done())
+            self.assertEqual(list(self.handler.operations), [2])
+
+            write_gate.open()
+            await self.served
+            self.assertEqual(write_gate.cancelled, 0)
+            self.assertEqual(self.handler.operations, {})
+            self.assertIn('changed', self.backend._get(f'cn=user2,{SUFFIX}').attrs['description'])
+            return await client.receive_all()
+
+        return self.loop.run_until_complete(run_test())
+
+    def test_unbind_cancels_reads_and_awaits_writes(self):
+        def unbind(client):
+            client.send(3, 'unbindRequest', rfc4511.UnbindRequest(''))
+
+        responses = self._test_hang_up(unbind)
+        self.assertEqual([r[:2] for r in responses], [(2, 'modifyResponse')])
+        self.assertEqual(result_code(responses[0][2]), 'success')
+
+    def test_disconnect_cancels_reads_and_awaits_writes(self):
+        def disconnect(client):
+            client.writer.write_eof()
+
+        self._test_hang_up(disconnect)
+
+    def assert_notice_of_disconnection(self, response, result):
+        message_id, op_name, op = response
+        self.assertEqual((message_id, op_name), (0, 'extendedResp'))
+        self.assertEqual(result_code(op), result)
+
+    def test_idle_timeout(self):
+        async def run_test():
+            client = await self.connect({'idle_timeout': 0.1})
+            responses = await client.receive_all()
+            self.assertEqual(len(responses), 1)
+            self.assert_notice_of_disconnection(responses[0], 'unavailable')
+            await self.served
+
+        self.loop.run_until_complete(run_test())
+
+    def test_not_idle_with_operations_in_flight(self):
+        async def run_test():
+            client = await self.connect({'idle_timeout': 0.1})
+            gate = Gate(self.backend, 'compare_params')
+            client.send(1, 'compareRequest', make_compare_request(f'cn=user1,{SUFFIX}', 'cn', 'user1'))
+            await asyncio.sleep(0.3)
+            self.assertFalse(self.served.done())
+
+            # once the compare is answered the connection goes idle
+            gate.open()
+            responses = await client.receive_all()
+            self.assertEqual([r[:2] for r in responses], [(1, 'compareResponse'), (0, 'extendedResp')])
+            self.assert_notice_of_disconnection(responses[1], 'unavailable')
+
+        self.loop.run_until_complete(run_test())
+
+    def test_max_connection_lifetime(self):
+        async def run_test():
+            client = await self.connect({'max_connection_lifetime': 0.2})
+            gate = Gate(self.backend, 'compare_params')
+            client.send(1, 'compareRequest', make_compare_request(f'cn=user1,{SUFFIX}', 'cn', 'user1'))
+            await asyncio.sleep(0.3)
+            # the notice waits for the in-flight compare
+            self.assertFalse(self.served.done())
+
+            gate.open()
+            responses = await client.receive_all()
+            self.assertEqual([r[:2] for r in responses], [(1, 'compareResponse'), (0, 'extendedResp')])
+            self.assertEqual(result_code(responses[0][2]), 'compareTrue')
+            self.assert_notice_of_disconnection(responses[1], 'unavailable')
+
+        self.loop.run_until_complete(run_test())
+
+    def test_compare_time_limit(self):
+        async def run_test():
+            client = await self.connect({'operation_time_limit': 0.1})
+            gate = Gate(self.backend, 'compare_params')
+            client.send(1, 'compareRequest', make_compare_request(f'cn=user1,{SUFFIX}', 'cn', 'user1'))
+            message_id, op_name, op = await client.receive()
+            self.assertEqual((message_id, op_name), (1, 'compareResponse'))
+            self.assertEqual(result_code(op), 'timeLimitExceeded')
+            self.assertEqual(gate.cancelled, 1)
+
+        self.loop.run_until_complete(run_test())
+
+    def test_search_time_limit(self):
+        async def run_test():
+            client = await self.connect({'operation_time_limit': 0.1})
+            gate = Gate(self.handler, 'send_search_result')
+            # the server limit applies both to unlimited searches and to those asking for longer
+            for message_id, time_limit in ((1, 0), (2, 3600)):
+                with self.subTest(time_limit=time_limit):
+                    client.send(message_id, 'searchRequest', make_search_request(SUFFIX, Scope.SUB, time_limit))
+                    response = await client.receive(1)
+                    self.assertEqual(response[:2], (message_id, 'searchResDone'))
+                    self.assertEqual(result_code(response[2]), 'timeLimitExceeded')
+            self.assertEqual(gate.cancelled, 2)
+
+        self.loop.run_until_complete(run_test())
+
+    def test_search_client_time_limit(self):
+        async def run_test():
+            # a shorter client timeLimit is honoured under the server limit
+            client = await self.connect({'operation_time_limit': 60})
+            gate = Gate(self.handler, 'send_search_result')
+            client.send(1, 'searchRequest', make_search_request(SUFFIX, Scope.SUB, 1))
+            response = await client.receive(5)
+            self.assertEqual(response[:2], (1, 'searchResDone'))
+            self.assertEqual(result_code(response[2]), 'timeLimitExceeded')
+            self.assertEqual(gate.cancelled, 1)
+
+        self.loop.run_until_complete(run_test())
@@ -0,0 +1,37 @@
+import os
+import unittest
+
+from laurelin.server.__main__ import main, parse_args
+from laurelin.server.runtime import EVENT_LOOPS
+
+
+class TestArgs(unittest.TestCase):
+    def setUp(self):
+        self.env_config = os.environ.pop('LAURELIN_SERVER_CONFIG', None)
+
+    def tearDown(self):
+        os.environ.pop('LAURELIN_SERVER_CONFIG', None)
+        if self.env_config is not None:
+            os.environ['LAURELIN_SERVER_CONFIG'] = self.env_config
+
+    def test_parse_args(self):
+        args = parse_args(['server.yaml', '--event-loop', 'uvloop', '--debug'])
+        self.assertEqual((args.config, args.event_loop, args.debug), ('server.yaml', 'uvloop', True))
+
+        # unset options defer to the config file
+        args = parse_args([])
+        self.assertEqual((args.config, args.event_loop, args.debug), (None, None, None))
+
+        os.environ['LAURELIN_SERVER_CONFIG'] = 'env.yaml'
+        self.assertEqual(parse_args([]).config, 'env.yaml')
+        self.assertEqual(parse_args(['server.yaml']).config, 'server.yaml')
+
+        for loop_name in EVENT_LOOPS:
+            self.assertEqual(parse_args(['--event-loop', loop_name]).event_loop, loop_name)
+        with self.assertRaises(SystemExit):
+            parse_args(['--event-loop', 'trio'])
+
+    def test_no_config(self):
+        with self.assertRaises(SystemExit) as cm:
+            main([])
+        self.assertEqual(cm.exception.code, 1)
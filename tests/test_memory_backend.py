@@ -1,14 +1,23 @@
 import asyncio
+import os
+import pickle
 import random
+import tempfile
 import unittest
 
 from laurelin.ldap import rfc4511
 from laurelin.ldap.constants import Scope
 from laurelin.ldap.filter import parse
+from laurelin.ldap.modify import Mod
 
+from laurelin.server.attrsdict import AttrSelection
+from laurelin.server.exceptions import (EntryAlreadyExistsError, InternalError, LDAPError, ObjectNotFound,
+                                        SchemaValidationError, UnwillingToPerformError)
 from laurelin.server.memory_backend import MemoryBackend
 from laurelin.server.memory_backend.ldapobject import LDAPObject
+from laurelin.server.memory_backend.locks import RWLock
 from laurelin.server.schema import get_schema
+from laurelin.server.stats import get_stats
 
 
 def make_search_request(base_dn, scope, filter=None, limit=None):
@@ -131,13 +140,12 @@ class TestMemoryBackend(unittest.TestCase):
                 s = await asynclist(mb.search(make_search_request(dn, Scope.SUB)))
                 self.assertEqual(len(s), expected_count)
 
-            # TODO limits now only handled by LDAPServer not backends
-            #with self.subTest('subtree with limit'):
-            #    limit = 17
-            #    rdn0 = random.choice(rdns)
-            #    dn = ','.join((rdn0, suffix))
-            #    s = await asynclist(mb.search(make_search_request(dn, Scope.SUB, limit=limit)))
-            #    self.assertEqual(len(s), limit + 1)  # include search done
+            with self.subTest('subtree with limit'):
+                limit = 17
+                rdn0 = random.choice(rdns)
+                dn = ','.join((rdn0, suffix))
+                s = await asynclist(mb.search(make_search_request(dn, Scope.SUB, limit=limit)))
+                self.assertEqual(len(s), limit + 1)  # include search done
 
             expected_objects = 10
             expected_count = expected_objects + 1  # include search done
@@ -149,3 +157,732 @@ class TestMemoryBackend(unittest.TestCase):
                 self.assertEqual(len(s), expected_count)
 
         self.loop.run_until_complete(run_test())
+
+    def test_search_abandon(self):
+        async def run_test():
+            suffix = 'cn=test'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory'})
+            for i in range(10):
+                await mb.add(make_add_request(f'cn=child{i},{suffix}'))
+
+            results = mb.search(make_search_request(suffix, Scope.SUB))
+            first = await results.__anext__()
+            self.assertEqual(first.dn, suffix)
+            await results.aclose()
+            with self.assertRaises(StopAsyncIteration):
+                await results.__anext__()
+
+        self.loop.run_until_complete(run_test())
+
+    def test_indexed_search(self):
+        async def run_test():
+            suffix = 'o=test'
+            plain = MemoryBackend(suffix, {'data_backend': 'memory'})
+            indexed = MemoryBackend(suffix, {'data_backend': 'memory', 'indexes': {'cn': ['equality']}})
+
+            async def search_dns(mb, base, scope, fil):
+                results = await asynclist(mb.search(make_search_request(base, scope, fil)))
+                return sorted(res.dn for res in results[:-1])
+
+            for mb in plain, indexed:
+                for ou in 'a', 'b':
+                    await mb.add_params(f'ou={ou},{suffix}', {'ou': [ou]})
+                    for i in range(5):
+                        await mb.add_params(f'cn=user{i},ou={ou},{suffix}', {'cn': [f'user{i}', f'Alias{i % 2}']})
+
+            filters = [
+                '(cn=user1)',
+                '(cn=ALIAS1)',
+                '(&(cn=alias0)(cn=user2))',
+                '(|(cn=user1)(cn=user3))',
+                '(&(cn=alias0)(!(cn=user0)))',
+                '(cn=nope)',
+            ]
+            for base, scope in (suffix, Scope.SUB), (f'ou=a,{suffix}', Scope.SUB), (f'ou=b,{suffix}', Scope.ONE):
+                for fil in filters:
+                    with self.subTest(base=base, scope=scope, filter=fil):
+                        self.assertEqual(await search_dns(indexed, base, scope, fil),
+                                         await search_dns(plain, base, scope, fil))
+
+            for mb in plain, indexed:
+                await mb.modify_params(f'cn=user1,ou=a,{suffix}', [(Mod.REPLACE, 'cn', ['user1', 'renamed'])])
+                await mb.delete(rfc4511.DelRequest(f'cn=user3,ou=b,{suffix}'))
+            for fil in '(cn=renamed)', '(cn=alias1)', '(cn=user3)':
+                with self.subTest('after modify and delete', filter=fil):
+                    self.assertEqual(await search_dns(indexed, suffix, Scope.SUB, fil),
+                                     await search_dns(plain, suffix, Scope.SUB, fil))
+            self.assertEqual(await search_dns(indexed, suffix, Scope.SUB, '(cn=renamed)'), [f'cn=user1,ou=a,{suffix}'])
+
+        self.loop.run_until_complete(run_test())
+
+    def test_object_class_presence_index(self):
+        async def run_test():
+            suffix = 'o=test'
+            plain = MemoryBackend(suffix, {'data_backend': 'memory'})
+            indexed = MemoryBackend(suffix, {'data_backend': 'memory', 'indexes': {'description': ['presence']}})
+
+            async def search_dns(mb, fil):
+                results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, fil)))
+                return sorted(res.dn for res in results[:-1])
+
+            for mb in plain, indexed:
+                await mb.add_params(f'ou=people,{suffix}', {'objectClass': ['organizationalUnit'], 'ou': ['people']})
+                for i in range(6):
+                    # object classes may be given by OID as well as by name
+                    attrs = {'objectClass': ['2.5.6.6' if i == 5 else 'person'], 'cn': [f'user{i}'], 'sn': ['user']}
+                    if i % 3 == 0:
+                        attrs['description'] = ['has a description']
+                    await mb.add_params(f'cn=user{i},ou=people,{suffix}', attrs)
+
+            filters = [
+                '(objectClass=person)',
+                '(objectClass=PERSON)',
+                '(objectClass=organizationalUnit)',
+                '(objectClass=2.5.6.6)',
+                '(objectClass=2.5.6.5)',
+                '(description=*)',
+                '(&(objectClass=person)(description=*))',
+                '(|(objectClass=organizationalUnit)(description=*))',
+            ]
+            for fil in filters:
+                with self.subTest(filter=fil):
+                    self.assertEqual(await search_dns(indexed, fil), await search_dns(plain, fil))
+            self.assertEqual(len(await search_dns(indexed, '(&(objectClass=person)(description=*))')), 2)
+            for mb in plain, indexed:
+                self.assertEqual(len(await search_dns(mb, '(objectClass=2.5.6.6)')), 6)
+                self.assertEqual(len(await search_dns(mb, '(objectClass=person)')), 6)
+                self.assertEqual(await search_dns(mb, '(objectClass=2.5.6.5)'), [f'ou=people,{suffix}'])
+
+            for mb in plain, indexed:
+                await mb.modify_params(f'cn=user1,ou=people,{suffix}', [(Mod.ADD, 'description', ['new'])])
+                await mb.modify_params(f'cn=user0,ou=people,{suffix}', [(Mod.DELETE, 'description', [])])
+            for fil in '(description=*)', '(&(objectClass=person)(description=*))':
+                with self.subTest('after modify', filter=fil):
+                    self.assertEqual(await search_dns(indexed, fil), await search_dns(plain, fil))
+
+        self.loop.run_until_complete(run_test())
+
+    def test_substrings_index(self):
+        async def run_test():
+            suffix = 'o=test'
+            plain = MemoryBackend(suffix, {'data_backend': 'memory'})
+            indexed = MemoryBackend(suffix, {'data_backend': 'memory', 'indexes': {'cn': ['substrings']}})
+
+            async def search_dns(mb, fil):
+                results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, fil)))
+                return sorted(res.dn for res in results[:-1])
+
+            names = ['Smith', 'Smithers', 'Blacksmith', 'Goldsmith', 'Jones', 'Jo', 'Smy', 'John  Smith ']
+            for mb in plain, indexed:
+                for name in names:
+                    await mb.add_params(f'cn={name},{suffix}', {'cn': [name]})
+
+            # spaces inside values and assertions are insignificant in the same way, and not at all at the ends
+            expected = {
+                '(cn=*smi*)': ['Blacksmith', 'Goldsmith', 'John  Smith ', 'Smith', 'Smithers'],
+                '(cn=smi*)': ['Smith', 'Smithers'],
+                '(cn=*smith)': ['Blacksmith', 'Goldsmith', 'John  Smith ', 'Smith'],
+                '(cn=sm*th*)': ['Smith', 'Smithers'],
+                '(cn=*ol*mi*)': ['Goldsmith'],
+                '(cn=jo*)': ['Jo', 'John  Smith ', 'Jones'],
+                '(cn=*o*)': ['Goldsmith', 'Jo', 'John  Smith ', 'Jones'],
+                '(cn=*n s*)': ['John  Smith '],
+                '(cn=* smith)': ['Blacksmith', 'Goldsmith', 'John  Smith ', 'Smith'],
+                '(cn=*nope*)': [],
+            }
+            for fil, expected_names in expected.items():
+                with self.subTest(filter=fil):
+                    expected_dns = sorted(f'cn={name},{suffix}' for name in expected_names)
+                    self.assertEqual(await search_dns(plain, fil), expected_dns)
+                    self.assertEqual(await search_dns(indexed, fil), expected_dns)
+
+            for mb in plain, indexed:
+                await mb.modify_params(f'cn=Jones,{suffix}', [(Mod.ADD, 'cn', ['Jonesmith'])])
+            self.assertEqual(await search_dns(indexed, '(cn=*esmi*)'), [f'cn=Jones,{suffix}'])
+
+            report = [line for line in indexed.report() if line.startswith('substrings')]
+            self.assertEqual(len(report), 1)
+            self.assertIn('substrings index on cn', report[0])
+
+        self.loop.run_until_complete(run_test())
+
+    def test_ordering_index(self):
+        async def run_test():
+            suffix = 'o=test'
+            plain = MemoryBackend(suffix, {'data_backend': 'memory'})
+            indexed = MemoryBackend(suffix, {'data_backend': 'memory', 'indexes': {'dnQualifier': ['ordering']}})
+
+            async def search_dns(mb, fil):
+                results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, fil)))
+                return sorted(res.dn for res in results[:-1])
+
+            for mb in plain, indexed:
+                for i, val in enumerate(['a', 'c', 'e', 'g', 'i']):
+                    await mb.add_params(f'cn=obj{i},{suffix}', {'dnQualifier': [val]})
+                await mb.add_params(f'cn=multi,{suffix}', {'dnQualifier': ['b', 'h']})
+
+            filters = [
+                '(dnQualifier>=e)',
+                '(dnQualifier>=f)',
+                '(dnQualifier<=c)',
+                '(dnQualifier<=a)',
+                '(dnQualifier>=z)',
+                '(&(dnQualifier>=c)(dnQualifier<=g))',
+            ]
+            for fil in filters:
+                with self.subTest(filter=fil):
+                    self.assertEqual(await search_dns(indexed, fil), await search_dns(plain, fil))
+            self.assertEqual(len(await search_dns(indexed, '(dnQualifier>=h)')), 2)
+
+            for mb in plain, indexed:
+                await mb.modify_params(f'cn=obj0,{suffix}', [(Mod.REPLACE, 'dnQualifier', ['y'])])
+            with self.subTest('after modify'):
+                self.assertEqual(await search_dns(indexed, '(dnQualifier>=x)'), [f'cn=obj0,{suffix}'])
+                self.assertEqual(await search_dns(indexed, '(dnQualifier<=a)'), [])
+
+        self.loop.run_until_complete(run_test())
+
+    def test_plan(self):
+        async def run_test():
+            suffix = 'o=test'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory', 'indexes': {
+                'cn': ['equality'],
+                'description': ['presence'],
+            }})
+            for i in range(20):
+                attrs = {'objectClass': ['person'], 'cn': [f'user{i}'], 'sn': ['user']}
+                if i < 10:
+                    attrs['description'] = ['first half']
+                await mb.add_params(f'cn=user{i},{suffix}', attrs)
+
+            plan = mb.explain(suffix, Scope.SUB, '(&(objectClass=person)(description=*)(cn=user3))')
+            self.assertTrue(plan.startswith('index'))
+            self.assertIn('equality(cn=user3) ~1', plan)
+            self.assertNotIn('objectClass', plan)
+            self.assertIn('+2 residual', plan)
+
+            plan = mb.explain(suffix, Scope.SUB, '(|(cn=user1)(description=*))')
+            self.assertIn('equality(cn=user1) ~1 | presence(description=*) ~10', plan)
+
+            for fil in '(!(cn=user1))', '(|(cn=user1)(sn=user))', '(sn=user)':
+                with self.subTest('scan', filter=fil):
+                    self.assertTrue(mb.explain(suffix, Scope.SUB, fil).startswith('scan'))
+
+            stats = get_stats()
+            stats.clear()
+            results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, '(&(cn=user3)(sn=user))')))
+            self.assertEqual(len(results), 2)
+            await asynclist(mb.search(make_search_request(suffix, Scope.SUB, '(sn=user)')))
+            self.assertEqual(stats.get('memory_backend_indexed_searches'), 1)
+            self.assertEqual(stats.get('memory_backend_scan_searches'), 1)
+
+        self.loop.run_until_complete(run_test())
+
+    def test_mod_dn(self):
+        async def run_test():
+            suffix = 'o=test'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory', 'indexes': {'cn': ['equality']}})
+            await mb.add_params(f'ou=a,{suffix}', {'ou': ['a']})
+            await mb.add_params(f'ou=b,{suffix}', {'ou': ['b']})
+            await mb.add_params(f'cn=x,ou=a,{suffix}', {'cn': ['x']})
+            await mb.add_params(f'cn=y,cn=x,ou=a,{suffix}', {'cn': ['y']})
+
+            async def search_dns(base, scope=Scope.SUB, fil=None):
+                results = await asynclist(mb.search(make_search_request(base, scope, fil)))
+                return sorted(res.dn for res in results[:-1])
+
+            await mb.mod_dn_params(f'cn=x,ou=a,{suffix}', 'cn=z', True, f'ou=b,{suffix}')
+            self.assertEqual(await search_dns(f'ou=b,{suffix}'),
+                             [f'cn=y,cn=z,ou=b,{suffix}', f'cn=z,ou=b,{suffix}', f'ou=b,{suffix}'])
+            self.assertEqual(await search_dns(f'ou=a,{suffix}'), [f'ou=a,{suffix}'])
+            self.assertEqual(await search_dns(f'cn=y,cn=z,ou=b,{suffix}', Scope.BASE), [f'cn=y,cn=z,ou=b,{suffix}'])
+            self.assertEqual(await search_dns(suffix, fil='(cn=z)'), [f'cn=z,ou=b,{suffix}'])
+            self.assertEqual(await search_dns(suffix, fil='(cn=x)'), [])
+
+            with self.assertRaises(ObjectNotFound) as cm:
+                await asynclist(mb.search(make_search_request(f'cn=y,cn=x,ou=a,{suffix}', Scope.BASE)))
+            self.assertEqual(cm.exception.args[1], f'ou=a,{suffix}')
+
+            await mb.mod_dn_params(f'cn=z,ou=b,{suffix}', 'cn=w', False)
+            self.assertEqual(await search_dns(suffix, fil='(cn=z)'), [f'cn=w,ou=b,{suffix}'])
+            self.assertEqual(await search_dns(suffix, fil='(cn=w)'), [f'cn=w,ou=b,{suffix}'])
+
+            with self.assertRaises(UnwillingToPerformError):
+                await mb.mod_dn_params(f'ou=b,{suffix}', 'ou=c', True, f'cn=y,cn=w,ou=b,{suffix}')
+            await mb.add_params(f'cn=v,ou=b,{suffix}', {'cn': ['v']})
+            with self.assertRaises(EntryAlreadyExistsError):
+                await mb.mod_dn_params(f'cn=v,ou=b,{suffix}', 'cn=w', True)
+            self.assertEqual(await search_dns(suffix, fil='(cn=v)'), [f'cn=v,ou=b,{suffix}'])
+
+            # DNs and RDN values keep the client's spelling, not the matching rule's prepared form
+            await mb.add_params(f'ou=People,{suffix}', {'ou': ['People']})
+            await mb.add_params(f'cn=John Smith,ou=People,{suffix}', {'cn': ['John Smith']})
+            await mb.mod_dn_params(f'ou=people,{suffix}', 'ou=Staff', True)
+            await mb.mod_dn_params(f'cn=john smith,ou=staff,{suffix}', 'cn=Jane Doe', True)
+            self.assertEqual(await search_dns(f'ou=Staff,{suffix}'),
+                             [f'cn=Jane Doe,ou=Staff,{suffix}', f'ou=Staff,{suffix}'])
+            self.assertEqual(list(mb._get(f'cn=jane doe,ou=staff,{suffix}').attrs['cn']), ['Jane Doe'])
+
+        self.loop.run_until_complete(run_test())
+
+    def test_subtree_traversal(self):
+        root = LDAPObject('o=test')
+        for a in 'abc':
+            child = root.add_child(f'ou={a}')
+            for b in 'xyz':
+                grandchild = child.add_child(f'cn={b}')
+                grandchild.add_child('cn=leaf')
+
+        visited = []
+
+        def match(attrs):
+            visited.append(attrs)
+            return 'ou' in attrs
+
+        found = [obj.dn_str for obj in root.subtree(match)]
+        self.assertEqual(found, ['ou=a,o=test', 'ou=b,o=test', 'ou=c,o=test'])
+        self.assertEqual(len(visited), 1 + 3 + 9 + 9)
+        self.assertEqual(len({id(attrs) for attrs in visited}), len(visited))
+
+        visited.clear()
+        results = root.subtree(match)
+        self.assertEqual(next(results).dn_str, 'ou=a,o=test')
+        results.close()
+        self.assertEqual(len(visited), 2)
+
+    def test_result_attr_selection(self):
+        obj = LDAPObject('cn=test', attrs={
+            'cn': ['test'],
+            'sn': ['user'],
+            'creatorsName': ['cn=admin'],
+        })
+
+        def selected(attrs):
+            return sorted(attr.lower() for attr, vals in obj.to_result(attrs).items())
+
+        self.assertEqual(selected(None), ['cn', 'sn'])
+        self.assertEqual(selected(['*']), ['cn', 'sn'])
+        self.assertEqual(selected(['+']), ['creatorsname'])
+        self.assertEqual(selected(['*', '+']), ['cn', 'creatorsname', 'sn'])
+        self.assertEqual(selected(['SN', 'creatorsname']), ['creatorsname', 'sn'])
+        self.assertEqual(selected(['1.1']), [])
+        self.assertEqual(selected(['1.1', 'cn']), ['cn'])
+
+        res = obj.to_result(AttrSelection(['sn']))
+        obj.modify_op(Mod.ADD, 'sn', ['other'])
+        obj.modify_op(Mod.REPLACE, 'cn', ['changed'])
+        self.assertEqual(list(res.attrs['sn']), ['user'])
+        self.assertEqual(res.items(), (('sn', ('user',)),))
+        self.assertEqual(list(obj.attrs['sn']), ['user', 'other'])
+
+        res = obj.to_result(None, types_only=True)
+        self.assertEqual(sorted(attr for attr, vals in res.items() if not vals), ['cn', 'sn'])
+
+    def test_persistence(self):
+        async def run_test(directory):
+            suffix = 'o=test'
+            conf = {
+                'data_backend': 'memory',
+                'indexes': {'cn': ['equality']},
+                'persistence': {'directory': directory, 'fsync': False, 'snapshot_after_records': 4},
+            }
+
+            async def search_dns(mb, fil=None):
+                results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, fil)))
+                return sorted(res.dn for res in results[:-1])
+
+            mb = MemoryBackend(suffix, conf)
+            await asyncio.gather(*(mb.add_params(f'ou={ou},{suffix}', {'ou': [ou]}) for ou in 'abc'))
+            await mb.add_params(f'cn=x,ou=a,{suffix}', {'cn': ['x'], 'description': ['one']})
+            # let the snapshot triggered by the 4th record finish
+            await mb._persistence._snapshot_task
+            self.assertTrue(os.path.exists(os.path.join(directory, 'snapshot')))
+
+            await mb.modify_params(f'cn=x,ou=a,{suffix}', [(Mod.REPLACE, 'description', ['two']),
+                                                          (Mod.ADD, 'cn', ['y'])])
+            await mb.mod_dn_params(f'cn=x,ou=a,{suffix}', 'cn=z', False, f'ou=b,{suffix}')
+            await mb.delete(f'ou=c,{suffix}')
+            expected = await search_dns(mb)
+
+            restarted = MemoryBackend(suffix, conf)
+            self.assertEqual(await search_dns(restarted), expected)
+            self.assertEqual(await search_dns(restarted, '(cn=y)'), [f'cn=z,ou=b,{suffix}'])
+            obj = restarted._get(f'cn=z,ou=b,{suffix}')
+            self.assertEqual(list(obj.attrs['description']), ['two'])
+            self.assertEqual(restarted.indexes.entry_count, mb.indexes.entry_count)
+
+            # a torn record at the end of the log is discarded
+            wal_fn = sorted(fn for fn in os.listdir(directory) if fn.startswith('wal.'))[-1]
+            with open(os.path.join(directory, wal_fn), 'ab') as f:
+                f.write(b'\x00\x00\x01\x00garbage')
+            restarted = MemoryBackend(suffix, conf)
+            self.assertEqual(await search_dns(restarted), expected)
+            await restarted.add_params(f'ou=d,{suffix}', {'ou': ['d']})
+            await restarted._persistence._snapshot_task
+            restarted = MemoryBackend(suffix, conf)
+            self.assertEqual(await search_dns(restarted), sorted(expected + [f'ou=d,{suffix}']))
+
+            # the snapshot is copied in slices, as of the moment it was started
+            restarted.scan_slice_entries = 1
+            snapshot = asyncio.ensure_future(restarted._persistence.snapshot())
+            await asyncio.sleep(0)
+            await restarted.delete(f'ou=d,{suffix}')
+            await snapshot
+            with open(os.path.join(directory, 'snapshot'), 'rb') as f:
+                self.assertEqual(pickle.load(f)['count'], len(expected) + 1)
+            restarted = MemoryBackend(suffix, conf)
+            self.assertEqual(await search_dns(restarted), expected)
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.loop.run_until_complete(run_test(directory))
+
+    def test_write_ahead(self):
+        async def run_test(directory):
+            suffix = 'o=test'
+            conf = {
+                'data_backend': 'memory',
+                'persistence': {'directory': directory, 'fsync': False, 'group_commit_delay': 0.01},
+            }
+            mb = MemoryBackend(suffix, conf)
+            await mb.add_params(f'ou=a,{suffix}', {'ou': ['a']})
+
+            # writes are only visible once logged
+            add = asyncio.ensure_future(mb.add_params(f'cn=x,ou=a,{suffix}', {'cn': ['x'], 'description': ['old']}))
+            await asyncio.sleep(0)
+            with self.assertRaises(ObjectNotFound):
+                mb._get(f'cn=x,ou=a,{suffix}')
+
+            # the parent cannot be deleted under a pending write
+            stats = get_stats()
+            stats.clear()
+            delete = asyncio.ensure_future(mb.delete(f'ou=a,{suffix}'))
+            await add
+            with self.assertRaises(LDAPError):
+                await delete
+            self.assertEqual(stats.get('memory_backend_write_lock_waits'), 1)
+
+            class FailingWAL(object):
+                def write(self, data):
+                    raise OSError('disk full')
+
+            mb._persistence._wal = FailingWAL()
+            with self.assertRaises(InternalError):
+                await mb.modify_params(f'cn=x,ou=a,{suffix}', [(Mod.REPLACE, 'description', ['new'])])
+            self.assertEqual(list(mb._get(f'cn=x,ou=a,{suffix}').attrs['description']), ['old'])
+            with self.assertRaises(InternalError):
+                await mb.delete(f'cn=x,ou=a,{suffix}')
+
+            restarted = MemoryBackend(suffix, conf)
+            self.assertEqual(list(restarted._get(f'cn=x,ou=a,{suffix}').attrs['description']), ['old'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.loop.run_until_complete(run_test(directory))
+
+    def test_snapshot_directory_fsync(self):
+        async def run_test(directory):
+            suffix = 'o=test'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory', 'persistence': {'directory': directory}})
+            await mb.add_params(f'ou=a,{suffix}', {'ou': ['a']})
+            persistence = mb._persistence
+            old_wal_fn = persistence._wal.name
+            fsync_directory = persistence._fsync_directory
+            synced = []
+
+            def record_fsync():
+                # the old WAL file must still be there when the snapshot rename is made durable
+                synced.append(os.path.exists(old_wal_fn))
+                fsync_directory()
+
+            persistence._fsync_directory = record_fsync
+            await persistence.snapshot()
+            self.assertEqual(synced, [True])
+            self.assertFalse(os.path.exists(old_wal_fn))
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.loop.run_until_complete(run_test(directory))
+
+    def test_snapshot_reads(self):
+        async def run_test():
+            suffix = 'o=test'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory', 'indexes': {'cn': ['equality']}})
+            for ou in 'abc':
+                await mb.add_params(f'ou={ou},{suffix}', {'ou': [ou]})
+                for cn in 'xy':
+                    await mb.add_params(f'cn={cn},ou={ou},{suffix}', {'cn': [cn], 'description': ['old']})
+
+            async def search(fil=None):
+                return {res.dn: list(res.attrs.get('description', [])) for res in
+                        (await asynclist(mb.search(make_search_request(suffix, Scope.SUB, fil))))[:-1]}
+
+            for fil in (None, '(cn=x)'):
+                with self.subTest(fil=fil):
+                    before = await search(fil)
+                    results = mb.search(make_search_request(suffix, Scope.SUB, fil))
+                    first = await results.__anext__()
+
+                    await mb.modify_params(f'cn=x,ou=c,{suffix}', [(Mod.REPLACE, 'description', ['new'])])
+                    await mb.add_params(f'ou=d,{suffix}', {'ou': ['d']})
+                    await mb.add_params(f'cn=x,ou=d,{suffix}', {'cn': ['x']})
+                    await mb.delete(f'cn=y,ou=b,{suffix}')
+                    await mb.mod_dn_params(f'cn=x,ou=b,{suffix}', 'cn=w', True, f'ou=a,{suffix}')
+                    with self.assertRaises(EntryAlreadyExistsError):
+                        await mb.mod_dn_params(f'cn=w,ou=a,{suffix}', 'cn=y', True, f'ou=c,{suffix}')
+                    await mb.mod_dn_params(f'cn=x,ou=c,{suffix}', 'cn=z', False, f'ou=b,{suffix}')
+                    self.assertGreater(mb._versions.retained, 0)
+
+                    seen = {first.dn: list(first.attrs.get('description', []))}
+                    for res in (await asynclist(results))[:-1]:
+                        seen[res.dn] = list(res.attrs.get('description', []))
+                    self.assertEqual(seen, before)
+                    self.assertEqual(mb._versions.retained, 0)
+                    self.assertIsNone(mb._get(f'cn=z,ou=b,{suffix}').prev)
+                    self.assertIsNone(mb._get(f'ou=b,{suffix}').former_children)
+
+                    after = await search(fil)
+                    self.assertNotEqual(after, before)
+                    self.assertEqual(after[f'cn=z,ou=b,{suffix}'], ['new'])
+
+                    # put things back for the next filter
+                    await mb.mod_dn_params(f'cn=z,ou=b,{suffix}', 'cn=x', False, f'ou=c,{suffix}')
+                    await mb.mod_dn_params(f'cn=w,ou=a,{suffix}', 'cn=x', True, f'ou=b,{suffix}')
+                    await mb.add_params(f'cn=y,ou=b,{suffix}', {'cn': ['y'], 'description': ['old']})
+                    await mb.modify_params(f'cn=x,ou=c,{suffix}', [(Mod.REPLACE, 'description', ['old'])])
+                    await mb.delete(f'cn=x,ou=d,{suffix}')
+                    await mb.delete(f'ou=d,{suffix}')
+
+        self.loop.run_until_complete(run_test())
+
+    def test_atomic_modify(self):
+        async def run_test():
+            suffix = 'o=test'
+            dn = f'cn=x,{suffix}'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory', 'indexes': {'description': ['equality']}})
+            await mb.add_params(dn, {'objectClass': ['person'], 'cn': ['x'], 'sn': ['y'], 'description': ['old']})
+
+            with self.assertRaises(SchemaValidationError):
+                await mb.modify_params(dn, [(Mod.REPLACE, 'description', ['new']), (Mod.DELETE, 'sn', [])])
+            obj = mb._get(dn)
+            self.assertEqual(list(obj.attrs['description']), ['old'])
+            self.assertEqual(list(obj.attrs['sn']), ['y'])
+            self.assertEqual(mb.indexes.get('description', 'equality').lookup('old'), {obj})
+
+            with self.assertRaises(SchemaValidationError):
+                await mb.modify_params(dn, [(Mod.ADD, 'objectClass', ['organizationalUnit'])])
+            await mb.modify_params(dn, [(Mod.REPLACE, 'description', ['new']), (Mod.ADD, 'seeAlso', [suffix])])
+            self.assertEqual(list(obj.attrs['description']), ['new'])
+            self.assertEqual(mb.indexes.get('description', 'equality').lookup('new'), {obj})
+
+        self.loop.run_until_complete(run_test())
+
+    def test_entry_locks(self):
+        async def run_test():
+            suffix = 'o=test'
+            dn = f'cn=x,{suffix}'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory'})
+            await mb.add_params(dn, {'cn': ['x'], 'description': ['old']})
+            stats = get_stats()
+            stats.clear()
+
+            # readers do not wait for each other
+            async with mb._locks.read(mb._get(dn).dn):
+                self.assertTrue(await mb.compare_params(dn, 'description', 'old'))
+            self.assertEqual(stats.get('memory_backend_read_lock_waits'), 0)
+
+            # readers of an entry wait for a write to it to complete
+            async with mb._locks.write(mb._get(dn).dn):
+                compare = asyncio.ensure_future(mb.compare_params(dn, 'description', 'new'))
+                modify = asyncio.ensure_future(mb.modify_params(dn, [(Mod.REPLACE, 'description', ['new'])]))
+                await asyncio.sleep(0)
+                self.assertFalse(compare.done())
+                self.assertFalse(modify.done())
+                mb._get(dn).modify([(Mod.REPLACE, 'description', ['locked'])])
+            self.assertFalse(await compare)
+            await modify
+            self.assertTrue(await mb.compare_params(dn, 'description', 'new'))
+            self.assertEqual(stats.get('memory_backend_read_lock_waits'), 1)
+            self.assertEqual(stats.get('memory_backend_write_lock_waits'), 1)
+            self.assertEqual(len(mb._locks), 0)
+
+        self.loop.run_until_complete(run_test())
+
+    def test_lock_writer_preference(self):
+        async def run_test():
+            lock = RWLock()
+            order = []
+
+            async def read(name):
+                await lock.acquire_read()
+                order.append(name)
+
+            async def write(name):
+                await lock.acquire_write()
+                order.append(name)
+
+            # a waiting writer holds off new readers
+            await read('r1')
+            w1 = asyncio.ensure_future(write('w1'))
+            r2 = asyncio.ensure_future(read('r2'))
+            await asyncio.sleep(0)
+            self.assertEqual(order, ['r1'])
+            lock.release_read()
+            await asyncio.sleep(0)
+            self.assertEqual(order, ['r1', 'w1'])
+
+            # readers that queued during a write go before the next writer
+            w2 = asyncio.ensure_future(write('w2'))
+            r3 = asyncio.ensure_future(read('r3'))
+            await asyncio.sleep(0)
+            lock.release_write()
+            await asyncio.gather(w1, r2, r3)
+            self.assertEqual(order, ['r1', 'w1', 'r2', 'r3'])
+            lock.release_read()
+            lock.release_read()
+            await w2
+            self.assertEqual(order[-1], 'w2')
+
+            # readers queued behind a writer that gives up are let in
+            lock.release_write()
+            await read('r4')
+            w3 = asyncio.ensure_future(write('w3'))
+            r5 = asyncio.ensure_future(read('r5'))
+            await asyncio.sleep(0)
+            w3.cancel()
+            await r5
+            self.assertEqual(order[-2:], ['r4', 'r5'])
+            self.assertEqual((lock.readers, lock.writing), (2, False))
+            lock.release_read()
+            lock.release_read()
+            self.assertTrue(lock.idle)
+
+        self.loop.run_until_complete(run_test())
+
+    def test_lock_cancelled_waiters(self):
+        async def run_test():
+            # waiters cancelled before they resume are not handed the lock
+            lock = RWLock()
+            await lock.acquire_write()
+            reader = asyncio.ensure_future(lock.acquire_read())
+            writer = asyncio.ensure_future(lock.acquire_write())
+            await asyncio.sleep(0)
+            reader.cancel()
+            writer.cancel()
+            lock.release_write()
+            await asyncio.gather(reader, writer, return_exceptions=True)
+            self.assertTrue(reader.cancelled())
+            self.assertTrue(writer.cancelled())
+            self.assertTrue(lock.idle)
+
+        self.loop.run_until_complete(run_test())
+
+    def test_scan_time_slicing(self):
+        async def run_test():
+            suffix = 'o=test'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory', 'scan_slice_entries': 10})
+            for i in range(99):
+                await mb.add_params(f'cn=user{i},{suffix}', {'cn': [f'user{i}']})
+            stats = get_stats()
+            stats.clear()
+
+            ticks = 0
+
+            async def other_connection():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0)
+                    ticks += 1
+
+            other = asyncio.ensure_future(other_connection())
+            await asyncio.sleep(0)
+            ticks = 0
+            results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, '(cn=user98)')))
+            other.cancel()
+
+            self.assertEqual(len(results), 2)
+            self.assertEqual(stats.get('memory_backend_entries_examined'), 100)
+            self.assertEqual(stats.get('memory_backend_scan_pauses'), 10)
+            self.assertGreaterEqual(ticks, 10)
+
+        self.loop.run_until_complete(run_test())
+
+    def test_search_limits(self):
+        async def run_test():
+            suffix = 'o=test'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory', 'indexes': {'sn': ['equality']},
+                                        'scan_slice_entries': 10, 'lookthrough_limit': 50})
+            for i in range(99):
+                await mb.add_params(f'cn=user{i},{suffix}', {'cn': [f'user{i}'], 'sn': ['a' if i < 5 else 'b']})
+
+            results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, '(sn=a)', limit=3)))
+            self.assertEqual(len(results), 4)
+            self.assertEqual(results[-1].result_code, rfc4511.ResultCode('sizeLimitExceeded'))
+
+            results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, '(sn=a)', limit=5)))
+            self.assertEqual(len(results), 6)
+            self.assertEqual(results[-1].result_code, rfc4511.ResultCode('success'))
+
+            # unindexed searches stop once they have examined lookthrough_limit entries
+            stats = get_stats()
+            stats.clear()
+            results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, '(cn=user98)')))
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[-1].result_code, rfc4511.ResultCode('adminLimitExceeded'))
+            # the 51st entry is only examined to find out that the scan was not finished
+            self.assertEqual(stats.get('memory_backend_entries_examined'), 51)
+
+            # a scan of exactly lookthrough_limit entries completes normally
+            mb.lookthrough_limit = 100
+            results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, '(cn=user98)')))
+            self.assertEqual(len(results), 2)
+            self.assertEqual(results[-1].result_code, rfc4511.ResultCode('success'))
+            mb.lookthrough_limit = 99
+            results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, '(cn=user98)')))
+            self.assertEqual(results[-1].result_code, rfc4511.ResultCode('adminLimitExceeded'))
+
+            # indexed searches are not subject to it
+            results = await asynclist(mb.search(make_search_request(suffix, Scope.SUB, '(&(sn=b)(cn=user98))')))
+            self.assertEqual(len(results), 2)
+            self.assertEqual(results[-1].result_code, rfc4511.ResultCode('success'))
+
+            mb.lookthrough_limit = None
+            results = await asynclist(mb.search_params(suffix, Scope.SUB, '(sn=*)', time_limit=1))
+            self.assertEqual(results[-1].result_code, rfc4511.ResultCode('success'))
+            results = await asynclist(mb.search_params(suffix, Scope.SUB, '(sn=*)', time_limit=1e-9))
+            self.assertLess(len(results), 99)
+            self.assertEqual(results[-1].result_code, rfc4511.ResultCode('timeLimitExceeded'))
+
+        self.loop.run_until_complete(run_test())
+
+    def test_shared_object_classes(self):
+        async def run_test():
+            suffix = 'o=test'
+            mb = MemoryBackend(suffix, {'data_backend': 'memory'})
+            for i in range(3):
+                await mb.add_params(f'cn=user{i},{suffix}', {'objectClass': ['top', 'person'],
+                                                             'cn': [f'user{i}'], 'sn': ['x']})
+            await mb.add_params(f'cn=user3,{suffix}', {'objectClass': ['PERSON', '2.5.6.0'], 'cn': ['user3'],
+                                                       'sn': ['x']})
+            objs = [mb._get(f'cn=user{i},{suffix}') for i in range(4)]
+            self.assertEqual(len({id(obj.object_class) for obj in objs}), 1)
+            self.assertEqual(objs[0].object_class.names, frozenset(['top', 'person']))
+
+            with self.assertRaises(SchemaValidationError):
+                await mb.modify_params(f'cn=user0,{suffix}', [(Mod.ADD, 'uid', ['user0'])])
+            await mb.modify_params(f'cn=user0,{suffix}', [(Mod.ADD, 'objectClass', ['extensibleObject']),
+                                                          (Mod.ADD, 'uid', ['user0'])])
+            self.assertIsNot(objs[0].object_class, objs[1].object_class)
+            self.assertTrue(objs[0].object_class.extensible)
+            await mb.add_params(f'cn=user4,{suffix}', {'objectClass': ['top', 'person', 'extensibleObject'],
+                                                       'cn': ['user4'], 'sn': ['x'], 'uid': ['user4']})
+            self.assertIs(mb._get(f'cn=user4,{suffix}').object_class, objs[0].object_class)
+
+            with self.assertRaises(SchemaValidationError):
+                await mb.modify_params(f'cn=user0,{suffix}', [(Mod.DELETE, 'objectClass', ['extensibleObject'])])
+            await mb.modify_params(f'cn=user0,{suffix}', [(Mod.DELETE, 'objectClass', ['extensibleObject']),
+                                                          (Mod.DELETE, 'uid', [])])
+            self.assertIs(objs[0].object_class, objs[1].object_class)
+
+            # re-resolving the schema starts over with new merged classes
+            get_schema().resolve()
+            self.assertIsNot(get_schema().get_merged_object_class(['top', 'person']), objs[1].object_class)
+
+        self.loop.run_until_complete(run_test())
@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+
+from laurelin.server.response_writer import ResponseWriter
+
+
+class MockWriter(object):
+    def __init__(self):
+        self.writes = []
+        self.drains = 0
+
+    def write(self, data):
+        self.writes.append(data)
+
+    async def drain(self):
+        self.drains += 1
+
+
+class TestResponseWriter(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def test_coalesce(self):
+        async def run_test():
+            mock = MockWriter()
+            rw = ResponseWriter(mock, 10)
+            await rw.send(b'abcd', flush=False)
+            await rw.send(b'efgh', flush=False)
+            self.assertEqual(mock.writes, [])
+            await rw.send(b'ijkl', flush=False)
+            self.assertEqual(mock.writes, [b'abcdefghijkl'])
+            self.assertEqual(mock.drains, 1)
+            await rw.send(b'mn', flush=False)
+            await rw.send(b'op')
+            self.assertEqual(mock.writes, [b'abcdefghijkl', b'mnop'])
+            self.assertEqual(mock.drains, 2)
+
+        self.loop.run_until_complete(run_test())
+
+    def test_flush_later(self):
+        async def run_test():
+            mock = MockWriter()
+            rw = ResponseWriter(mock, 10)
+            await rw.send(b'abcd', flush=False)
+            await rw.send(b'efgh', flush=False)
+            self.assertEqual(mock.writes, [])
+            # written out once the sender gives up control
+            await asyncio.sleep(0.01)
+            self.assertEqual(mock.writes, [b'abcdefgh'])
+            self.assertEqual(mock.drains, 1)
+
+            mock = MockWriter()
+            rw = ResponseWriter(mock, 10, flush_delay=0.1)
+            await rw.send(b'abcd', flush=False)
+            await asyncio.sleep(0.01)
+            self.assertEqual(mock.writes, [])
+            await asyncio.sleep(0.2)
+            self.assertEqual(mock.writes, [b'abcd'])
+
+            # an explicit flush cancels the pending one
+            await rw.send(b'efgh', flush=False)
+            await rw.send(b'ijkl')
+            await asyncio.sleep(0.2)
+            self.assertEqual(mock.writes, [b'abcd', b'efghijkl'])
+            self.assertEqual(mock.drains, 2)
+
+        self.loop.run_until_complete(run_test())
@@ -0,0 +1,49 @@
+import unittest
+
+from laurelin.ldap import rfc4511
+from pyasn1.codec.ber.encoder import encode as ber_encode
+
+from laurelin.server import search_results
+from laurelin.server.dit import DIT
+from laurelin.server.exceptions import ConfigError
+from laurelin.server.root_dse import RootDSE
+from laurelin.server.schema import get_schema
+
+
+def pack(message_id, op):
+    lm = rfc4511.LDAPMessage()
+    lm.setComponentByName('messageID', rfc4511.MessageID(message_id))
+    lm.setComponentByName('protocolOp', op)
+    return lm
+
+
+class TestRootDSE(unittest.TestCase):
+    def __init__(self, *args, **kwds):
+        unittest.TestCase.__init__(self, *args, **kwds)
+        schema = get_schema()
+        schema.load_builtin()
+        schema.resolve()
+
+    def test_encode(self):
+        dit = DIT({
+            'o=foo': {'data_backend': 'memory'},
+            'o=bar': {'data_backend': 'memory', 'default': True},
+        })
+        root_dse = RootDSE(dit)
+        self.assertEqual(list(root_dse.entry.attrs['defaultNamingContext']), ['o=bar'])
+        for message_id in 1, 300:
+            expected = (ber_encode(pack(message_id, root_dse.entry.to_proto())) +
+                        ber_encode(pack(message_id, search_results.Done('').to_proto())))
+            self.assertEqual(root_dse.encode(message_id), expected)
+
+        root_dse.set_attr('supportedExtension', ['1.2.3.4'])
+        self.assertEqual(list(root_dse.entry.attrs['supportedExtension']), ['1.2.3.4'])
+        self.assertIn(b'1.2.3.4', root_dse.encode(2))
+
+    def test_multiple_default(self):
+        dit = DIT({
+            'o=foo': {'data_backend': 'memory', 'default': True},
+            'o=bar': {'data_backend': 'memory', 'default': True},
+        })
+        with self.assertRaises(ConfigError):
+            RootDSE(dit)
@@ -0,0 +1,71 @@
+import asyncio
+import gc
+import importlib.util
+import sys
+import unittest
+
+from laurelin.server.config import Config
+from laurelin.server.exceptions import ConfigError
+from laurelin.server.runtime import configure_event_loop, configure_gc, freeze_gc
+
+HAVE_UVLOOP = importlib.util.find_spec('uvloop') is not None
+
+
+class TestEventLoop(unittest.TestCase):
+    def tearDown(self):
+        asyncio.set_event_loop_policy(None)
+
+    def test_configure_event_loop(self):
+        self.assertEqual(configure_event_loop('asyncio'), 'asyncio')
+        with self.assertRaises(ConfigError):
+            configure_event_loop('trio')
+
+    def test_uvloop_fallback(self):
+        # a None entry in sys.modules makes the import fail as if uvloop was not installed
+        saved = sys.modules.get('uvloop')
+        sys.modules['uvloop'] = None
+        try:
+            self.assertEqual(configure_event_loop('auto'), 'asyncio')
+            self.assertNotIn('uvloop', type(asyncio.get_event_loop_policy()).__module__)
+            with self.assertRaises(ConfigError):
+                configure_event_loop('uvloop')
+        finally:
+            if saved is None:
+                del sys.modules['uvloop']
+            else:
+                sys.modules['uvloop'] = saved
+
+    @unittest.skipUnless(HAVE_UVLOOP, 'uvloop is not installed')
+    def test_uvloop(self):
+        self.assertEqual(configure_event_loop('auto'), 'uvloop')
+        self.assertEqual(configure_event_loop('uvloop'), 'uvloop')
+        self.assertEqual(type(asyncio.get_event_loop_policy()).__module__.split('.')[0], 'uvloop')
+
+
+class TestGC(unittest.TestCase):
+    def setUp(self):
+        self.thresholds = gc.get_threshold()
+        self.enabled = gc.isenabled()
+
+    def tearDown(self):
+        gc.set_threshold(*self.thresholds)
+        if self.enabled:
+            gc.enable()
+        gc.unfreeze()
+
+    def test_configure_gc(self):
+        configure_gc(Config({}))
+        self.assertEqual(gc.get_threshold(), self.thresholds)
+        self.assertEqual(gc.isenabled(), self.enabled)
+
+        configure_gc(Config({'thresholds': [50000, 20, 20], 'disable': True}))
+        self.assertEqual(gc.get_threshold(), (50000, 20, 20))
+        self.assertFalse(gc.isenabled())
+
+    def test_freeze_gc(self):
+        gc.unfreeze()
+        freeze_gc(Config({}))
+        self.assertEqual(gc.get_freeze_count(), 0)
+
+        freeze_gc(Config({'freeze_after_startup': True}))
+        self.assertGreater(gc.get_freeze_count(), 0)
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import signal
+import tempfile
+import unittest
+
+from laurelin.ldap.modify import Mod
+
+from laurelin.server.config import Config
+from laurelin.server.exceptions import ConfigError
+from laurelin.server.memory_backend import MemoryBackend
+from laurelin.server.schema import get_schema
+from laurelin.server.workers import WorkerSupervisor
+
+SUFFIX = 'o=test'
+DN = f'cn=user,{SUFFIX}'
+
+
+class CrashingServer(object):
+    """Stands in for LaurelinServer in the workers; every run records what the worker sees, then changes it and crashes
+    until the expected number of runs have happened"""
+
+    def __init__(self, backend, log_fn, runs):
+        self.conf = Config({'worker_restart_delay': 0.01})
+        self.backend = backend
+        self.log_fn = log_fn
+        self.runs = runs
+
+    async def run(self):
+        description = self.backend._get(DN).attrs['description'][0]
+        with open(self.log_fn, 'a') as f:
+            f.write(f'{os.getpid()} {description}\n')
+        with open(self.log_fn) as f:
+            runs = len(f.readlines())
+        if runs < self.runs:
+            await self.backend.modify_params(DN, [(Mod.REPLACE, 'description', [f'written by run {runs}'])])
+            with open(f'{self.log_fn}.writes', 'a') as f:
+                f.write(f"{self.backend._get(DN).attrs['description'][0]}\n")
+            raise RuntimeError('worker crashed')
+        # stop the supervisor, which in turn stops this worker
+        os.kill(os.getppid(), signal.SIGTERM)
+        await asyncio.Event().wait()
+
+
+class TestWorkers(unittest.TestCase):
+    def __init__(self, *args, **kwds):
+        unittest.TestCase.__init__(self, *args, **kwds)
+        schema = get_schema()
+        schema.load_builtin()
+        schema.resolve()
+
+    def test_configure_workers(self):
+        with self.assertRaises(ConfigError):
+            MemoryBackend(SUFFIX, {}).configure_workers()
+        with self.assertRaises(ConfigError):
+            MemoryBackend(SUFFIX, {'multi_worker': 'shared'}).configure_workers()
+
+        backend = MemoryBackend(SUFFIX, {'multi_worker': 'read_only'})
+        backend.configure_workers()
+        self.assertTrue(backend.read_only)
+
+        backend = MemoryBackend(SUFFIX, {'multi_worker': 'independent'})
+        with self.assertLogs('laurelin.server.memory_backend', 'WARNING'):
+            backend.configure_workers()
+        self.assertFalse(backend.read_only)
+
+        with tempfile.TemporaryDirectory() as directory:
+            persistence = {'directory': directory, 'fsync': False}
+            with self.assertRaises(ConfigError):
+                MemoryBackend(SUFFIX, {'multi_worker': 'independent', 'persistence': persistence}).configure_workers()
+            backend = MemoryBackend(SUFFIX, {'multi_worker': 'read_only', 'persistence': persistence})
+            backend.configure_workers()
+            self.assertTrue(backend.read_only)
+
+    def test_multi_worker_modes(self):
+        for mode in MemoryBackend.MULTI_WORKER_MODES:
+            with self.subTest(mode=mode):
+                MemoryBackend(SUFFIX, {'multi_worker': mode}).configure_workers()
+
+    def test_restart_worker(self):
+        backend = MemoryBackend(SUFFIX, {'multi_worker': 'independent'})
+        asyncio.run(backend.add_params(DN, {'cn': ['user'], 'description': ['loaded at startup']}))
+
+        handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+        with tempfile.TemporaryDirectory() as directory:
+            log_fn = os.path.join(directory, 'runs')
+            supervisor = WorkerSupervisor(CrashingServer(backend, log_fn, runs=3), num_workers=1)
+            try:
+                with self.assertLogs('laurelin.server.workers', 'INFO') as logs:
+                    supervisor.run()
+            finally:
+                for signum, handler in handlers.items():
+                    signal.signal(signum, handler)
+            with open(log_fn) as f:
+                runs = [line.split(' ', 1) for line in f.read().splitlines()]
+            with open(f'{log_fn}.writes') as f:
+                writes = f.read().splitlines()
+
+        self.assertEqual(supervisor.workers, {})
+        self.assertEqual(sum('died unexpectedly' in line for line in logs.output), 2)
+        self.assertIn('INFO:laurelin.server.workers:All workers have exited', logs.output)
+
+        # every run was a new process, and although the crashed workers' writes were accepted, each restarted worker
+        # went back to the data the parent loaded
+        self.assertEqual(len({pid for pid, _ in runs}), 3)
+        self.assertEqual(writes, ['written by run 1', 'written by run 2'])
+        self.assertEqual([description for _, description in runs], ['loaded at startup'] * 3)
+        self.assertEqual(backend._get(DN).attrs['description'][0], 'loaded at startup')
+